@@ -6,6 +6,13 @@ jQuery(function ($) {
         $prog = $(".progress-bar"),
         $email = $("#email"),
         $pass = $("#password"),
+        $all_attachments = $("#all-attachments"),
+        $after = $("#after"),
+        $before = $("#before"),
+        $larger = $("#larger"),
+        $smaller = $("#smaller"),
+        $label = $("#label"),
+        $query = $("#query"),
         $submit = $("#submit"),
         $auth_form = $("#auth-form"),
         $auth_fields = $auth_form.find(":input"),
@@ -13,13 +20,25 @@ jQuery(function ($) {
         $sync_form = $("#sync-form"),
         $confim_form = $("#confirm-form"),
         $no_confirm_bttn = $confim_form.find("[type=cancel]"),
+        $gallery = $("#gallery"),
+        $gallery_images = $gallery.find(".images"),
+        $marked = $sync_form.find(".marked"),
+        // Names of the images picked in the gallery, to remove from Gmail
+        selected = {},
+        num_selected = 0,
+        gallery_page = 0,
+        gallery_pages = 0,
+        load_gallery,
+        show_selected,
         rewrite_index = 0,
         rewrite_total = 0,
         feedback,
         num_messages,
         update_progress,
+        on_message,
         hide_progress,
-        ws = new WebSocket("ws://" + loc.host + "/ws");
+        open_socket,
+        ws;
 
     hide_progress = function () {
         $prog_container.fadeOut();
@@ -75,6 +94,69 @@ jQuery(function ($) {
         }
     };
 
+    show_selected = function () {
+        $marked.text(num_selected + (num_selected === 1 ? " image" : " images") + " marked for removal");
+    };
+
+    // Only a page of thumbnails is shown at a time, so reviewing thousands
+    // of images never means loading them all at once
+    load_gallery = function (page) {
+        var job = window.sessionStorage.getItem("job");
+        if (!job) {
+            return;
+        }
+        $.getJSON("/gallery/" + job, {"page": page}, function (data) {
+            gallery_page = data.page;
+            gallery_pages = data.pages;
+            $gallery_images.empty();
+            $.each(data.images, function (i, image) {
+                var $link = $("<a href='#' class='thumbnail'></a>")
+                        .attr("title", image.subject + " - " + image.name)
+                        .data("name", image.name)
+                        .toggleClass("selected", !!selected[image.name])
+                        .append($("<img>").attr("src", image.thumb).attr("alt", image.name));
+                $("<div class='col-xs-4 col-sm-3 col-md-2'></div>")
+                    .append($link)
+                    .appendTo($gallery_images);
+            });
+            $gallery.find(".page-number").text(
+                data.pages ? "Page " + (data.page + 1) + " of " + data.pages : "No images"
+            );
+            $gallery.find(".previous").toggleClass("disabled", data.page <= 0);
+            $gallery.find(".next").toggleClass("disabled", data.page >= data.pages - 1);
+        });
+    };
+
+    $gallery_images.on("click", ".thumbnail", function () {
+        var $link = $(this),
+            name = $link.data("name");
+
+        if (selected[name]) {
+            delete selected[name];
+            num_selected -= 1;
+        } else {
+            selected[name] = true;
+            num_selected += 1;
+        }
+        $link.toggleClass("selected", !!selected[name]);
+        show_selected();
+        return false;
+    });
+
+    $gallery.find(".previous a").click(function () {
+        if (gallery_page > 0) {
+            load_gallery(gallery_page - 1);
+        }
+        return false;
+    });
+
+    $gallery.find(".next a").click(function () {
+        if (gallery_page < gallery_pages - 1) {
+            load_gallery(gallery_page + 1);
+        }
+        return false;
+    });
+
     $auth_form.submit(function () {
 
         var params = JSON.stringify({
@@ -83,7 +165,15 @@ jQuery(function ($) {
             "type": "connect",
             "limit": 0,
             "simultaneous": 10,
-            "rewrite": 1
+            "rewrite": 1,
+            "all_attachments": $all_attachments.is(":checked"),
+            // Gmail wants dates as YYYY/MM/DD, date inputs give YYYY-MM-DD
+            "after": $after.val().replace(/-/g, "/"),
+            "before": $before.val().replace(/-/g, "/"),
+            "larger": $larger.val(),
+            "smaller": $smaller.val(),
+            "label": $label.val(),
+            "query": $query.val()
         });
 
         $auth_fields.attr("disabled", "disabled");
@@ -94,9 +184,16 @@ jQuery(function ($) {
 
     $sync_form.submit(function () {
 
-        var params = JSON.stringify({
+        var params = {
             "type": "sync"
-        });
+        };
+
+        // Images picked in the gallery are removed instead of those
+        // deleted from disk
+        if (num_selected) {
+            params.names = Object.keys(selected);
+        }
+        params = JSON.stringify(params);
 
         $(this).find("[type=submit]").attr("disabled", "disabled");
         ws.send(params);
@@ -123,11 +220,40 @@ jQuery(function ($) {
         return false;
     });
 
-    ws.onmessage = function (evt) {
+    // Jobs keep running on the server if the connection drops, so
+    // reconnect and pick up where the job has got to
+    open_socket = function () {
+        ws = new WebSocket("ws://" + loc.host + "/ws");
+        ws.onopen = function () {
+            var job = window.sessionStorage.getItem("job");
+            if (job) {
+                ws.send(JSON.stringify({"type": "attach", "job": job}));
+            }
+        };
+        ws.onclose = function () {
+            window.setTimeout(open_socket, 2000);
+        };
+        ws.onmessage = on_message;
+    };
+
+    on_message = function (evt) {
         var msg = JSON.parse(evt.data);
 
         switch (msg['type']) {
 
+            case "job":
+                window.sessionStorage.setItem("job", msg.job);
+                break;
+
+            case "attach":
+                window.sessionStorage.removeItem("job");
+                break;
+
+            case "waiting":
+                feedback(msg);
+                update_progress();
+                break;
+
             case "connect":
                 feedback(msg);
                 if (!msg.ok) {
@@ -148,14 +274,23 @@ jQuery(function ($) {
                 break;
 
             case "download-complete":
-                feedback(msg, "Please delete any attachments you'd like removed from your GMail account from " + window.gmail.home);
+                feedback(msg, "Please click any images you'd like removed from your GMail account, or delete them from " + (msg.path || window.gmail.home));
                 hide_progress();
+                load_gallery(0);
+                $gallery.fadeIn();
                 $sync_form.fadeIn();
                 break;
 
+            case "marked":
+                if (!num_selected) {
+                    $marked.text(msg.msg);
+                }
+                break;
+
             case "file-checking":
                 feedback(msg);
                 update_progress();
+                $gallery.fadeOut();
                 $sync_form.fadeOut();
                 break;
 
@@ -183,6 +318,13 @@ jQuery(function ($) {
                 feedback(msg);
                 hide_progress();
                 break;
+
+            case "error":
+                feedback(msg);
+                hide_progress();
+                break;
         }
     };
+
+    open_socket();
 });
@@ -0,0 +1,605 @@
+"""A small IMAP server that imitates the parts of Gmail's IMAP interface
+used by the gmail image extractor (the X-GM-RAW, X-GM-MSGID and X-GM-LABELS
+extensions, special-use mailboxes, APPEND and the Trash), for benchmarking
+without a real account.  It keeps everything in memory and only understands
+the commands the extractor sends.
+"""
+
+import email
+import email.utils
+import re
+import socket
+import SocketServer
+import threading
+import time
+
+ALL_MAIL = "[Gmail]/All Mail"
+TRASH = "[Gmail]/Trash"
+
+LITERAL_RE = re.compile(r"\{(\d+)\+?\}$")
+
+
+class Message(object):
+
+    def __init__(self, uid, gm_id, raw, labels=(), internaldate=None):
+        self.uid = uid
+        self.gm_id = gm_id
+        self.raw = raw
+        self.labels = set(labels)
+        self.flags = set()
+        self.internaldate = internaldate or time.time()
+        self._parsed = None
+
+    @property
+    def parsed(self):
+        if self._parsed is None:
+            self._parsed = email.message_from_string(self.raw)
+        return self._parsed
+
+
+class Mailbox(object):
+    """The state of a fake Gmail account: the messages in All Mail and in
+    the Trash.
+    """
+
+    def __init__(self, email_address, password):
+        self.email = email_address
+        self.password = password
+        self.lock = threading.Lock()
+        self.folders = {ALL_MAIL: [], TRASH: []}
+        self.next_uid = {ALL_MAIL: 1, TRASH: 1}
+        self.next_gm_id = 1000000000000000000
+        self.uidvalidity = {ALL_MAIL: 11, TRASH: 12}
+        # Counters reported by benchmarks
+        self.commands = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def add(self, raw, labels=(), internaldate=None, folder=ALL_MAIL, gm_id=None):
+        with self.lock:
+            uid = self.next_uid[folder]
+            self.next_uid[folder] += 1
+            if gm_id is None:
+                gm_id = self.next_gm_id
+                self.next_gm_id += 1
+            msg = Message(uid, gm_id, raw, labels, internaldate)
+            self.folders[folder].append(msg)
+            return msg
+
+
+def quote(value):
+    return '"{0}"'.format(value.replace("\\", "\\\\").replace('"', '\\"'))
+
+
+def nstring(value):
+    if value is None:
+        return "NIL"
+    return quote(value)
+
+
+def literal(value):
+    return "{%d}\r\n%s" % (len(value), value)
+
+
+# -- Gmail search (X-GM-RAW) ----------------------------------------------
+
+def _size(value):
+    value = value.lower()
+    mult = 1
+    if value.endswith("k"):
+        mult, value = 1024, value[:-1]
+    elif value.endswith("m"):
+        mult, value = 1024 * 1024, value[:-1]
+    return int(value) * mult
+
+
+def _date(value):
+    if value.isdigit():
+        return int(value)
+    return time.mktime(time.strptime(value.replace("-", "/"), "%Y/%m/%d"))
+
+
+def _attachment_names(msg):
+    names = []
+    for part in msg.parsed.walk():
+        if part.is_multipart():
+            continue
+        name = part.get_filename()
+        if name:
+            names.append(name)
+    return names
+
+
+def _match_term(term, msg):
+    negate = term.startswith("-")
+    if negate:
+        term = term[1:]
+    if ":" in term:
+        key, value = term.split(":", 1)
+    else:
+        key, value = "", term
+    key = key.lower()
+    value = value.strip('"')
+    if key == "has" and value == "attachment":
+        result = bool(_attachment_names(msg))
+    elif key == "filename":
+        value = value.lower()
+        result = any(n.lower() == value or n.lower().endswith("." + value)
+                     for n in _attachment_names(msg))
+    elif key == "larger":
+        result = len(msg.raw) > _size(value)
+    elif key == "smaller":
+        result = len(msg.raw) < _size(value)
+    elif key in ("after", "newer"):
+        result = msg.internaldate > _date(value)
+    elif key in ("before", "older"):
+        result = msg.internaldate < _date(value)
+    elif key == "label":
+        result = value.lower() in set(l.lower().strip('"') for l in msg.labels)
+    elif key == "in" and value == "anywhere":
+        result = True
+    else:
+        result = value.lower() in msg.raw.lower()
+    return not result if negate else result
+
+
+def _search_tokens(query):
+    return re.findall(r'-?\w+:"[^"]*"|-?[^\s(){}]+|[(){}]', query)
+
+
+def _match(tokens, msg):
+    """Evaluates a list of search tokens, with implicit AND between terms,
+    OR between adjacent terms, and grouping with parentheses or braces.
+    """
+    pos = [0]
+
+    def parse_or():
+        value = parse_term()
+        while pos[0] < len(tokens) and tokens[pos[0]].upper() == "OR":
+            pos[0] += 1
+            value = parse_term() or value
+        return value
+
+    def parse_term():
+        token = tokens[pos[0]]
+        pos[0] += 1
+        if token in ("(", "{"):
+            closing = ")" if token == "(" else "}"
+            values = []
+            while tokens[pos[0]] != closing:
+                values.append(parse_or())
+            pos[0] += 1
+            return all(values) if token == "(" else any(values)
+        return _match_term(token, msg)
+
+    results = []
+    while pos[0] < len(tokens):
+        results.append(parse_or())
+    return all(results)
+
+
+def gmail_search(query, messages):
+    tokens = _search_tokens(query)
+    return [m for m in messages if _match(tokens, m)]
+
+
+# -- BODYSTRUCTURE ---------------------------------------------------------
+
+def _param_list(params):
+    if not params:
+        return "NIL"
+    return "(" + " ".join("{0} {1}".format(quote(k), quote(v)) for k, v in params) + ")"
+
+
+def bodystructure(part):
+    if part.is_multipart():
+        children = "".join(bodystructure(p) for p in part.get_payload())
+        return "({0} {1} {2} NIL NIL NIL)".format(
+            children, quote(part.get_content_subtype()),
+            _param_list([("boundary", part.get_boundary())]))
+    maintype = part.get_content_maintype()
+    subtype = part.get_content_subtype()
+    params = [(k, v) for k, v in part.get_params()[1:]] if part.get_params() else []
+    payload = part.get_payload()
+    encoding = part.get("Content-Transfer-Encoding", "7bit")
+    disposition = "NIL"
+    if part.get("Content-Disposition"):
+        disp = part.get("Content-Disposition").split(";")[0].strip()
+        disp_params = part.get_params(header="content-disposition")[1:]
+        disposition = "({0} {1})".format(quote(disp), _param_list(disp_params))
+    fields = "{0} {1} {2} NIL NIL {3} {4}".format(
+        quote(maintype), quote(subtype), _param_list(params), quote(encoding), len(payload))
+    if maintype == "text":
+        fields += " {0} NIL {1} NIL NIL".format(payload.count("\n"), disposition)
+    else:
+        fields += " NIL {0} NIL NIL".format(disposition)
+    return "(" + fields + ")"
+
+
+def get_section(msg, section):
+    part = msg.parsed
+    if section == "":
+        return msg.raw
+    if section.upper() == "TEXT":
+        return msg.raw.split("\r\n\r\n", 1)[-1] if "\r\n\r\n" in msg.raw else msg.raw.split("\n\n", 1)[-1]
+    for index in section.split("."):
+        index = int(index)
+        if part.is_multipart():
+            part = part.get_payload()[index - 1]
+        elif index != 1:
+            return ""
+    payload = part.get_payload()
+    return payload if isinstance(payload, str) else part.as_string()
+
+
+def header_fields(msg, names):
+    lines = []
+    for name in names:
+        value = msg.parsed.get(name)
+        if value is not None:
+            lines.append("{0}: {1}".format(name, value))
+    return "\r\n".join(lines) + "\r\n\r\n"
+
+
+# -- Protocol ---------------------------------------------------------------
+
+FETCH_ITEM_RE = re.compile(r'(BODY(?:\.PEEK)?\[[^\]]*\](?:<\d+\.\d+>)?|[A-Z0-9.\-]+)', re.I)
+
+
+def _parse_uid_set(value, messages):
+    max_uid = messages[-1].uid if messages else 0
+    uids = set()
+    for piece in value.split(","):
+        if ":" in piece:
+            a, b = piece.split(":")
+            a = max_uid if a == "*" else int(a)
+            b = max_uid if b == "*" else int(b)
+            if a > b:
+                a, b = b, a
+            uids.update(range(a, b + 1))
+        else:
+            uids.add(max_uid if piece == "*" else int(piece))
+    return uids
+
+
+def _split_args(line):
+    """Splits a command line into arguments, honouring quoted strings and
+    parenthesized lists.
+    """
+    args = []
+    i = 0
+    while i < len(line):
+        c = line[i]
+        if c == " ":
+            i += 1
+        elif c == '"':
+            j = i + 1
+            chars = []
+            while line[j] != '"':
+                if line[j] == "\\":
+                    j += 1
+                chars.append(line[j])
+                j += 1
+            args.append("".join(chars))
+            i = j + 1
+        elif c == "(":
+            depth = 0
+            j = i
+            while True:
+                if line[j] == "(":
+                    depth += 1
+                elif line[j] == ")":
+                    depth -= 1
+                    if depth == 0:
+                        break
+                elif line[j] == "[":
+                    j = line.index("]", j)
+                j += 1
+            args.append(line[i:j + 1])
+            i = j + 1
+        else:
+            j = i
+            while j < len(line) and line[j] != " ":
+                if line[j] == "[":
+                    j = line.index("]", j)
+                j += 1
+            args.append(line[i:j])
+            i = j
+    return args
+
+
+def _eval_one(pieces, msg, messages):
+    key = pieces.pop(0).upper()
+    if key == "OR":
+        a = _eval_one(pieces, msg, messages)
+        b = _eval_one(pieces, msg, messages)
+        return a or b
+    elif key == "NOT":
+        return not _eval_one(pieces, msg, messages)
+    elif key == "X-GM-MSGID":
+        return str(msg.gm_id) == pieces.pop(0)
+    elif key == "X-GM-RAW":
+        return _match(_search_tokens(pieces.pop(0)), msg)
+    elif key == "HEADER":
+        name, value = pieces.pop(0), pieces.pop(0).lower()
+        return any(value in field.lower() for field in msg.parsed.get_all(name, []))
+    elif key == "UID":
+        return msg.uid in _parse_uid_set(pieces.pop(0), messages)
+    elif key == "ALL":
+        return True
+    raise ValueError("Unsupported search key " + key)
+
+
+def _eval_criteria(pieces, msg, messages):
+    while pieces:
+        if not _eval_one(pieces, msg, messages):
+            return False
+    return True
+
+
+class Handler(SocketServer.StreamRequestHandler):
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.account = None
+        self.selected = None
+
+    def send(self, data):
+        account = self.server.account
+        with account.lock:
+            account.bytes_sent += len(data)
+        self.wfile.write(data)
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        received = len(line)
+        line = line.rstrip("\r\n")
+        # Commands may contain literals, which need to be read off of the
+        # socket before the rest of the command
+        parts = []
+        while True:
+            match = LITERAL_RE.search(line)
+            if not match:
+                parts.append(line)
+                break
+            size = int(match.group(1))
+            if not match.group(0).endswith("+}"):
+                self.send("+ go ahead\r\n")
+            data = self.rfile.read(size)
+            parts.append((line[:match.start()], data))
+            line = self.rfile.readline()
+            received += size + len(line)
+            line = line.rstrip("\r\n")
+        account = self.server.account
+        with account.lock:
+            account.bytes_received += received
+        return parts
+
+    def handle(self):
+        self.send("* OK Fake Gmail IMAP ready\r\n")
+        while True:
+            parts = self.read_command()
+            if parts is None:
+                return
+            first = parts[0] if isinstance(parts[0], str) else parts[0][0]
+            pieces = first.split(" ", 2)
+            if len(pieces) < 2:
+                continue
+            tag, command = pieces[0], pieces[1].upper()
+            rest = pieces[2] if len(pieces) > 2 else ""
+            with self.server.account.lock:
+                self.server.account.commands += 1
+                count = self.server.account.commands
+            delay = self.server.latency
+            if delay:
+                time.sleep(delay)
+            # Misbehave like Gmail does under load, but only once logged in,
+            # and only for commands that work on messages
+            if command in ("UID", "APPEND"):
+                if self.server.drop_every and count % self.server.drop_every == 0:
+                    return
+                if self.server.throttle_every and count % self.server.throttle_every == 0:
+                    self.send("{0} NO [THROTTLED] Too many commands, slow down\r\n".format(tag))
+                    continue
+            try:
+                if not self.dispatch(tag, command, rest, parts):
+                    return
+            except socket.error:
+                return
+            except Exception as e:
+                self.send("{0} BAD {1}\r\n".format(tag, e))
+
+    def dispatch(self, tag, command, rest, parts):
+        mailbox = self.server.account
+        if command == "CAPABILITY":
+            self.send("* CAPABILITY IMAP4rev1 UIDPLUS X-GM-EXT-1 SPECIAL-USE LITERAL+\r\n")
+            self.send("{0} OK CAPABILITY completed\r\n".format(tag))
+        elif command == "LOGIN":
+            user, password = _split_args(rest)[:2]
+            if user == mailbox.email and password == mailbox.password:
+                self.account = mailbox
+                self.send("{0} OK {1} authenticated\r\n".format(tag, user))
+            else:
+                self.send("{0} NO [AUTHENTICATIONFAILED] Invalid credentials\r\n".format(tag))
+        elif command == "LOGOUT":
+            self.send("* BYE LOGOUT Requested\r\n{0} OK 73 good day\r\n".format(tag))
+            return False
+        elif command == "NOOP":
+            self.send("{0} OK NOOP completed\r\n".format(tag))
+        elif self.account is None:
+            self.send("{0} NO Not authenticated\r\n".format(tag))
+        elif command == "LIST":
+            self.send('* LIST (\\HasChildren \\Noselect) "/" "[Gmail]"\r\n')
+            self.send('* LIST (\\HasNoChildren \\All) "/" "{0}"\r\n'.format(ALL_MAIL))
+            self.send('* LIST (\\HasNoChildren \\Trash) "/" "{0}"\r\n'.format(TRASH))
+            self.send("{0} OK LIST completed\r\n".format(tag))
+        elif command in ("SELECT", "EXAMINE"):
+            name = _split_args(rest)[0]
+            if name not in mailbox.folders:
+                self.send("{0} NO Unknown mailbox\r\n".format(tag))
+            else:
+                self.selected = name
+                messages = mailbox.folders[name]
+                self.send("* FLAGS (\\Answered \\Flagged \\Draft \\Deleted \\Seen)\r\n")
+                self.send("* OK [UIDVALIDITY {0}] UIDs valid.\r\n".format(mailbox.uidvalidity[name]))
+                self.send("* {0} EXISTS\r\n* 0 RECENT\r\n".format(len(messages)))
+                self.send("* OK [UIDNEXT {0}] Predicted next UID.\r\n".format(mailbox.next_uid[name]))
+                self.send("{0} OK [{1}] {2} selected.\r\n".format(
+                    tag, "READ-ONLY" if command == "EXAMINE" else "READ-WRITE", name))
+        elif command == "APPEND":
+            self.append(tag, rest, parts)
+        elif command == "UID":
+            sub, _, args = rest.partition(" ")
+            self.uid_command(tag, sub.upper(), args, parts)
+        else:
+            self.send("{0} BAD Unknown command {1}\r\n".format(tag, command))
+        return True
+
+    def append(self, tag, rest, parts):
+        mailbox = self.server.account
+        prefix, raw = parts[0]
+        # Skip the tag and command to get to the mailbox name
+        name = _split_args(prefix.split(" ", 2)[2])[0]
+        if name not in mailbox.folders:
+            self.send("{0} NO [TRYCREATE] Unknown mailbox\r\n".format(tag))
+            return
+        msg = mailbox.add(raw, folder=name)
+        self.send("{0} OK [APPENDUID {1} {2}] (Success)\r\n".format(
+            tag, mailbox.uidvalidity[name], msg.uid))
+
+    def uid_command(self, tag, sub, args, parts):
+        mailbox = self.server.account
+        messages = mailbox.folders.get(self.selected, [])
+        if sub == "SEARCH":
+            if isinstance(parts[0], tuple):
+                # X-GM-RAW query sent as a literal
+                pieces = _split_args(parts[0][0].split(" ", 3)[3]) + [parts[0][1]]
+            else:
+                pieces = _split_args(args)
+            if pieces and pieces[0].upper() == "CHARSET":
+                pieces = pieces[2:]
+            found = [m for m in messages if _eval_criteria(list(pieces), m, messages)]
+            self.send("* SEARCH {0}\r\n".format(" ".join(str(m.uid) for m in found)))
+            self.send("{0} OK SEARCH completed (Success)\r\n".format(tag))
+        elif sub == "FETCH":
+            uid_value, items = args.split(" ", 1)
+            uids = _parse_uid_set(uid_value, messages)
+            items = items.strip()
+            if items.startswith("("):
+                items = items[1:-1]
+            requested = FETCH_ITEM_RE.findall(items)
+            for seq, msg in enumerate(messages, 1):
+                if msg.uid in uids:
+                    self.send_fetch(seq, msg, requested)
+            self.send("{0} OK Success\r\n".format(tag))
+        elif sub == "STORE":
+            uid_value, item, value = args.split(" ", 2)
+            uids = _parse_uid_set(uid_value, messages)
+            values = _split_args(value[1:-1]) if value.startswith("(") else [value]
+            for msg in messages:
+                if msg.uid not in uids:
+                    continue
+                target = msg.labels if "LABELS" in item.upper() else msg.flags
+                if item.startswith("+"):
+                    target.update(values)
+                elif item.startswith("-"):
+                    target.difference_update(values)
+                else:
+                    target.clear()
+                    target.update(values)
+            if any(v == "\\Trash" for v in values) and item.startswith("+") and "LABELS" in item.upper():
+                self._move(uids, TRASH)
+            self.send("{0} OK Success\r\n".format(tag))
+        elif sub in ("COPY", "MOVE"):
+            uid_value, name = args.split(" ", 1)
+            name = _split_args(name)[0]
+            uids = _parse_uid_set(uid_value, messages)
+            if name == TRASH:
+                self._move(uids, TRASH)
+            else:
+                for msg in messages:
+                    if msg.uid in uids:
+                        msg.labels.add(name)
+            self.send("{0} OK Success\r\n".format(tag))
+        else:
+            self.send("{0} BAD Unknown UID command\r\n".format(tag))
+
+    def _move(self, uids, folder):
+        mailbox = self.server.account
+        with mailbox.lock:
+            moving = [m for m in mailbox.folders[self.selected] if m.uid in uids]
+            mailbox.folders[self.selected] = [m for m in mailbox.folders[self.selected]
+                                              if m.uid not in uids]
+        for msg in moving:
+            mailbox.add(msg.raw, msg.labels, msg.internaldate, folder=folder, gm_id=msg.gm_id)
+
+    def send_fetch(self, seq, msg, requested):
+        out = ["UID {0}".format(msg.uid)]
+        for item in requested:
+            upper = item.upper()
+            if upper == "UID":
+                continue
+            elif upper == "X-GM-MSGID":
+                out.append("X-GM-MSGID {0}".format(msg.gm_id))
+            elif upper == "X-GM-THRID":
+                out.append("X-GM-THRID {0}".format(msg.gm_id))
+            elif upper == "X-GM-LABELS":
+                out.append("X-GM-LABELS ({0})".format(" ".join(quote(l) for l in sorted(msg.labels))))
+            elif upper == "FLAGS":
+                out.append("FLAGS ({0})".format(" ".join(sorted(msg.flags))))
+            elif upper == "RFC822.SIZE":
+                out.append("RFC822.SIZE {0}".format(len(msg.raw)))
+            elif upper == "INTERNALDATE":
+                out.append("INTERNALDATE {0}".format(quote(time.strftime(
+                    "%d-%b-%Y %H:%M:%S +0000", time.gmtime(msg.internaldate)))))
+            elif upper == "BODYSTRUCTURE":
+                out.append("BODYSTRUCTURE " + bodystructure(msg.parsed))
+            elif upper in ("RFC822", "BODY[]", "BODY.PEEK[]"):
+                name = "RFC822" if upper == "RFC822" else "BODY[]"
+                out.append("{0} {1}".format(name, literal(msg.raw)))
+            elif upper.startswith("BODY"):
+                section = item[item.index("[") + 1:item.index("]")]
+                partial = re.search(r"<(\d+)\.(\d+)>$", item)
+                if section.upper().startswith("HEADER.FIELDS"):
+                    names = section[section.index("(") + 1:section.index(")")].split()
+                    data = header_fields(msg, names)
+                else:
+                    data = get_section(msg, section)
+                name = "BODY[{0}]".format(section)
+                if partial:
+                    start, length = int(partial.group(1)), int(partial.group(2))
+                    data = data[start:start + length]
+                    name += "<{0}>".format(start)
+                out.append("{0} {1}".format(name, literal(data)))
+        self.send("* {0} FETCH ({1})\r\n".format(seq, " ".join(out)))
+
+
+class FakeGmailServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """A threaded fake Gmail IMAP server serving a single account."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, account, address=("127.0.0.1", 0), latency=0,
+                 drop_every=0, throttle_every=0):
+        SocketServer.TCPServer.__init__(self, address, Handler)
+        self.account = account
+        # Seconds to wait before answering each command, to imitate the
+        # round trip time to Gmail
+        self.latency = latency
+        # If set, every nth command that works on messages drops the
+        # connection, or is refused as throttled, instead of being answered
+        self.drop_every = drop_every
+        self.throttle_every = throttle_every
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -0,0 +1,102 @@
+"""Generates synthetic mailboxes for the benchmarks, with a configurable mix
+of messages with image attachments, other attachments, or both.
+"""
+
+import os
+import random
+import time
+from email.mime.application import MIMEApplication
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+
+class MailSpec(object):
+    """Describes the messages to generate."""
+
+    def __init__(self, messages=500, image_ratio=0.5, max_images=3, other_ratio=0.3,
+                 image_size=200000, other_size=100000, shared_ratio=0.2, seed=1):
+        """
+        Keyword Args:
+            messages     -- the number of messages to generate, every one of
+                            which has at least one attachment
+            image_ratio  -- the share of messages with images attached
+            max_images   -- the most images attached to a single message
+            other_ratio  -- the share of messages with images that also have
+                            a non-image attachment (messages without images
+                            always have one)
+            image_size   -- the average size, in bytes, of each image
+            other_size   -- the average size, in bytes, of each non-image
+                            attachment
+            shared_ratio -- the share of images that are copies of images
+                            attached to other messages, as with photos that
+                            are forwarded around
+            seed         -- seeds the choices made, so the same spec always
+                            gives a mailbox of the same shape
+        """
+        self.messages = messages
+        self.image_ratio = image_ratio
+        self.max_images = max_images
+        self.other_ratio = other_ratio
+        self.image_size = image_size
+        self.other_size = other_size
+        self.shared_ratio = shared_ratio
+        self.seed = seed
+
+
+def _size(rnd, average):
+    return max(1, int(rnd.uniform(0.5, 1.5) * average))
+
+
+def make_message(index, images, others):
+    """Returns the full text, with CRLF line endings, of a message with the
+    given attachments.
+
+    Args:
+        index  -- the number of the message, used in its subject
+        images -- a list of the contents of each image to attach
+        others -- a list of the contents of each non-image attachment
+    """
+    msg = MIMEMultipart()
+    msg["Subject"] = "Message {0}".format(index)
+    msg["From"] = "sender@example.com"
+    msg["To"] = "receiver@example.com"
+    msg.attach(MIMEText("Message number {0}".format(index)))
+    for i, data in enumerate(images):
+        part = MIMEImage(data, "jpeg")
+        part.add_header("Content-Disposition", "attachment", filename="photo{0}.jpg".format(i))
+        msg.attach(part)
+    for i, data in enumerate(others):
+        part = MIMEApplication(data, "pdf")
+        part.add_header("Content-Disposition", "attachment", filename="document{0}.pdf".format(i))
+        msg.attach(part)
+    return msg.as_string().replace("\r\n", "\n").replace("\n", "\r\n")
+
+
+def populate(mailbox, spec):
+    """Adds the messages described by a MailSpec to a fakeimap.Mailbox.
+
+    Returns:
+        The total size, in bytes, of the messages added.
+    """
+    rnd = random.Random(spec.seed)
+    shared = []
+    total = 0
+    start = time.time() - spec.messages * 60
+    for index in range(spec.messages):
+        images = []
+        if rnd.random() < spec.image_ratio:
+            for i in range(rnd.randint(1, spec.max_images)):
+                if shared and rnd.random() < spec.shared_ratio:
+                    images.append(rnd.choice(shared))
+                else:
+                    data = os.urandom(_size(rnd, spec.image_size))
+                    shared.append(data)
+                    images.append(data)
+        others = []
+        if not images or rnd.random() < spec.other_ratio:
+            others.append(os.urandom(_size(rnd, spec.other_size)))
+        raw = make_message(index, images, others)
+        mailbox.add(raw, labels=["\\Inbox"], internaldate=start + index * 60)
+        total += len(raw)
+    return total
@@ -0,0 +1,186 @@
+"""Benchmarks GmailImageExtractor against a local stand-in for Gmail's IMAP
+server, reporting for each of extract(), check_deletions() and sync() how
+long it took, how many items it handled a second, how much data went over
+the wire, the number of IMAP round trips and the peak memory use.
+
+Run from the root of the repository, ex:
+
+    python -m bench.run --messages 1000 --latency 0.02 --connections 4
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from gmailextract.extractor import GmailImageExtractor
+from . import fakeimap
+from . import mailgen
+
+EMAIL = "bench@example.com"
+PASSWORD = "bench"
+
+
+def _serve(pipe, spec, latency, drop_every, throttle_every):
+    """Runs the fake server in a process of its own, so that the mailbox it
+    holds doesn't count towards the memory used by the extractor.  Answers
+    requests for the server's counters over `pipe`, until told to stop.
+    """
+    mailbox = fakeimap.Mailbox(EMAIL, PASSWORD)
+    total = mailgen.populate(mailbox, spec)
+    server = fakeimap.FakeGmailServer(mailbox, latency=latency, drop_every=drop_every,
+                                      throttle_every=throttle_every)
+    server.start()
+    pipe.send((server.port, total))
+    while pipe.recv() != "stop":
+        with mailbox.lock:
+            pipe.send((mailbox.commands, mailbox.bytes_sent + mailbox.bytes_received))
+    server.shutdown()
+
+
+def _peak_rss():
+    """Returns the most memory, in bytes, this process has used so far."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Bench(object):
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.results = []
+
+    def counters(self):
+        self.pipe.send("counters")
+        return self.pipe.recv()
+
+    def measure(self, name, func):
+        """Calls func(), which returns the number of items it handled, and
+        records how it went.
+        """
+        commands, wire_bytes = self.counters()
+        start = time.time()
+        items = func()
+        elapsed = time.time() - start
+        end_commands, end_bytes = self.counters()
+        result = {"phase": name,
+                  "seconds": elapsed,
+                  "items": items,
+                  "items_per_sec": items / elapsed if elapsed else 0.0,
+                  "mb_per_sec": (end_bytes - wire_bytes) / 1048576.0 / elapsed if elapsed else 0.0,
+                  "round_trips": end_commands - commands,
+                  "peak_rss_mb": _peak_rss() / 1048576.0}
+        self.results.append(result)
+        return result
+
+
+def _print_results(results):
+    row = "{0:<16} {1:>9} {2:>8} {3:>10} {4:>8} {5:>11} {6:>13}"
+    print row.format("phase", "seconds", "items", "items/sec", "MB/sec",
+                     "round trips", "peak RSS (MB)")
+    for r in results:
+        print row.format(r["phase"], "{0:.2f}".format(r["seconds"]), r["items"],
+                         "{0:.1f}".format(r["items_per_sec"]),
+                         "{0:.2f}".format(r["mb_per_sec"]), r["round_trips"],
+                         "{0:.1f}".format(r["peak_rss_mb"]))
+    print
+    print "items are messages for extract and sync, and images for check_deletions."
+    print "MB/sec counts data sent to and from the server; peak RSS is for the"
+    print "extractor's process, as of the end of each phase."
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Gmail image extractor against a local fake IMAP server.")
+    parser.add_argument('--messages', type=int, default=500, help="Number of messages with attachments in the mailbox.")
+    parser.add_argument('--image-ratio', type=float, default=0.5, help="Share of messages with images attached.")
+    parser.add_argument('--max-images', type=int, default=3, help="Most images attached to one message.")
+    parser.add_argument('--other-ratio', type=float, default=0.3, help="Share of messages with images that also have another attachment.")
+    parser.add_argument('--image-size', type=int, default=200, help="Average image size, in KB.")
+    parser.add_argument('--other-size', type=int, default=100, help="Average size of other attachments, in KB.")
+    parser.add_argument('--shared-ratio', type=float, default=0.2, help="Share of images that are copies of other images.")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds the server waits before answering each command.")
+    parser.add_argument('--drop-every', type=int, default=0, help="Drop the connection instead of answering every nth command.")
+    parser.add_argument('--throttle-every', type=int, default=0, help="Refuse every nth command as throttled.")
+    parser.add_argument('--connections', type=int, default=1, help="Connections the extractor opens to the server.")
+    parser.add_argument('--batch', type=int, default=10, help="Messages fetched at a time.")
+    parser.add_argument('--dedupe', action="store_true", help="Hard link duplicate images.")
+    parser.add_argument('--replace', action="store_true", help="Replace messages in place when syncing.")
+    parser.add_argument('--delete', type=float, default=0.2, help="Share of the extracted images to delete before syncing.")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--stats', action="store_true", help="Also print the extractor's own counters and timers.")
+    parser.add_argument('--json', action="store_true", help="Print the results as JSON.")
+    args = parser.parse_args()
+
+    spec = mailgen.MailSpec(messages=args.messages, image_ratio=args.image_ratio,
+                            max_images=args.max_images, other_ratio=args.other_ratio,
+                            image_size=args.image_size * 1024, other_size=args.other_size * 1024,
+                            shared_ratio=args.shared_ratio, seed=args.seed)
+    pipe, child_pipe = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=_serve, args=(child_pipe, spec, args.latency,
+                                                             args.drop_every, args.throttle_every))
+    server.daemon = True
+    server.start()
+    port, mailbox_bytes = pipe.recv()
+
+    dest = tempfile.mkdtemp(prefix="gmail-image-bench-")
+    bench = Bench(pipe)
+    try:
+        extractor = GmailImageExtractor(dest, EMAIL, PASSWORD, batch=args.batch,
+                                        replace=args.replace, connections=args.connections,
+                                        dedupe=args.dedupe,
+                                        server=("127.0.0.1", port, False))
+        if not extractor.connect():
+            print "Unable to connect to the fake IMAP server"
+            return 1
+
+        def _extract():
+            num_messages = extractor.num_messages_with_attachments()
+            extractor.extract()
+            return num_messages
+        bench.measure("extract", _extract)
+
+        rnd = random.Random(args.seed)
+        names = sorted(extractor.mapping)
+        for name in rnd.sample(names, int(len(names) * args.delete)):
+            if os.path.exists(os.path.join(dest, name)):
+                os.remove(os.path.join(dest, name))
+
+        def _check_deletions():
+            extractor.check_deletions()
+            return len(extractor.mapping)
+        bench.measure("check_deletions", _check_deletions)
+
+        def _sync():
+            num_attch_removed, num_msg_changed = extractor.sync()
+            return num_msg_changed
+        bench.measure("sync", _sync)
+        extractor.close()
+        metrics = extractor.metrics
+    finally:
+        shutil.rmtree(dest, True)
+        pipe.send("stop")
+        server.join()
+
+    if args.json:
+        print json.dumps({"mailbox_mb": mailbox_bytes / 1048576.0,
+                          "options": vars(args),
+                          "results": bench.results,
+                          "metrics": metrics.snapshot()}, indent=2)
+    else:
+        print "Mailbox of {0} messages, {1:.1f} MB".format(args.messages, mailbox_bytes / 1048576.0)
+        print
+        _print_results(bench.results)
+        if args.stats:
+            print
+            print metrics.summary()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
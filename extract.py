@@ -1,6 +1,9 @@
 import sys
+import json
 import argparse
+from gmailextract import batch
 from gmailextract.extractor import GmailImageExtractor
+from gmailextract.search import SearchFilter
 
 parser = argparse.ArgumentParser(description='Extract images from a gmail account.')
 parser.add_argument('-e', '--email', type=str, default="",
@@ -13,13 +16,80 @@ parser.add_argument('-l', '--limit', type=int, default=0,
                     help="The total number of messages that should be downloaded from GMail. Default is 0, or all.")
 parser.add_argument('-s', '--simultaneous', type=int, default=10,
                     help="The maximum number of messages that should be downloaded from GMail at a time (defaults to 10).")
+parser.add_argument('-c', '--connections', type=int, default=1,
+                    help="The number of connections to open to GMail, to download messages in parallel (defaults to 1).")
+parser.add_argument('-m', '--chunk-size', type=int, default=1024,
+                    help="The maximum number of kilobytes of image data to download at a time on each connection (defaults to 1024).")
+parser.add_argument('-u', '--dedupe', action='store_true',
+                    help="Only write each distinct image to disk once, hard linking any other copies of it. Deleting any copy removes all of them from GMail.")
 parser.add_argument('-w', '--write', action='store_true',
                     help="Edit messages in place instead of saving altered versions with the label 'Images redacted'")
+parser.add_argument('-a', '--all-attachments', action='store_true',
+                    help="Consider every message with an attachment, not just those with an attachment named like an image. Slower, but finds images attached without a .jpg, .png or .gif name.")
+parser.add_argument('--larger', type=str, default=None,
+                    help="Only consider messages larger than this, ex 500K or 2M.")
+parser.add_argument('--smaller', type=str, default=None,
+                    help="Only consider messages smaller than this, ex 500K or 2M.")
+parser.add_argument('--after', type=str, default=None,
+                    help="Only consider messages received after this date, as YYYY/MM/DD.")
+parser.add_argument('--before', type=str, default=None,
+                    help="Only consider messages received before this date, as YYYY/MM/DD.")
+parser.add_argument('--label', type=str, action='append', default=[],
+                    help="Only consider messages with this label. Can be given more than once.")
+parser.add_argument('-q', '--query', type=str, default=None,
+                    help="Any other Gmail search terms messages must match, as typed into Gmail's search box.")
+parser.add_argument('--stats', action='store_true',
+                    help="Print a summary of the IMAP commands sent, the time spent in each step and the bytes moved, after extracting and again after syncing.")
+parser.add_argument('--batch', type=str, default=None, metavar="FILE",
+                    help="Work through every account in FILE, one JSON object per line, without stopping to ask before syncing. Other options give the defaults for each account; see gmailextract/batch.py for the format and for rules to delete images by.")
+parser.add_argument('--processes', type=int, default=4,
+                    help="With --batch, the number of accounts to work on at once (defaults to 4).")
+parser.add_argument('--max-connections', type=int, default=0,
+                    help="With --batch, the most connections to have open to GMail at once across all accounts. Default is 0, or no limit.")
+parser.add_argument('--max-bandwidth', type=int, default=0,
+                    help="With --batch, the most kilobytes a second to download and upload across all accounts. Default is 0, or no limit.")
+parser.add_argument('--summary', type=str, default=None, metavar="FILE",
+                    help="With --batch, write the result of each account to FILE, one JSON object per line.")
 args = parser.parse_args()
 
+if args.batch:
+    defaults = dict((key, getattr(args, key)) for key in batch.DEFAULTS if hasattr(args, key))
+    try:
+        accounts = batch.load_accounts(args.batch, defaults)
+    except (IOError, ValueError) as e:
+        print "Error: Unable to read accounts from {0}: {1}".format(args.batch, e)
+        sys.exit(1)
+
+    print "Processing {0} accounts".format(len(accounts))
+    summary = open(args.summary, "a") if args.summary else None
+    failures = 0
+    for result in batch.run(accounts, processes=args.processes,
+                            max_connections=args.max_connections,
+                            max_bandwidth=args.max_bandwidth * 1024):
+        if result["ok"]:
+            print u"{0}: {1} images from {2} messages, {3} deleted, {4} removed from {5} messages ({6:.1f}s)".format(
+                result["email"], result["images"], result["messages"], result["deleted"],
+                result["attachments_removed"], result["messages_changed"], result["seconds"])
+        else:
+            failures += 1
+            print u"{0}: Error: {1}".format(result["email"], result["error"])
+        if summary:
+            summary.write(json.dumps(result) + "\n")
+            summary.flush()
+    if summary:
+        summary.close()
+    print "Finished, with {0} of {1} accounts failing".format(failures, len(accounts))
+    sys.exit(1 if failures else 0)
+
 extractor = GmailImageExtractor(args.dest, args.email, args.password,
                                 limit=args.limit, batch=args.simultaneous,
-                                replace=args.write)
+                                replace=args.write, connections=args.connections,
+                                chunk_size=args.chunk_size * 1024,
+                                dedupe=args.dedupe,
+                                search=SearchFilter(images_only=not args.all_attachments,
+                                                    larger=args.larger, smaller=args.smaller,
+                                                    after=args.after, before=args.before,
+                                                    labels=args.label, raw=args.query))
 
 # Next, see if we can succesfully connect to and select a mailbox from
 # Gmail. If not, error out quick
@@ -38,6 +108,14 @@ def _status(*status_args):
 
 attachment_count = extractor.extract(_status)
 print "Succesfully stored {0} attachments to disk".format(attachment_count)
+print "Downloaded {0:.1f} MB from {1:.1f} MB of messages".format(extractor.bytes_fetched / 1048576.0,
+                                                             extractor.message_bytes / 1048576.0)
+if args.dedupe:
+    print "{0} of those were copies of images already on disk ({1:.0%})".format(extractor.store.hits,
+                                                                            extractor.store.hit_rate())
+if args.stats:
+    print ""
+    print extractor.metrics.summary()
 
 print "\n\nDelete any images you would like to have removed from your Gmail account."
 raw_input("Press any key to continue.")
@@ -57,3 +135,6 @@ def _sync_status(*args):
 
 num_attch_removed, num_msg_changed = extractor.sync(callback=_sync_status)
 print "Removed {0} images from {1} messages".format(num_attch_removed, num_msg_changed)
+if args.stats:
+    print ""
+    print extractor.metrics.summary()
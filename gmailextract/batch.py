@@ -0,0 +1,311 @@
+"""Runs the extractor over many Gmail accounts without anyone at the
+keyboard, with the accounts worked on in parallel by a pool of processes
+that share a limit on the connections open to Gmail and the bandwidth
+used between them.
+
+Accounts are read from a file with one JSON object per line, each giving
+at least the "email" and "password" of an account, and optionally any of
+the keys in DEFAULTS, ex:
+
+    {"email": "a@example.com", "password": "...", "delete": [{"larger": "5M"}]}
+
+Images matching any of the rules under "delete" are deleted once they are
+extracted, and the deletions synced back to Gmail.  Each rule is an object
+whose conditions must all hold for an image, of:
+
+    larger  -- the image is larger than this, in bytes or with a suffix
+               (ex "500K", "2M")
+    smaller -- the image is smaller than this
+    name    -- the image's file name matches this pattern (ex "*.gif")
+    subject -- the subject of the image's message matches this pattern
+"""
+
+import fnmatch
+import json
+import multiprocessing
+import os
+import signal
+import time
+import traceback
+from .extractor import GmailImageExtractor
+from .fs import account_dirname
+from .metrics import Metrics
+from .pool import ConnectionBudget
+from .search import SearchFilter
+from .throttle import RateLimit
+
+# Options each account can be given, and their values when neither the
+# account nor the command line give one.  They match the options of
+# extract.py, with sizes in kilobytes.
+DEFAULTS = {
+    "dest": ".",
+    "limit": 0,
+    "simultaneous": 10,
+    "connections": 1,
+    "chunk_size": 1024,
+    "dedupe": False,
+    "write": False,
+    "all_attachments": False,
+    "larger": None,
+    "smaller": None,
+    "after": None,
+    "before": None,
+    "label": [],
+    "query": None,
+    "delete": [],
+}
+
+RULE_KEYS = ("larger", "smaller", "name", "subject")
+
+_SUFFIXES = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+# How long, in seconds, to wait for an account to finish before checking
+# for signals again
+_POLL = 0.5
+
+# Set in each worker process by _init_worker()
+_budget = None
+_rate = None
+_server = None
+
+
+def parse_size(value):
+    """Returns the number of bytes described by a size given as a number,
+    or as a string with an optional "K", "M" or "G" suffix.
+    """
+    if isinstance(value, (int, long, float)):
+        return int(value)
+    value = value.strip().upper()
+    if value and value[-1] in _SUFFIXES:
+        return int(float(value[:-1]) * _SUFFIXES[value[-1]])
+    return int(value)
+
+
+def load_accounts(path, defaults=None):
+    """Reads the accounts to work on from a file.
+
+    Args:
+        path -- the path to a file with an account on each line, as a JSON
+                object.  Blank lines and lines starting with "#" are
+                skipped.
+
+    Keyword Args:
+        defaults -- an optional dict of values for options the accounts
+                    don't give, such as those given on the command line.
+                    Options in neither fall back to DEFAULTS.
+
+    Returns:
+        A list of dicts, each with a value for every option in DEFAULTS,
+        along with the "email" and "password" of the account.  Unless an
+        account gives its own "dest", its images are written to a directory
+        named after the account (see fs.account_dirname()) in the default
+        "dest", which is created if need be.
+
+    raise:
+        ValueError -- If any line isn't a JSON object with an email and
+                      password, gives an option or rule that doesn't exist,
+                      or would share a directory with an earlier account.
+    """
+    base = dict(DEFAULTS)
+    base.update(defaults or {})
+    accounts = []
+    dests = set()
+    with open(path) as handle:
+        for line_num, line in enumerate(handle, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                given = json.loads(line)
+            except ValueError as e:
+                raise ValueError("Line {0}: {1}".format(line_num, e))
+            if not isinstance(given, dict) or not given.get("email") or not given.get("password"):
+                raise ValueError("Line {0}: each account needs an email and password".format(line_num))
+            unknown = set(given) - set(DEFAULTS) - set(("email", "password"))
+            if unknown:
+                raise ValueError("Line {0}: unknown options {1}".format(line_num, ", ".join(sorted(unknown))))
+            for rule in given.get("delete", []):
+                if not isinstance(rule, dict) or not rule or set(rule) - set(RULE_KEYS):
+                    raise ValueError("Line {0}: deletion rules can only use {1}".format(
+                        line_num, ", ".join(RULE_KEYS)))
+
+            account = dict(base)
+            account.update(given)
+            if "dest" not in given:
+                account["dest"] = os.path.join(base["dest"], account_dirname(account["email"]))
+            # Two accounts working in one directory would sync each
+            # other's deletions against the wrong messages
+            dest = os.path.normcase(os.path.abspath(account["dest"]))
+            if dest in dests:
+                raise ValueError("Line {0}: {1} is already used by another account".format(
+                    line_num, account["dest"]))
+            dests.add(dest)
+            if "dest" not in given and not os.path.isdir(account["dest"]):
+                os.makedirs(account["dest"])
+            accounts.append(account)
+    return accounts
+
+
+def rule_matches(rule, path, name, subject):
+    """Returns a boolean description of whether an extracted image meets
+    every condition of a deletion rule.
+
+    Args:
+        rule    -- a dict of conditions, as described at the top of the
+                   module
+        path    -- the path of the image on disk
+        name    -- the file name of the image
+        subject -- the subject of the message the image was attached to
+    """
+    for key, value in rule.items():
+        if key == "larger" and not os.path.getsize(path) > parse_size(value):
+            return False
+        elif key == "smaller" and not os.path.getsize(path) < parse_size(value):
+            return False
+        elif key == "name" and not fnmatch.fnmatch(name.lower(), value.lower()):
+            return False
+        elif key == "subject" and not fnmatch.fnmatch((subject or u"").lower(), value.lower()):
+            return False
+    return True
+
+
+def apply_rules(extractor, rules):
+    """Deletes, from disk, every image the extractor has extracted that
+    matches any of the given deletion rules.
+
+    Returns:
+        A list of the file names of the images deleted.
+    """
+    deleted = []
+    for name, (gm_id, a_hash, subject) in sorted(extractor.mapping.items()):
+        path = os.path.join(extractor.dest, name)
+        if not os.path.isfile(path):
+            continue
+        if any(rule_matches(rule, path, name, subject) for rule in rules):
+            os.remove(path)
+            deleted.append(name)
+    return deleted
+
+
+def run_account(account, budget=None, rate=None, server=None):
+    """Extracts the images from a single account, then deletes any that
+    match the account's deletion rules and syncs those deletions to Gmail.
+    Errors are caught and reported in the result, rather than raised, so
+    that one account can't stop the others.
+
+    Args:
+        account -- a dict describing the account, as returned by
+                   load_accounts()
+
+    Keyword Args:
+        budget -- an optional pool.ConnectionBudget for the account's
+                  connections to count against
+        rate   -- an optional throttle.RateLimit capping the bandwidth used
+        server -- an optional (host, port, use_ssl) tuple, describing an
+                  IMAP server to connect to in place of Gmail's
+
+    Returns:
+        A dict summarizing how it went, with the "email" and "dest" of the
+        account, whether it went "ok" (and if not, the "error"), the number
+        of "messages" with attachments, the number of "images" extracted,
+        the "bytes_fetched", the number of images "deleted", the number of
+        "attachments_removed" from the number of "messages_changed" in
+        Gmail, the "seconds" it took and a snapshot of the "metrics".
+    """
+    result = {"email": account["email"], "dest": account["dest"], "ok": False}
+    start = time.time()
+    try:
+        search = SearchFilter(images_only=not account["all_attachments"],
+                              larger=account["larger"], smaller=account["smaller"],
+                              after=account["after"], before=account["before"],
+                              labels=account["label"], raw=account["query"])
+        extractor = GmailImageExtractor(account["dest"], account["email"], account["password"],
+                                        limit=account["limit"], batch=account["simultaneous"],
+                                        replace=account["write"],
+                                        connections=account["connections"],
+                                        chunk_size=account["chunk_size"] * 1024,
+                                        dedupe=account["dedupe"], budget=budget,
+                                        server=server, metrics=Metrics(),
+                                        search=search, rate=rate)
+        try:
+            if not extractor.connect():
+                result["error"] = "Unable to connect to Gmail with provided credentials"
+                return result
+            result["messages"] = extractor.num_messages_with_attachments()
+            result["images"] = extractor.extract()
+            result["bytes_fetched"] = extractor.bytes_fetched
+            result["deleted"] = 0
+            result["attachments_removed"] = result["messages_changed"] = 0
+            if account["delete"]:
+                result["deleted"] = len(apply_rules(extractor, account["delete"]))
+                extractor.check_deletions()
+                removed, changed = extractor.sync()
+                result["attachments_removed"], result["messages_changed"] = removed, changed
+            result["ok"] = True
+        finally:
+            extractor.close()
+            result["metrics"] = extractor.metrics.snapshot()
+    except Exception as e:
+        result["error"] = "{0}: {1}".format(type(e).__name__, e)
+        result["traceback"] = traceback.format_exc()
+    finally:
+        result["seconds"] = time.time() - start
+    return result
+
+
+def _init_worker(budget, rate, server):
+    global _budget, _rate, _server
+    _budget = budget
+    _rate = rate
+    _server = server
+    # Interrupting the batch is left to the parent process, which stops
+    # the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _run_account(account):
+    return run_account(account, _budget, _rate, _server)
+
+
+def run(accounts, processes=4, max_connections=0, max_bandwidth=0, server=None):
+    """Works on the given accounts in a pool of processes.
+
+    Args:
+        accounts -- a list of accounts, as returned by load_accounts()
+
+    Keyword Args:
+        processes       -- the number of accounts to work on at once
+        max_connections -- the most connections to have open to Gmail at
+                           once across every account, or 0 for no limit
+        max_bandwidth   -- the most bytes a second to move to and from Gmail
+                           across every account, or 0 for no limit
+        server          -- an optional (host, port, use_ssl) tuple,
+                           describing an IMAP server to connect to in place
+                           of Gmail's
+
+    Returns:
+        An iterator over the result of each account, as returned by
+        run_account(), in the order they finish.
+    """
+    budget = ConnectionBudget(max_connections, shared=True) if max_connections else None
+    rate = RateLimit(max_bandwidth, shared=True) if max_bandwidth else None
+    pool = multiprocessing.Pool(max(1, min(processes, len(accounts) or 1)),
+                                initializer=_init_worker, initargs=(budget, rate, server))
+    try:
+        results = pool.imap_unordered(_run_account, accounts)
+        while True:
+            # Waiting with a timeout keeps the process responsive to
+            # signals, such as a KeyboardInterrupt
+            try:
+                result = results.next(_POLL)
+            except multiprocessing.TimeoutError:
+                continue
+            except StopIteration:
+                break
+            yield result
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
@@ -1,10 +1,98 @@
 import os
-import pygmail.errors
-from .fs import sanatize_filename, unique_filename
-from pygmail.account import Account
+import hashlib
+import threading
+import time
+import uuid
+from . import mime
+from .fs import sanatize_filename, list_names, NameAllocator, AtomicFile, remove_partial_files
+from .imap import FETCH_CHUNK, TOKEN_HEADER
+from .manifest import Manifest
+from .metrics import Metrics
+from .pipeline import Pipeline, Stage
+from .pool import ConnectionPool
+from .search import SearchFilter
+from .store import ImageStore
+from .throttle import BatchSizer
+from .watch import DeletionWatcher
 
 ATTACHMENT_MIMES = ('image/jpeg', 'image/png', 'image/gif')
 
+# The most bytes of whole messages to fetch at once on each connection while
+# syncing, since each is held in memory while it is rewritten.  Larger
+# messages are fetched on their own.
+SYNC_FETCH_BYTES = 8 * 1048576
+
+
+class _Page(object):
+    """A batch of messages being extracted."""
+
+    def __init__(self, index, first, uids):
+        self.index = index
+        # The position, counting from 1, of the batch's first message among
+        # all the messages being extracted
+        self.first = first
+        self.uids = uids
+        # Number of messages in the batch not finished yet
+        self.pending = None
+        self.finished = False
+
+
+class _Message(object):
+    """A message being extracted, and its images."""
+
+    def __init__(self, page, uid, gm_id, subject, size, parts):
+        self.page = page
+        self.uid = uid
+        self.gm_id = gm_id
+        self.subject = subject
+        self.size = size
+        self.parts = parts
+        self.images = []
+        # Number of images not written to disk yet
+        self.pending = len(parts)
+
+
+class _Image(object):
+    """An image being decoded and written to disk."""
+
+    def __init__(self, message, part):
+        self.message = message
+        self.part = part
+        self.decoder = mime.decoder(part.encoding)
+        self.hash = hashlib.sha1()
+        self.handle = None
+        self.buffered = None
+        self.fname = None
+        self.sha1 = None
+        message.images.append(self)
+
+
+def _size_groups(parts, limit, size=lambda part: part.size):
+    """Splits MIME parts into groups whose combined size is no more than
+    `limit`, except for parts larger than `limit`, which are each put in a
+    group of their own.
+
+    Keyword Args:
+        size -- a function returning the size of each item, for grouping
+                things other than MIME parts
+    """
+    group = []
+    group_size = 0
+    for part in parts:
+        part_size = size(part)
+        if part_size > limit:
+            yield [part]
+            continue
+        if group and group_size + part_size > limit:
+            yield group
+            group = []
+            group_size = 0
+        group.append(part)
+        group_size += part_size
+    if group:
+        yield group
+
+
 class GmailImageExtractor(object):
     """Image extrating class which handles connecting to gmail on behalf of
     a user over IMAP, extracts images from messages in a Gmail account,
@@ -14,7 +102,9 @@ class GmailImageExtractor(object):
     account.
     """
 
-    def __init__(self, dest, email, password, limit=None, batch=10, replace=False):
+    def __init__(self, dest, email, password, limit=None, batch=10, replace=False,
+                 connections=1, chunk_size=1048576, writers=2, dedupe=False,
+                 budget=None, server=None, metrics=None, search=None, rate=None):
         """
         Args:
             dest     -- the path on the file system where images should be
@@ -25,12 +115,46 @@ class GmailImageExtractor(object):
         Keyword Args:
             limit   -- an optional limit of the total number of messages to
                        download from the gmail account.
-            batch   -- the maximum number of messages to download from Gmail
-                       at the same time.
+            batch   -- the number of messages to download from Gmail at the
+                       same time, to start with.  The number grows while
+                       Gmail keeps up, and shrinks when it throttles the
+                       connection or batches get slow or large.
             replace -- whether to rewrite the messages in the Gmail account
                        in place (True) or to just write a second, parallel
                        copy of the altered message and leave the original
                        version alone.
+            connections -- the number of connections to open to Gmail, to
+                           download batches of messages in parallel.
+            chunk_size  -- the maximum number of bytes of image data to
+                           download at once on each connection.  Larger
+                           images are downloaded and written to disk in
+                           pieces, which bounds the memory used however large
+                           the images are.
+            writers     -- the number of threads writing images to disk.
+            dedupe      -- whether to only write each distinct image to disk
+                           once, making any other copies of it hard links to
+                           the first.  Deleting any copy of the image then
+                           removes every copy of it from Gmail.
+            budget      -- an optional pool.ConnectionBudget, shared with
+                           other extractors, limiting how many connections
+                           they have open to Gmail between them.  Only one
+                           connection is kept open between steps, and more
+                           are opened, as the budget allows, for extract()
+                           and sync().
+            server      -- an optional (host, port, use_ssl) tuple,
+                           describing an IMAP server to connect to in place
+                           of Gmail's, such as the stand-in server the
+                           benchmarks use.
+            metrics     -- an optional metrics.Metrics to record counters
+                           and timers in.  If not given, a new one is made.
+                           Either way it is available as `self.metrics`.
+            search      -- an optional search.SearchFilter, narrowing down
+                           which messages are considered, with the search
+                           done by Gmail.  Defaults to every message with an
+                           attachment named like an image.
+            rate        -- an optional throttle.RateLimit, shared with other
+                           extractors, capping the bandwidth they use
+                           between them.
 
         raise:
             ValueError -- If the given dest path to write extracted images to
@@ -40,10 +164,35 @@ class GmailImageExtractor(object):
 
         if not self.validate_path():
             raise ValueError("{0} is not a writeable directory".format(dest))
+        # Images left half written by an earlier run that was killed
+        remove_partial_files(dest)
+
+        # Anything extracted by an earlier run into the same directory is
+        # loaded from the manifest, so that deletions can be checked and
+        # synced without extracting again.
+        self.manifest = Manifest(dest)
+        # Keep track of which attachments belong to which messages.  Do this
+        # by keeping track of all attachments downloaded to the filesystem
+        # (used as the dict key) and pairing it with two values, the gmail
+        # message id and the hash of the attachment (so that we can uniquely
+        # identify the attachment again), along with the message's subject
+        self.mapping = self.manifest.mapping()
+        self.snapshot = None
+        self.dedupe = dedupe
+        self.watcher = None
+        self.store = ImageStore(dest, self.mapping) if dedupe else None
 
         self.limit = limit
+        self.search = search or SearchFilter()
         self.batch = batch
         self.replace = replace
+        self.connections = connections
+        self.budget = budget
+        self.server = server
+        self.rate = rate
+        self.metrics = metrics or Metrics()
+        self.chunk_size = chunk_size
+        self.writers = writers
         self.email = email
         self.password = password
 
@@ -71,34 +220,91 @@ class GmailImageExtractor(object):
             Returns a boolean description of whether we were able to connect
             to Gmail using the current parameters.
         """
-        mail = Account(self.email, password=self.password)
-        trash_folder = mail.trash_mailbox()
-        if pygmail.errors.is_error(trash_folder):
+        pool = ConnectionPool(self.email, self.password, self.connections,
+                              self.budget, self.server, self.metrics, self.rate)
+        if not pool.connect():
             return False
-        else:
-            self.mail = mail
-            self.trash_folder = trash_folder
-            self.inbox = mail.all_mailbox()
-            return True
+
+        self.pool = pool
+        self.conn = pool.connections[0]
+        self.snapshot = None
+        return True
+
+    def close(self):
+        """Stops watching for deletions, and closes the connections to Gmail
+        and the manifest.  The extractor can't be used afterwards.
+        """
+        self.stop_watching()
+        if getattr(self, 'pool', None) is not None:
+            self.pool.close()
+            self.pool = None
+        self.manifest.close()
+
+    def _snapshot(self):
+        """Returns the UIDs of the messages with attachments that still need
+        to be extracted, respecting the `limit` set at instantiation.
+
+        The search is only run once and the result is reused until the next
+        extraction finishes, so the count given by
+        num_messages_with_attachments() and the messages extracted always
+        agree, even if new mail arrives in the meantime.  Only messages
+        newer than the last one extracted by an earlier run with the same
+        search filter are searched for.
+        """
+        if self.snapshot is None:
+            # UIDs from before the mailbox's UIDVALIDITY changed mean nothing,
+            # and a different search may match older messages the last one
+            # didn't, so start over, relying on the list of processed
+            # messages.
+            query = self.search.query()
+            if (self.manifest.get('uidvalidity') != unicode(self.conn.uidvalidity) or
+                    self.manifest.get('query') != query):
+                self.manifest.set('uidvalidity', self.conn.uidvalidity)
+                self.manifest.set('query', query)
+                self.manifest.set('high_water_uid', 0)
+            high_water = int(self.manifest.get('high_water_uid', 0))
+            uids = self.conn.search(query, min_uid=high_water + 1)
+            if self.limit > 0:
+                uids = uids[:self.limit]
+            self.snapshot = uids
+        return self.snapshot
 
     def num_messages_with_attachments(self):
         """Checks to see how many Gmail messages have attachments in the
-        currently connected gmail account.
+        currently connected gmail account, and have not already been
+        extracted.
 
         This should only be called after having succesfully connected to Gmail.
 
         Return:
             The number of messages in the Gmail account that have at least one
-            attachment (as advertised by Gmail).
+            attachment (as advertised by Gmail), match the search filter given
+            at instantiation, and still need to be extracted.
         """
-        limit = self.limit if self.limit > 0 else False
-        gm_ids = self.inbox.search("has:attachment", gm_ids=True, limit=limit)
-        return len(gm_ids)
+        return len(self._snapshot())
 
     def extract(self, callback=None):
         """Extracts images from Gmail messages and writes them to the
         path set at instantiation.
 
+        Each message is recorded in the manifest as soon as its images have
+        been written, so messages handled by an earlier (possibly
+        interrupted) run are skipped.
+
+        Only the structure of each message is downloaded, followed by just
+        the image parts of it.  Once finished, `self.bytes_fetched` holds the
+        number of bytes downloaded from Gmail and `self.message_bytes` the
+        total size of the messages considered.
+
+        If instantiated with dedupe=True, `self.store.hits` holds the number
+        of images that were already on disk, and were linked to instead of
+        being written again.
+
+        Downloading, decoding and writing to disk happen at the same time, in
+        separate stages connected by small queues.  Once finished,
+        `self.queue_stats` holds statistics about how much work waited at
+        each stage.
+
         Keyword Args:
             callback -- An optional funciton that will be called with updates
                         about the image extraction process. If provided,
@@ -114,6 +320,11 @@ class GmailImageExtractor(object):
                         when fetching messages from Gmail, where `first` is the
                         index of the current message being downloaded.
 
+                        ('queues', depths)
+                        along with each 'message' update, where `depths` is a
+                        dict of the number of items waiting at each of the
+                        'fetch', 'decode' and 'write' stages.
+
         Returns:
             The number of images written to disk.
         """
@@ -121,49 +332,277 @@ class GmailImageExtractor(object):
             if callback:
                 callback(*args)
 
-        attachment_count = 0
-        num_messages = 0
-        offset = 0
+        # Work happens in several threads at once, so anything shared
+        # between them is guarded by this lock, including the callback.
+        lock = threading.Lock()
+        start = time.time()
+        metrics = self.metrics
+        self.pool.grow()
+        fetched_before = self.pool.bytes_fetched
+        # Total size of the messages considered, to compare against the
+        # number of bytes actually downloaded
+        self.message_bytes = 0
+        self.attachment_count = 0
         per_page = min(self.batch, self.limit) if self.limit else self.batch
-        # Keep track of which attachments belong to which messages.  Do this
-        # by keeping track of all attachments downloaded to the filesystem
-        # (used as the dict key) and pairing it with two values, the gmail
-        # message id and the hash of the attachment (so that we can uniquely
-        # identify the attachment again)
-        self.mapping = {}
-        hit_limit = False
-        while True and not hit_limit:
-            _cb('message', offset + 1)
-            messages = self.inbox.search("has:attachment", full=True,
-                                         limit=per_page, offset=offset)
-            if len(messages) == 0:
-                break
-            for msg in messages:
-                for att in msg.attachments():
-                    if att.type in ATTACHMENT_MIMES:
-                        poss_fname = u"{0} - {1}".format(msg.subject, att.name())
-                        safe_fname = sanatize_filename(poss_fname)
-                        fname = unique_filename(self.dest, safe_fname)
-
-                        _cb('image', att.name(), fname)
-                        h = open(os.path.join(self.dest, fname), 'w')
-                        h.write(att.body())
-                        h.close()
-
-                        self.mapping[fname] = msg.gmail_id, att.sha1(), msg.subject
-                        attachment_count += 1
-                num_messages += 1
-                if self.limit > 0 and num_messages >= self.limit:
-                    hit_limit = True
-                    break
-            offset += per_page
-        return attachment_count
-
-    def check_deletions(self):
+        sizer = BatchSizer(per_page, maximum=FETCH_CHUNK)
+        processed = self.manifest.processed_gm_ids()
+        pages = []
+
+        def _pages():
+            # Batches are made as they're needed, so that each one is the
+            # size that suits how the batches before it went
+            first = 1
+            for uids in sizer.batches(self._snapshot()):
+                with lock:
+                    page = _Page(len(pages), first, uids)
+                    pages.append(page)
+                first += len(uids)
+                yield page
+
+        # Index of the first page that has not finished yet
+        waiting_on = [0]
+        # Images being written, so they can be cleaned up if anything fails
+        open_images = set()
+        # Images deleted from disk but not yet synced keep their names, or
+        # a new image could take one over and the deletion would be lost
+        names = NameAllocator(self.dest, self.mapping.keys())
+
+        def _page_done(page):
+            # Searches return UIDs in ascending order, so once every page up
+            # to this one is finished, every message up to the end of it has
+            # been handled
+            high_water = None
+            with lock:
+                page.finished = True
+                while waiting_on[0] < len(pages) and pages[waiting_on[0]].finished:
+                    high_water = pages[waiting_on[0]].uids[-1]
+                    waiting_on[0] += 1
+            if high_water is not None:
+                self.manifest.set('high_water_uid', high_water)
+
+        def _message_done(message):
+            images = [(image.fname, image.sha1) for image in message.images]
+            with lock:
+                self.message_bytes += message.size
+                for fname, a_hash in images:
+                    self.mapping[fname] = unicode(message.gm_id), a_hash, message.subject
+                self.attachment_count += len(images)
+                message.page.pending -= 1
+                page_finished = message.page.pending == 0
+            self.manifest.add_message(message.gm_id, message.subject, images)
+            if page_finished:
+                _page_done(message.page)
+
+        def _fetch(worker, page, emit):
+            # Fetches the structure of each message in a batch, and then only
+            # the parts of the message that are images we want, passing them
+            # on to be decoded in pieces of at most chunk_size bytes
+            conn = self.pool.connections[worker]
+            with lock:
+                _cb('message', page.first)
+                _cb('queues', pipeline.depths())
+            page_start = time.time()
+            bytes_before = conn.bytes_fetched
+            retries_before = conn.retries
+            structures = conn.fetch(page.uids, "(X-GM-MSGID RFC822.SIZE BODYSTRUCTURE "
+                                               "BODY.PEEK[HEADER.FIELDS (SUBJECT)])")
+            messages = []
+            for uid in page.uids:
+                # Skip messages deleted since we searched, or that were
+                # handled by an earlier run
+                attrs = structures.get(uid)
+                if attrs is None or attrs["X-GM-MSGID"] in processed:
+                    continue
+                headers = [v for k, v in attrs.items() if k.startswith("BODY[HEADER")]
+                image_parts = []
+                for part in mime.parts(attrs["BODYSTRUCTURE"]):
+                    if not part.name():
+                        continue
+                    if part.type in ATTACHMENT_MIMES:
+                        image_parts.append(part)
+                    else:
+                        metrics.incr(u"attachments.skipped." + part.type)
+                messages.append(_Message(page, uid, attrs["X-GM-MSGID"],
+                                         mime.subject(headers[0] if headers else ""),
+                                         int(attrs["RFC822.SIZE"]), image_parts))
+            page.pending = len(messages)
+            if not messages:
+                _page_done(page)
+
+            for message in messages:
+                if not message.pending:
+                    _message_done(message)
+                    continue
+                for group in _size_groups(message.parts, self.chunk_size):
+                    if group[0].size > self.chunk_size:
+                        part = group[0]
+                        image = _Image(message, part)
+                        for piece in conn.fetch_part(message.uid, part.section, part.size,
+                                                     self.chunk_size):
+                            emit((image, piece))
+                        emit((image, None))
+                        continue
+                    items = u" ".join(u"BODY.PEEK[{0}]".format(part.section) for part in group)
+                    bodies = conn.fetch([message.uid], u"({0})".format(items)).get(message.uid, {})
+                    for part in group:
+                        image = _Image(message, part)
+                        emit((image, bodies.get(u"BODY[{0}]".format(part.section)) or ""))
+                        emit((image, None))
+
+            sizer.finished(len(page.uids), time.time() - page_start,
+                           conn.bytes_fetched - bytes_before,
+                           throttled=conn.retries > retries_before)
+
+        def _decode(worker, item, emit):
+            # Decodes and hashes image data, a piece at a time.  A piece of
+            # None marks the end of the image.
+            image, piece = item
+            data = image.decoder.flush() if piece is None else image.decoder.decode(piece)
+            if data:
+                image.hash.update(data)
+                emit((image, data))
+            if piece is None:
+                emit((image, None))
+
+        def _claim_name(image):
+            # Picks a unique file name for the image, which the allocator
+            # holds until the image is moved into place (or linked to an
+            # existing copy of it)
+            poss_fname = u"{0} - {1}".format(image.message.subject, image.part.name())
+            image.fname = names.allocate(sanatize_filename(poss_fname))
+            with lock:
+                _cb('image', image.part.name(), image.fname)
+                if self.store and image.sha1 and self.store.link(image.sha1, image.fname):
+                    metrics.incr(u"images.linked")
+                    return True
+                open_images.add(image)
+                return False
+
+        def _open(image):
+            image.handle = AtomicFile(self.dest, image.fname)
+            if image.buffered is not None:
+                _write_data(image, image.buffered)
+                image.buffered = None
+
+        def _write_data(image, data):
+            with metrics.timer(u"disk.write"):
+                image.handle.write(data)
+            metrics.incr(u"disk.bytes_written", len(data))
+
+        def _commit(image):
+            with metrics.timer(u"disk.commit"):
+                image.handle.commit()
+            metrics.incr(u"images.written")
+
+        def _write(worker, item, emit):
+            # Writes decoded image data to disk, and moves each image into
+            # place once it has been completely written
+            image, data = item
+            if data is not None:
+                if image.handle is None:
+                    # When deduplicating, hold on to the first piece of the
+                    # image, so that images small enough to arrive in one
+                    # piece are only written if they're new
+                    if self.store and image.buffered is None:
+                        image.buffered = data
+                        return
+                    _claim_name(image)
+                    _open(image)
+                _write_data(image, data)
+                return
+
+            image.sha1 = image.hash.hexdigest()
+            if image.handle is None:
+                # The whole image was held on to, so it only needs to be
+                # written if there isn't a copy of it on disk already
+                if not _claim_name(image):
+                    _open(image)
+                    _commit(image)
+                    if self.store:
+                        self.store.add(image.sha1, image.fname)
+            elif self.store and self.store.link(image.sha1, image.fname, replace=True):
+                # Images too large to hold on to were written anyway, but
+                # only one copy of them needs to be kept
+                image.handle.discard()
+                metrics.incr(u"images.linked")
+            else:
+                _commit(image)
+                if self.store:
+                    self.store.add(image.sha1, image.fname)
+            with lock:
+                open_images.discard(image)
+                image.message.pending -= 1
+                message_finished = image.message.pending == 0
+            if message_finished:
+                _message_done(image.message)
+
+        # Each stage can only get a few pieces ahead of the one after it, so
+        # no more than about queue_size * chunk_size bytes of image data are
+        # held in memory at a time
+        queue_size = 2 * len(self.pool.connections)
+        _image_key = lambda item: id(item[0])
+        pipeline = Pipeline([
+            Stage('fetch', _fetch, workers=len(self.pool.connections), maxsize=1),
+            Stage('decode', _decode, maxsize=queue_size, key=_image_key),
+            Stage('write', _write, workers=self.writers, maxsize=queue_size, key=_image_key),
+        ])
+        try:
+            pipeline.run(_pages())
+        finally:
+            for image in open_images:
+                if image.handle is not None:
+                    image.handle.discard()
+            self.queue_stats = pipeline.stats()
+            self.bytes_fetched = self.pool.bytes_fetched - fetched_before
+            if self.budget is not None:
+                self.pool.shrink()
+            metrics.record(u"phase.extract", time.time() - start)
+        self.snapshot = None
+        return self.attachment_count
+
+    def watch_deletions(self, callback=None):
+        """Starts watching the directory images were extracted to, so that
+        images deleted by the user are noticed as they are deleted, and
+        check_deletions() doesn't need to look at the file system.  This is
+        only supported on Linux.
+
+        Keyword Args:
+            callback -- An optional function that will be called, from
+                        another thread, with the number of extracted images
+                        currently deleted, whenever that number changes.
+
+        Returns:
+            A boolean description of whether the directory is being watched.
+        """
+        self.stop_watching()
+        watcher = DeletionWatcher(self.dest, self.mapping.keys(), callback)
+        if not watcher.start():
+            return False
+        self.watcher = watcher
+        return True
+
+    def stop_watching(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+    def check_deletions(self, names=None):
         """Checks the filesystem to see which image attachments, downloaded
         in the self.extract() step, have been removed since extraction, and
         thus should be removed from Gmail.
 
+        This works from the manifest, so it can be run in a later process
+        than the one that did the extraction.  If watch_deletions() was
+        called, the deletions it has already seen are used, otherwise the
+        directory is listed once and compared against the extracted images.
+
+        Keyword Args:
+            names -- an optional list of the file names of the extracted
+                     images to remove, such as those picked in the web
+                     interface's gallery.  If given, these are used instead
+                     of the images deleted from disk, and the directory
+                     isn't looked at.
+
         Returns:
             The number of attachments that have been deleted from the
             filesystem.
@@ -175,16 +614,33 @@ class GmailImageExtractor(object):
         # Here we want to group attachments by gmail_id, so that we only act on
         # a single email message once, instead of pulling it down multiple times
         # (which would change its gmail_id and ruin all things)
+        start = time.time()
         self.to_delete = {}
         self.to_delete_subjects = {}
+        self.to_delete_names = {}
         self.num_deletions = 0
-        for a_name, (gmail_id, a_hash, msg_subject) in self.mapping.items():
-            if not os.path.isfile(os.path.join(self.dest, a_name)):
-                if not gmail_id in self.to_delete:
-                    self.to_delete[gmail_id] = []
-                    self.to_delete_subjects[gmail_id] = msg_subject
-                self.to_delete[gmail_id].append(a_hash)
-                self.num_deletions += 1
+        if names is not None:
+            deleted = set(names) & set(self.mapping)
+        elif self.watcher is not None and self.watcher.running():
+            deleted = self.watcher.deleted_names() & set(self.mapping)
+        else:
+            deleted = set(self.mapping) - list_names(self.dest)
+        if self.dedupe:
+            # Every copy of an image is the same file on disk, so deleting
+            # any of them means the user wants all of them removed
+            deleted_hashes = set(self.mapping[a_name][1] for a_name in deleted)
+            deleted = [a_name for a_name, (gmail_id, a_hash, msg_subject) in self.mapping.items()
+                       if a_hash in deleted_hashes]
+        for a_name in deleted:
+            gmail_id, a_hash, msg_subject = self.mapping[a_name]
+            if not gmail_id in self.to_delete:
+                self.to_delete[gmail_id] = []
+                self.to_delete_subjects[gmail_id] = msg_subject
+                self.to_delete_names[gmail_id] = {}
+            self.to_delete[gmail_id].append(a_hash)
+            self.to_delete_names[gmail_id].setdefault(a_hash, []).append(a_name)
+            self.num_deletions += 1
+        self.metrics.record(u"phase.check_deletions", time.time() - start)
         return self.num_deletions
 
     def sync(self, label='"Images redacted"', callback=None):
@@ -192,6 +648,14 @@ class GmailImageExtractor(object):
         self.extract() step, and deletes any attachments that were deleted
         from disk from their corresponding images in Gmail.
 
+        Altered messages get a new gmail id, which the manifest is updated
+        with, and the altered messages are recorded as processed so that
+        they aren't extracted again.
+
+        Each rewrite is journaled in the manifest as it goes, so if a sync
+        is interrupted, the next one finishes any message whose altered
+        version already reached Gmail, rather than saving it again.
+
         Keyword Args:
             label    -- Gmail label to use either as a temporary work label
                         (if instatiated with replace=True) or where the altered
@@ -203,7 +667,8 @@ class GmailImageExtractor(object):
                         will be called with the following sets of arguments:
 
                         ('fetch', subject, num_attach)
-                        Called before fetching a message from gmail. `subject`
+                        Called before fetching a batch of messages from gmail,
+                        once for each message in the batch. `subject`
                         is the subject of the email message to download, and
                         `num_attach` is the number of attachments to be removed
                         from that message.
@@ -226,28 +691,155 @@ class GmailImageExtractor(object):
             if callback:
                 callback(*args)
 
-        num_msg_changed = 0
-        num_attch_removed = 0
-        for gmail_id, attch_to_remove in self.to_delete.items():
-            msg_sbj = self.to_delete_subjects[gmail_id]
-
-            _cb('fetch', msg_sbj, len(attch_to_remove))
-            msg_to_change = self.inbox.fetch_gm_id(gmail_id, full=True)
-            attach_hashes = {a.sha1(): a for a in msg_to_change.attachments()}
-            removed_attachments = 0
-            for attachment_hash in attch_to_remove:
-                attach_to_delete = attach_hashes[attachment_hash]
-                if attach_to_delete.remove():
-                    removed_attachments += 1
-                    num_attch_removed += 1
-
-            if removed_attachments:
-                num_msg_changed += 1
-                _cb('write', msg_sbj)
+        # Messages are handled in batches, each batch looked up with a single
+        # search, and with a batch handled by each connection in the pool
+        # at the same time, so that uploading the altered messages of one
+        # batch overlaps with downloading the next.
+        lock = threading.Lock()
+        start = time.time()
+        self.num_msg_changed = 0
+        self.num_attch_removed = 0
+
+        # Each batch's messages are found with a single search, and fetched
+        # in groups of at most SYNC_FETCH_BYTES
+        sizer = BatchSizer(self.batch, maximum=100)
+
+        def _finish(conn, gmail_id, new_uid, new_gm_id, fnames, orig_uid, labels):
+            """Deals with the original version of a rewritten message, now
+            that the altered version is in Gmail, and records the rewrite as
+            done.  Every step here can safely be repeated, in case a sync is
+            interrupted part way through.
+            """
+            if new_uid is not None:
                 if self.replace:
-                    msg_to_change.save(self.trash_folder.name, safe_label=label)
+                    # The label marks the new version as a work in progress
+                    # until the original is out of the way
+                    if orig_uid is not None:
+                        conn.add_labels([new_uid], labels + [label])
+                        conn.trash([orig_uid])
+                    conn.remove_labels([new_uid], [label])
                 else:
-                    msg_to_change.save_copy(label)
-        return num_attch_removed, num_msg_changed
+                    conn.add_labels([new_uid], [label])
+            # Once the altered message is stored, there is nothing left in
+            # Gmail for these files to refer to.
+            self.manifest.finish_rewrite(gmail_id, new_gm_id, keep_images=self.replace)
+            with lock:
+                for name in fnames:
+                    self.mapping.pop(name, None)
+                if self.replace:
+                    for name, (old_gm_id, a_hash, subject) in self.mapping.items():
+                        if old_gm_id == gmail_id:
+                            self.mapping[name] = new_gm_id, a_hash, subject
+                self.num_attch_removed += len(fnames)
+                self.num_msg_changed += 1
+
+        def _resume(conn, rewrites):
+            """Finishes rewrites that an earlier, interrupted, sync got as far
+            as saving to Gmail.
+            """
+            for gmail_id, rewrite in rewrites:
+                new_gm_id = rewrite["new_gm_id"]
+                if new_gm_id is None:
+                    new_uid = rewrite["new_uid"]
+                    new_gm_id = unicode(conn.fetch([new_uid], "(X-GM-MSGID)")[new_uid]["X-GM-MSGID"])
+                    self.manifest.rewrite_saved(gmail_id, conn.uidvalidity, new_uid, new_gm_id)
+                new_uids = conn.find_gm_ids([new_gm_id])
+                new_uid = new_uids[0] if new_uids else None
+                orig_uid, labels = None, []
+                originals = conn.fetch(conn.find_gm_ids([gmail_id]), "(X-GM-LABELS)")
+                for uid, attrs in originals.items():
+                    orig_uid, labels = uid, attrs["X-GM-LABELS"] or []
+                with lock:
+                    _cb('write', self.to_delete_subjects.get(gmail_id, u""))
+                _finish(conn, gmail_id, new_uid, new_gm_id, rewrite["fnames"], orig_uid, labels)
+
+        def _rewrite(conn, attrs):
+            gmail_id = unicode(attrs["X-GM-MSGID"])
+            if gmail_id not in self.to_delete:
+                return
+            msg_sbj = self.to_delete_subjects[gmail_id]
+            rewrite_start = time.time()
+            # Only the altered copy of the message is kept hold of
+            raw, removed_hashes = mime.remove_parts(attrs.pop("BODY[]"), self.to_delete[gmail_id])
+            if not removed_hashes:
+                return
+            names = self.to_delete_names[gmail_id]
+            removed_names = [names[a_hash].pop() for a_hash in removed_hashes]
+
+            # The journal is written ahead of each change to Gmail.  The
+            # token lets the altered message be found again if the
+            # connection drops, or the sync is interrupted, before its UID
+            # is known.
+            token = uuid.uuid4().hex
+            raw = mime.add_header(raw, TOKEN_HEADER, token)
+            self.manifest.plan_rewrite(gmail_id, removed_names, token)
+            with lock:
+                _cb('write', msg_sbj)
+            new_uid = conn.append(raw, attrs["FLAGS"] or [], attrs["INTERNALDATE"], token=token)
+            self.manifest.rewrite_saved(gmail_id, conn.uidvalidity, new_uid)
+            new_gm_id = unicode(conn.fetch([new_uid], "(X-GM-MSGID)")[new_uid]["X-GM-MSGID"])
+            self.manifest.rewrite_saved(gmail_id, conn.uidvalidity, new_uid, new_gm_id)
+            _finish(conn, gmail_id, new_uid, new_gm_id, removed_names,
+                    int(attrs["UID"]), attrs["X-GM-LABELS"] or [])
+            self.metrics.record(u"sync.rewrite", time.time() - rewrite_start)
+            self.metrics.incr(u"sync.bytes_uploaded", len(raw))
+
+        def _sync_batch(conn, gmail_ids):
+            with lock:
+                for gmail_id in gmail_ids:
+                    _cb('fetch', self.to_delete_subjects[gmail_id], len(self.to_delete[gmail_id]))
+            batch_start = time.time()
+            bytes_before = conn.bytes_fetched
+            retries_before = conn.retries
+            uids = conn.find_gm_ids(gmail_ids)
+            # Whole messages are held in memory while they're rewritten, so
+            # the batch's messages are fetched a few at a time, by size
+            sizes = conn.fetch(uids, "(RFC822.SIZE)")
+            for group in _size_groups(sorted(sizes), SYNC_FETCH_BYTES,
+                                      size=lambda uid: int(sizes[uid]["RFC822.SIZE"])):
+                fetched = conn.fetch(group, "(X-GM-MSGID X-GM-LABELS FLAGS INTERNALDATE BODY.PEEK[])")
+                for uid in group:
+                    if uid in fetched:
+                        _rewrite(conn, fetched.pop(uid))
+            sizer.finished(len(gmail_ids), time.time() - batch_start,
+                           conn.bytes_fetched - bytes_before,
+                           throttled=conn.retries > retries_before)
+
+        # Rewrites left unfinished by an earlier sync are dealt with first.
+        # An altered version whose gmail id, or still valid UID, wasn't
+        # recorded is looked for by its token, in case it reached Gmail
+        # before the sync stopped.  Those that never did are simply done
+        # again below.
+        resumed = set()
+        saved = []
+        for gmail_id, rewrite in self.manifest.unfinished_rewrites().items():
+            if not (rewrite["state"] == u"saved" and (
+                    rewrite["new_gm_id"] is not None or
+                    rewrite["uidvalidity"] == unicode(self.conn.uidvalidity))):
+                new_uid = None
+                if rewrite["token"] is not None:
+                    new_uid = self.conn.find_token(rewrite["token"])
+                if new_uid is None:
+                    self.manifest.cancel_rewrite(gmail_id)
+                    continue
+                self.manifest.rewrite_saved(gmail_id, self.conn.uidvalidity, new_uid)
+                rewrite.update(state=u"saved", uidvalidity=unicode(self.conn.uidvalidity),
+                               new_uid=new_uid, new_gm_id=None)
+            saved.append((gmail_id, rewrite))
+            resumed.add(gmail_id)
+        to_sync = [gmail_id for gmail_id in self.to_delete if gmail_id not in resumed]
+
+        self.pool.grow()
+        try:
+            if saved:
+                self.metrics.incr(u"sync.resumed", len(saved))
+                self.pool.map(_resume, [saved[i:i + self.batch]
+                                        for i in range(0, len(saved), self.batch)])
+            self.pool.map(_sync_batch, sizer.batches(to_sync))
+        finally:
+            if self.budget is not None:
+                self.pool.shrink()
+            self.metrics.record(u"phase.sync", time.time() - start)
+        return self.num_attch_removed, self.num_msg_changed
 
 
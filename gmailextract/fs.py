@@ -2,10 +2,37 @@
 image extractor program.
 """
 
+import hashlib
 import string
 import os
+import sys
+import tempfile
+import threading
 
 VALID_CHARS = "-_.() %s%s" % (string.ascii_letters, string.digits)
+
+# The start and end of the names of the temporary files AtomicFile writes to
+PARTIAL_PREFIX = u"."
+PARTIAL_SUFFIX = u".part"
+
+# os.umask() can only be read by setting it, which isn't safe once other
+# threads may be creating files, so it's read once here
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+class _ValidCharsTable(dict):
+    """Translation table for unicode.translate that keeps only VALID_CHARS,
+    dropping every other character without adding it to the table.
+    """
+
+    def __missing__(self, ordinal):
+        return None
+
+_UNICODE_TABLE = _ValidCharsTable((ord(c), ord(c)) for c in VALID_CHARS)
+_INVALID_BYTES = "".join(chr(i) for i in range(256) if chr(i) not in VALID_CHARS)
+
+
 def sanatize_filename(filename):
     """Returns a filename that is safe for using when saving to disk.
     This is only used for the basename of a file, not the directory path
@@ -17,36 +44,152 @@ def sanatize_filename(filename):
         A safe version of the same filename, that won't cause any problems
         saving to disk
     """
-    return ''.join(c for c in filename if c in VALID_CHARS)
+    if isinstance(filename, unicode):
+        return filename.translate(_UNICODE_TABLE)
+    return filename.translate(None, _INVALID_BYTES)
 
-def unique_filename(path, filename):
-    """Returns a version of the given filename that is unique in the given
-    directory.
 
-    A unique name is found by first trying the given filename in the given path.
-    If that file already exists, integers are added before the file extension
-    (if one exists) until a unique filename is found
+def normalize_email(email):
+    """Returns the form of an email address used to tell accounts apart,
+    so that differences in case or surrounding space name the same account.
+    """
+    if not isinstance(email, unicode):
+        email = email.decode("utf-8")
+    return email.strip().lower()
 
-    Args:
-        path     -- a directory path
-        filename -- a potential filename to try in the given directory
 
-    Returns:
-        A filename that is not currently used in the given directory
+def account_dirname(email):
+    """Returns the name of the directory to keep an account's images and
+    manifest in.  sanatize_filename() alone would give different accounts
+    the same name (ex "a+b@x.com" and "ab@x.com"), so the name ends with a
+    hash of the normalized email address.
     """
-    if not os.path.isfile(os.path.join(path, filename)):
-        return filename
+    email = normalize_email(email)
+    digest = hashlib.sha1(email.encode("utf-8")).hexdigest()
+    return u"{0}-{1}".format(sanatize_filename(email), digest[:16])
 
+
+def list_names(path):
+    """Returns the names of every entry in a directory, as a set of unicode
+    strings, from a single listing of the directory.
+    """
+    if not isinstance(path, unicode):
+        path = path.decode(sys.getfilesystemencoding())
+    return set(os.listdir(path))
+
+
+def _split_extension(filename):
     file_name_parts = filename.split(".")
     if len(file_name_parts) > 1:
-        extension = u"." + file_name_parts[-1]
-        base_filename = u".".join(file_name_parts[:-1])
-    else:
-        extension = u""
-        base_filename = filename
+        return u".".join(file_name_parts[:-1]), u"." + file_name_parts[-1]
+    return filename, u""
+
+
+def remove_partial_files(path):
+    """Removes the temporary files of any AtomicFile in a directory that was
+    never committed or discarded, such as those left behind when a process
+    is killed part way through writing an image.
+
+    Returns:
+        The number of files removed.
+    """
+    removed = 0
+    for name in list_names(path):
+        if name.startswith(PARTIAL_PREFIX) and name.endswith(PARTIAL_SUFFIX):
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError:
+                continue
+            removed += 1
+    return removed
+
+
+class NameAllocator(object):
+    """Hands out unique file names in a directory, without having to check
+    the file system for each candidate name.  A name that is taken has
+    integers added before its file extension (if one exists), ex
+    "photo - 2.jpg", until an untaken name is found.
+
+    The directory is listed once, when the allocator is created, and from
+    then on the allocator assumes it is the only thing adding files to the
+    directory.  It is safe to use from several threads at once.
+    """
+
+    def __init__(self, path, reserved=()):
+        """
+        Args:
+            path -- a directory path
+
+        Keyword Args:
+            reserved -- names to treat as taken even if they aren't in the
+                        directory, such as those of extracted images the
+                        user has deleted but that haven't been removed from
+                        Gmail yet
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.taken = list_names(path) | set(reserved)
+        # The next index to try for each requested file name, so that
+        # repeated requests for the same name don't check every earlier
+        # suffix again
+        self.next_index = {}
+
+    def allocate(self, filename):
+        """Returns a version of the given filename that is unique in the
+        directory, and reserves it so it won't be handed out again.
+
+        Args:
+            filename -- a potential filename to try in the directory
+
+        Returns:
+            A filename that is not currently used in the directory
+        """
+        with self.lock:
+            if filename not in self.taken:
+                self.taken.add(filename)
+                return filename
+
+            base_filename, extension = _split_extension(filename)
+            index = self.next_index.get(filename, 2)
+            candidate = u"{0} - {1}{2}".format(base_filename, index, extension)
+            while candidate in self.taken:
+                index += 1
+                candidate = u"{0} - {1}{2}".format(base_filename, index, extension)
+            self.next_index[filename] = index + 1
+            self.taken.add(candidate)
+            return candidate
+
+
+class AtomicFile(object):
+    """A file that is written to a temporary file in the same directory, and
+    only moved into place, replacing anything already there, once it has
+    been completely written.
+    """
+
+    def __init__(self, path, filename):
+        """
+        Args:
+            path     -- a directory path
+            filename -- the name the file should have in the directory once
+                        it has been completely written
+        """
+        self.path = os.path.join(path, filename)
+        fd, self.temp_path = tempfile.mkstemp(dir=path, prefix=PARTIAL_PREFIX,
+                                              suffix=PARTIAL_SUFFIX)
+        # mkstemp() only lets the owner read the file, but once in place it
+        # should have the same permissions as any other new file
+        os.fchmod(fd, 0o666 & ~_UMASK)
+        self.handle = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self.handle.write(data)
 
-    index = 2
-    while os.path.isfile(os.path.join(path, u"{0} - {1}{2}".format(base_filename, index, extension))):
-        index += 1
+    def commit(self):
+        """Moves the written file into place."""
+        self.handle.close()
+        os.rename(self.temp_path, self.path)
 
-    return u"{0} - {1}{2}".format(base_filename, index, extension)
+    def discard(self):
+        """Throws away anything written to the file."""
+        self.handle.close()
+        os.remove(self.temp_path)
@@ -0,0 +1,498 @@
+"""Access to Gmail over IMAP, using the Gmail IMAP extensions (X-GM-RAW,
+X-GM-MSGID and X-GM-LABELS) to search for messages, fetch single MIME parts
+of them, and write altered versions of them back.
+"""
+
+import imaplib
+import re
+import time
+from .metrics import Metrics
+from .throttle import Backoff
+
+GMAIL_HOST = "imap.gmail.com"
+GMAIL_PORT = 993
+
+# Number of message UIDs to include in a single FETCH command, so that
+# command lines stay a reasonable length.
+FETCH_CHUNK = 500
+
+# Number of gmail ids to look up with a single SEARCH command
+SEARCH_CHUNK = 50
+
+# Gmail labels that describe where a message came from, and can't be
+# applied to a message by a client
+SYSTEM_LABELS = (u"\\sent", u"\\draft")
+
+APPENDUID_RE = re.compile(r"\[APPENDUID \d+ (\d+)\]")
+
+# Header given to each message the extractor appends, holding a value
+# unique to it, so that it can be found again if it isn't known whether
+# the APPEND arrived
+TOKEN_HEADER = "X-Gmail-Image-Extractor-Token"
+
+# Response codes Gmail sends when it wants a client to slow down
+THROTTLED_RE = re.compile(r"\[(THROTTLED|UNAVAILABLE)\]", re.I)
+
+
+class Throttled(imaplib.IMAP4.abort):
+    """Raised when Gmail refuses a command because too many have been sent
+    too quickly.
+    """
+    pass
+
+
+def quote(value):
+    """Returns the given string as an IMAP quoted string."""
+    return u'"{0}"'.format(value.replace(u"\\", u"\\\\").replace(u'"', u'\\"'))
+
+
+def uid_set(uids):
+    """Returns a compact IMAP sequence set (ex "1:4,7,9:10") describing the
+    given UIDs.
+    """
+    uids = sorted(set(int(uid) for uid in uids))
+    ranges = []
+    for uid in uids:
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(a) if a == b else "{0}:{1}".format(a, b) for a, b in ranges)
+
+
+def chunks(items, size):
+    """Yields successive lists of at most `size` items from `items`."""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class ParseError(Exception):
+    pass
+
+
+class Quoted(str):
+    """A string that was sent as an IMAP quoted string or literal, as
+    opposed to an atom.
+    """
+    pass
+
+
+def _tokenize(text, tokens):
+    """Breaks a fragment of an IMAP response into tokens, appending them to
+    `tokens`.  Parentheses are returned as the strings "(" and ")", quoted
+    strings as `Quoted` instances, NIL as None, and everything else as a
+    plain string atom.
+    """
+    i = 0
+    length = len(text)
+    while i < length:
+        c = text[i]
+        if c in " \r\n":
+            i += 1
+        elif c in "()":
+            tokens.append(c)
+            i += 1
+        elif c == '"':
+            i += 1
+            chars = []
+            while i < length and text[i] != '"':
+                if text[i] == "\\":
+                    i += 1
+                chars.append(text[i])
+                i += 1
+            tokens.append(Quoted("".join(chars)))
+            i += 1
+        else:
+            start = i
+            # Atoms like BODY[HEADER.FIELDS (SUBJECT)]<0> can contain
+            # spaces and parentheses between their brackets
+            while i < length and text[i] not in " ()\r\n":
+                if text[i] == "[":
+                    i = text.index("]", i)
+                i += 1
+            atom = text[start:i]
+            tokens.append(None if atom.upper() == "NIL" else atom)
+
+
+def tokenize(data):
+    """Tokenizes a response as returned by imaplib, where literals are
+    given as (prefix, literal) tuples.
+    """
+    tokens = []
+    for item in data:
+        if item is None:
+            continue
+        if isinstance(item, tuple):
+            prefix, literal = item
+            _tokenize(prefix[:prefix.rindex("{")], tokens)
+            tokens.append(Quoted(literal))
+        else:
+            _tokenize(item, tokens)
+    return tokens
+
+
+def parse(data):
+    """Parses an imaplib response into nested lists."""
+    stack = [[]]
+    for token in tokenize(data):
+        if token == "(" and not isinstance(token, Quoted):
+            stack.append([])
+        elif token == ")" and not isinstance(token, Quoted):
+            if len(stack) == 1:
+                raise ParseError("Unbalanced parentheses in IMAP response")
+            finished = stack.pop()
+            stack[-1].append(finished)
+        else:
+            stack[-1].append(token)
+    if len(stack) != 1:
+        raise ParseError("Unbalanced parentheses in IMAP response")
+    return stack[0]
+
+
+def parse_fetch(data):
+    """Parses the data returned from a FETCH command into a list of dicts,
+    one per message, mapping each returned (upper cased) item name to its
+    value.
+    """
+    messages = []
+    values = parse(data)
+    for i in range(1, len(values), 2):
+        attrs = values[i]
+        messages.append(dict((attrs[j].upper(), attrs[j + 1])
+                             for j in range(0, len(attrs) - 1, 2)))
+    return messages
+
+
+def literal_size(data):
+    """Returns the number of bytes of message data in an imaplib response."""
+    return sum(len(item[1]) for item in data if isinstance(item, tuple))
+
+
+class GmailConnection(object):
+    """A single authenticated IMAP connection to a Gmail account, with the
+    account's "All Mail" folder selected.
+    """
+
+    def __init__(self, email, password, host=GMAIL_HOST, port=GMAIL_PORT, use_ssl=True,
+                 metrics=None, backoff=None, rate=None):
+        """
+        Args:
+            email    -- the username of the Gmail account to connect to
+            password -- the password of the Gmail account to connect to
+
+        Keyword Args:
+            host    -- the IMAP server to connect to
+            port    -- the port the IMAP server listens on
+            use_ssl -- whether to connect over SSL.  Gmail requires it, but
+                       servers standing in for Gmail, such as the one used
+                       by the benchmarks, may not support it.
+            metrics -- an optional metrics.Metrics to record the number and
+                       duration of each kind of IMAP command in, as timers
+                       named "imap.<command>", and the bytes of message data
+                       received, as the "imap.bytes_fetched" counter
+            backoff -- a throttle.Backoff describing how long to wait before
+                       reconnecting and sending a command again, when the
+                       connection drops or Gmail throttles it.  Defaults to
+                       Backoff(); Backoff(attempts=0) turns retrying off.
+            rate    -- an optional throttle.RateLimit, shared with other
+                       connections, capping the bandwidth used for message
+                       data fetched and appended
+        """
+        self.email = email
+        self.password = password
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.metrics = metrics or Metrics()
+        self.backoff = backoff or Backoff()
+        self.rate = rate
+        self.conn = None
+        self.mailboxes = {}
+        self.uidvalidity = None
+        # Total number of bytes of message data received over this
+        # connection
+        self.bytes_fetched = 0
+        # Number of times a command had to be sent again, because the
+        # connection dropped or was throttled
+        self.retries = 0
+        self.connecting = False
+
+    def connect(self):
+        """Logs in to Gmail, finds the special-use mailboxes of the account
+        and selects the "All Mail" mailbox.  Messages are only ever read with
+        BODY.PEEK, so selecting the mailbox for writing doesn't mark
+        anything as read.
+
+        Returns:
+            A boolean description of whether we were able to connect and
+            log in with the current parameters.
+        """
+        # Commands sent while connecting aren't retried one by one, the
+        # whole connection is
+        self.connecting = True
+        try:
+            return self._connect()
+        except (imaplib.IMAP4.error, IOError):
+            self.conn = None
+            return False
+        finally:
+            self.connecting = False
+
+    def _connect(self):
+        imap_class = imaplib.IMAP4_SSL if self.use_ssl else imaplib.IMAP4
+        with self.metrics.timer(u"imap.connect"):
+            self.conn = imap_class(self.host, self.port)
+        self._command("login", "login", self.email, self.password)
+
+        typ, data = self._command("list", "list")
+        self.mailboxes = {}
+        for flags, delim, name in self._list_entries(data):
+            for flag in flags:
+                self.mailboxes[flag.lower()] = name
+
+        if u"\\all" not in self.mailboxes:
+            return False
+        if u"\\trash" not in self.mailboxes:
+            return False
+        typ, data = self._command("select", "select", quote(self.mailboxes[u"\\all"]))
+        if typ != "OK":
+            return False
+        self.uidvalidity = self.conn.response("UIDVALIDITY")[1][0]
+        return True
+
+    def _list_entries(self, data):
+        values = parse(data)
+        for i in range(0, len(values) - 2, 3):
+            yield values[i], values[i + 1], values[i + 2]
+
+    def _command(self, name, method, *args, **kwargs):
+        """Sends an IMAP command by calling the given method of the imaplib
+        connection with the given arguments, timing it with the
+        "imap.<name>" timer.
+
+        If the connection drops, or Gmail throttles it, this reconnects,
+        waiting longer before each attempt, and sends the command again, so
+        that the caller carries on from the command that failed.
+
+        Keyword Args:
+            sent -- an optional function, called after reconnecting, that
+                    returns a boolean description of whether the command
+                    took effect before the connection dropped, in which case
+                    it isn't sent again
+
+        Returns:
+            The type and data of the response, as returned by imaplib, or
+            None if `sent` found the command had already taken effect.
+        """
+        sent = kwargs.get("sent")
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                typ, data = getattr(self.conn, method)(*args)
+                if typ == "NO" and THROTTLED_RE.search(" ".join(str(d) for d in data if d)):
+                    raise Throttled(data)
+                return typ, data
+            except (imaplib.IMAP4.abort, IOError) as e:
+                attempt += 1
+                if self.connecting or attempt > self.backoff.attempts:
+                    raise
+                self.retries += 1
+                self.metrics.incr(u"imap.retries")
+                if isinstance(e, Throttled):
+                    self.metrics.incr(u"imap.throttled")
+                self._reconnect(attempt, e)
+                if sent is not None and sent():
+                    return None
+            finally:
+                self.metrics.record(u"imap." + name, time.time() - start)
+
+    def _reconnect(self, attempt, error):
+        """Waits, and then reconnects after a command failed, trying again
+        with longer waits until the connection is back or the backoff's
+        attempts are used up, in which case `error` is re-raised.
+        """
+        uidvalidity = self.uidvalidity
+        while True:
+            time.sleep(self.backoff.delay(attempt))
+            self.close()
+            self.metrics.incr(u"imap.reconnects")
+            if self.connect():
+                break
+            attempt += 1
+            if attempt > self.backoff.attempts:
+                raise error
+        # The UIDs the caller is working with mean nothing if the mailbox's
+        # UIDVALIDITY changed while we were away
+        if self.uidvalidity != uidvalidity:
+            raise imaplib.IMAP4.error("UIDVALIDITY changed while reconnecting")
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                with self.metrics.timer(u"imap.logout"):
+                    self.conn.logout()
+            except (imaplib.IMAP4.error, IOError):
+                pass
+            self.conn = None
+
+    def search(self, query, min_uid=1):
+        """Returns the UIDs, in ascending order, of every message in
+        "All Mail" matching the given Gmail search query.
+
+        Keyword Args:
+            min_uid -- only return messages with at least this UID
+        """
+        typ, data = self._command("search", "uid", "SEARCH",
+                                  "UID", "{0}:*".format(min_uid),
+                                  "X-GM-RAW", quote(query).encode("utf-8"))
+        if typ != "OK":
+            raise imaplib.IMAP4.error(data)
+        # A UID range of "n:*" always matches the newest message, even
+        # when its UID is less than n
+        return sorted(int(uid) for uid in " ".join(d for d in data if d).split()
+                      if int(uid) >= min_uid)
+
+    def fetch(self, uids, items):
+        """Fetches the given items for each of the given messages.
+
+        Args:
+            uids  -- an iterable of message UIDs
+            items -- an IMAP FETCH item list, such as "(X-GM-MSGID FLAGS)"
+
+        Returns:
+            A dict mapping each UID to a dict of the returned items
+        """
+        uids = list(uids)
+        results = {}
+        for chunk in chunks(uids, FETCH_CHUNK):
+            typ, data = self._command("fetch", "uid", "FETCH", uid_set(chunk), items)
+            if typ != "OK":
+                raise imaplib.IMAP4.error(data)
+            size = literal_size(data)
+            self.bytes_fetched += size
+            self.metrics.incr(u"imap.bytes_fetched", size)
+            if self.rate is not None:
+                self.rate.consume(size)
+            for attrs in parse_fetch(data):
+                if "UID" in attrs:
+                    results[int(attrs["UID"])] = attrs
+        return results
+
+    def fetch_part(self, uid, section, size, chunk_size):
+        """Yields the (still transfer encoded) contents of a single MIME part
+        of a message, a piece at a time, so that no more than `chunk_size`
+        bytes of it need to be held in memory at once.
+
+        Args:
+            uid        -- the UID of the message to fetch from
+            section    -- the section specifier of the part, ex "2"
+            size       -- the size of the part, as given in its BODYSTRUCTURE
+            chunk_size -- the maximum number of bytes to fetch at a time
+        """
+        offset = 0
+        while offset < size:
+            key = "BODY[{0}]<{1}>".format(section, offset)
+            attrs = self.fetch([uid], "(BODY.PEEK[{0}]<{1}.{2}>)".format(section, offset, chunk_size))
+            data = attrs.get(uid, {}).get(key)
+            if not data:
+                break
+            offset += len(data)
+            yield data
+
+    def find_gm_ids(self, gm_ids):
+        """Returns the UIDs, in "All Mail", of the messages with any of the
+        given gmail ids.  Messages that no longer exist are left out.
+        """
+        uids = []
+        for chunk in chunks(list(gm_ids), SEARCH_CHUNK):
+            criteria = ["OR"] * (len(chunk) - 1)
+            for gm_id in chunk:
+                criteria.extend(("X-GM-MSGID", str(gm_id)))
+            typ, data = self._command("search", "uid", "SEARCH", *criteria)
+            if typ != "OK":
+                raise imaplib.IMAP4.error(data)
+            uids.extend(int(uid) for uid in " ".join(d for d in data if d).split())
+        return uids
+
+    def find_token(self, token):
+        """Returns the UID, in "All Mail", of the message whose TOKEN_HEADER
+        header has the given value, or None if there isn't one.
+        """
+        typ, data = self._command("search", "uid", "SEARCH",
+                                  "HEADER", TOKEN_HEADER, quote(token))
+        if typ != "OK":
+            raise imaplib.IMAP4.error(data)
+        uids = [int(uid) for uid in " ".join(d for d in data if d).split()]
+        return max(uids) if uids else None
+
+    def append(self, message, flags, internaldate, token=None):
+        """Adds a message to "All Mail".
+
+        Args:
+            message      -- the full text of the message
+            flags        -- a list of IMAP flags to give the message
+            internaldate -- the date the message was received, as returned in
+                            the INTERNALDATE item of a FETCH
+
+        Keyword Args:
+            token -- the value of the message's TOKEN_HEADER header, if it
+                     has one (see mime.add_header())
+
+        If the connection drops while the message is being sent, it is sent
+        again once reconnected.  When the message has a token, Gmail is
+        searched for it first, so that a message that did arrive isn't
+        added twice.  Without one, two copies of it can be left in Gmail.
+
+        Returns:
+            The UID of the new message.
+        """
+        flags = [flag for flag in flags if flag.lower() != "\\recent"]
+        if self.rate is not None:
+            self.rate.consume(len(message))
+        found = []
+
+        def _sent():
+            found.append(self.find_token(token))
+            return found[-1] is not None
+
+        response = self._command("append", "append",
+                                 quote(self.mailboxes[u"\\all"]),
+                                 u"({0})".format(u" ".join(flags)),
+                                 '"{0}"'.format(internaldate), message,
+                                 sent=_sent if token is not None else None)
+        if response is None:
+            self.metrics.incr(u"imap.appends_found")
+            return found[-1]
+        typ, data = response
+        match = APPENDUID_RE.search(" ".join(d for d in data if d)) if typ == "OK" else None
+        if match is None:
+            raise imaplib.IMAP4.error(data)
+        return int(match.group(1))
+
+    def _store_labels(self, uids, action, labels):
+        labels = [label for label in labels if label.lower() not in SYSTEM_LABELS]
+        if not labels:
+            return
+        # Labels that are already quoted, such as the default "sync" label,
+        # are sent as is
+        quoted = [label if label.startswith(u'"') else quote(label) for label in labels]
+        typ, data = self._command("store", "uid", "STORE", uid_set(uids), action,
+                                  u"({0})".format(u" ".join(quoted)).encode("utf-8"))
+        if typ != "OK":
+            raise imaplib.IMAP4.error(data)
+
+    def add_labels(self, uids, labels):
+        """Applies the given Gmail labels to the given messages."""
+        self._store_labels(uids, "+X-GM-LABELS", labels)
+
+    def remove_labels(self, uids, labels):
+        """Removes the given Gmail labels from the given messages."""
+        self._store_labels(uids, "-X-GM-LABELS", labels)
+
+    def trash(self, uids):
+        """Moves the given messages to the account's trash."""
+        typ, data = self._command("copy", "uid", "COPY", uid_set(uids),
+                                  quote(self.mailboxes[u"\\trash"]))
+        if typ != "OK":
+            raise imaplib.IMAP4.error(data)
@@ -0,0 +1,243 @@
+"""Keeps track of the extraction jobs of several users at once, so that a
+single process can serve many of them without one user's job getting in the
+way of another's.
+"""
+
+import collections
+import threading
+import time
+import uuid
+from .pool import ConnectionBudget
+
+
+class Job(object):
+    """One user's extractor, and the progress messages sent about it.
+
+    Each step of the job (connecting, extracting, syncing) runs in its own
+    thread.  Messages about the job are sent to whichever client is
+    attached to it, and the latest message of each type is kept, so that a
+    client that reconnects can be brought up to date.
+    """
+
+    def __init__(self, job_id, key, extractor, manager):
+        self.id = job_id
+        # What the job is for, such as the email address of the account
+        self.key = key
+        self.extractor = extractor
+        self.manager = manager
+        self.lock = threading.Lock()
+        self.listener = None
+        self.latest = collections.OrderedDict()
+        self.thread = None
+        self.touched = time.time()
+        # Set by JobManager.authenticate() once the job's login succeeds
+        self.authenticated = False
+
+    def attach(self, listener):
+        """Sends every message about the job to `listener` from now on,
+        in place of any client attached before, starting with the latest
+        message of each type sent so far.
+        """
+        with self.lock:
+            self.listener = listener
+            self.touched = time.time()
+            for message in self.latest.values():
+                listener(message)
+
+    def detach(self, listener):
+        """Stops sending messages to `listener`, if it is still attached."""
+        with self.lock:
+            if self.listener == listener:
+                self.listener = None
+            self.touched = time.time()
+
+    def attached(self):
+        return self.listener is not None
+
+    def send(self, message):
+        """Sends a message about the job to the attached client, if there is
+        one.  Can be called from any thread.
+
+        Args:
+            message -- a dict, with a "type" key
+        """
+        with self.lock:
+            self.latest.pop(message["type"], None)
+            self.latest[message["type"]] = message
+            self.touched = time.time()
+            if self.listener is not None:
+                self.listener(message)
+
+    def busy(self):
+        """Returns a boolean description of whether a step of the job is
+        running, or waiting to run.
+        """
+        return self.thread is not None and self.thread.is_alive()
+
+    def run(self, func, waiting=None, prepare=None):
+        """Runs a step of the job in a thread of its own, once the manager
+        has a free slot for it.
+
+        Args:
+            func -- called, with no arguments, to run the step
+
+        Keyword Args:
+            waiting -- an optional message to send if the step has to wait
+                       for other jobs to finish first
+            prepare -- an optional function called, with no arguments, in
+                       the step's thread before it takes a slot, for work
+                       that may wait on other jobs, such as taking
+                       connections from the budget.  If it returns a false
+                       value the step isn't run.
+
+        Returns:
+            False if another step of the job is still running, and True
+            otherwise.
+        """
+        if self.busy():
+            return False
+
+        def _step():
+            # Waiting for anything while holding a slot could leave every
+            # slot waiting on jobs that need a slot to make progress
+            if prepare is not None and not prepare():
+                return
+            slots = self.manager.slots
+            if not slots.acquire(False):
+                if waiting is not None:
+                    self.send(waiting)
+                slots.acquire()
+            try:
+                func()
+            finally:
+                slots.release()
+                self.touched = time.time()
+
+        self.thread = threading.Thread(target=_step)
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def close(self):
+        self.extractor.close()
+
+
+class JobManager(object):
+    """Keeps every job being worked on, limiting how many run at once and
+    how many connections they have open to each host between them.
+    """
+
+    def __init__(self, max_running=4, connections_per_host=16, idle_timeout=3600):
+        """
+        Keyword Args:
+            max_running          -- the most job steps that run at once,
+                                    any more wait their turn
+            connections_per_host -- the most IMAP connections all jobs have
+                                    open to the same host
+            idle_timeout         -- the number of seconds a job with no
+                                    client attached, and nothing running,
+                                    is kept before being dropped by expire()
+        """
+        self.slots = threading.Semaphore(max_running)
+        self.connections_per_host = connections_per_host
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.budgets = {}
+
+    def budget(self, host):
+        """Returns the ConnectionBudget shared by every job connecting to
+        the given host.
+        """
+        with self.lock:
+            if host not in self.budgets:
+                self.budgets[host] = ConnectionBudget(self.connections_per_host)
+            return self.budgets[host]
+
+    def add(self, key, extractor):
+        """Starts keeping track of a new job.  Any job already kept for the
+        same key is left alone until the new job is authenticated.
+
+        Args:
+            key       -- what the job is for, such as an email address.  Only
+                         one authenticated job is kept for each key.
+            extractor -- the GmailImageExtractor doing the job's work
+
+        Returns:
+            The new Job, or None if a job with the same key is still
+            running.
+        """
+        with self.lock:
+            old = self.find(key)
+            if old is not None and old.busy():
+                return None
+            job = Job(uuid.uuid4().hex, key, extractor, self)
+            self.jobs[job.id] = job
+        return job
+
+    def authenticate(self, job):
+        """Records that a job's login succeeded, so it takes the place of
+        any earlier job for the same key.  Until then, a job can't replace
+        another, so a wrong password can't end someone else's job.
+
+        Returns:
+            False if the earlier job for the same key is still running, in
+            which case the new job should be removed, and True otherwise.
+        """
+        with self.lock:
+            old = self.find(job.key)
+            if old is not None:
+                if old.busy():
+                    return False
+                del self.jobs[old.id]
+            job.authenticated = True
+        if old is not None:
+            self._close(old)
+        return True
+
+    def get(self, job_id):
+        """Returns the authenticated job with the given id, or None if there
+        is none.  Jobs whose login hasn't succeeded yet are never returned,
+        as their extractor already holds the account's images and manifest.
+        """
+        job = self.jobs.get(job_id)
+        if job is None or not job.authenticated:
+            return None
+        return job
+
+    def find(self, key):
+        """Returns the authenticated job kept for the given key, or None if
+        there is none.
+        """
+        for job in self.jobs.values():
+            if job.key == key and job.authenticated:
+                return job
+        return None
+
+    def remove(self, job):
+        with self.lock:
+            self.jobs.pop(job.id, None)
+        self._close(job)
+
+    def _close(self, job):
+        """Closes a job in a thread of its own, as logging out of Gmail and
+        stopping the deletion watcher take a while, and this is called from
+        the web app's IOLoop.
+        """
+        thread = threading.Thread(target=job.close)
+        thread.daemon = True
+        thread.start()
+
+    def expire(self):
+        """Drops every job that has had no client attached, and nothing
+        running, for longer than the idle timeout.
+
+        Returns:
+            The number of jobs dropped.
+        """
+        cutoff = time.time() - self.idle_timeout
+        expired = [job for job in self.jobs.values()
+                   if not job.attached() and not job.busy() and job.touched < cutoff]
+        for job in expired:
+            self.remove(job)
+        return len(expired)
@@ -0,0 +1,246 @@
+"""Durable record of the work done by the gmail image extractor, stored as a
+SQLite database in the same directory the images are extracted to.  This lets
+a later process pick up where an earlier one stopped, both to avoid
+downloading messages a second time and to sync deletions back to Gmail
+without having to re-extract first.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+
+MANIFEST_NAME = u".gmail-image-extractor.sqlite"
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )""",
+    # Every message that has been completely processed, whether or not
+    # any images were found in it, so that it is never fetched again.
+    """CREATE TABLE IF NOT EXISTS messages (
+        gm_id TEXT PRIMARY KEY,
+        subject TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS images (
+        fname TEXT PRIMARY KEY,
+        gm_id TEXT NOT NULL,
+        sha1 TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS images_gm_id ON images (gm_id)",
+    # Journal of the messages being rewritten by a sync, written ahead of
+    # each change to Gmail, so an interrupted sync can be picked up again.
+    # A rewrite is "planned" before the altered message is sent to Gmail,
+    # "saved" once it is there (with its UID, and gmail id once known),
+    # and "done" once the original is dealt with and the images recorded
+    # as removed.  The token is the value of the altered message's
+    # imap.TOKEN_HEADER header, by which it can be found in Gmail.
+    """CREATE TABLE IF NOT EXISTS rewrites (
+        gm_id TEXT PRIMARY KEY,
+        state TEXT NOT NULL,
+        fnames TEXT NOT NULL,
+        uidvalidity TEXT,
+        new_uid INTEGER,
+        new_gm_id TEXT,
+        token TEXT
+    )""",
+)
+
+# Columns added to tables after they were first created, which manifests
+# written by earlier versions are given when opened
+COLUMNS = (
+    ("rewrites", "token", "TEXT"),
+)
+
+
+class Manifest(object):
+    """Records which Gmail messages have been processed, and which file on
+    disk each extracted image was written to.
+    """
+
+    def __init__(self, dest, name=MANIFEST_NAME):
+        """
+        Args:
+            dest -- the directory extracted images are written to, and
+                    where the manifest database will be stored.
+
+        Keyword Args:
+            name -- the file name of the manifest database in `dest`.
+        """
+        self.path = os.path.join(dest, name)
+        # The manifest is shared between the threads extracting messages,
+        # so access to the database is serialized
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self.conn:
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+            for table, column, column_type in COLUMNS:
+                existing = [row[1] for row in self.conn.execute("PRAGMA table_info({0})".format(table))]
+                if column not in existing:
+                    self.conn.execute("ALTER TABLE {0} ADD COLUMN {1} {2}".format(
+                        table, column, column_type))
+
+    def get(self, key, default=None):
+        """Returns a value stored in the manifest's key-value table, or
+        `default` if no value has been stored for `key`.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?",
+                                    (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set(self, key, value):
+        """Stores a value in the manifest's key-value table."""
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                              (key, unicode(value)))
+
+    def processed_gm_ids(self):
+        """Returns a set of the gmail ids (as strings) of every message that
+        has been completely processed.
+        """
+        with self.lock:
+            return set(row[0] for row in self.conn.execute("SELECT gm_id FROM messages"))
+
+    def add_message(self, gm_id, subject, images):
+        """Records that a message has been completely processed.
+
+        The message and all of its images are written in a single
+        transaction, so a message is never recorded as processed unless all
+        of its images were recorded too.
+
+        Args:
+            gm_id   -- the gmail id of the processed message
+            subject -- the subject of the processed message
+            images  -- an iterable of (file name, sha1 hash) pairs, one for
+                       each image extracted from the message.
+
+        raise:
+            ValueError -- If any of the file names is already recorded for
+                          another image, in which case nothing is recorded.
+                          Replacing it would lose track of the other image.
+        """
+        gm_id = unicode(gm_id)
+        try:
+            with self.lock, self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO messages (gm_id, subject) VALUES (?, ?)",
+                                  (gm_id, subject))
+                self.conn.executemany("INSERT INTO images (fname, gm_id, sha1) VALUES (?, ?, ?)",
+                                      ((fname, gm_id, a_hash) for fname, a_hash in images))
+        except sqlite3.IntegrityError as e:
+            raise ValueError("Image file name already recorded: {0}".format(e))
+
+    def remove_images(self, fnames):
+        """Forgets about images, such as once they have been removed from
+        their message in Gmail.
+        """
+        with self.lock, self.conn:
+            self._remove_images(fnames)
+
+    def _remove_images(self, fnames):
+        # Leaves committing to the caller
+        self.conn.executemany("DELETE FROM images WHERE fname = ?",
+                              ((fname,) for fname in fnames))
+
+    def replace_message(self, gm_id, new_gm_id, keep_images=True):
+        """Records that a message was rewritten in Gmail, with the rewritten
+        version having the gmail id `new_gm_id`.  The rewritten version is
+        marked as processed, so it isn't extracted again.
+
+        Keyword Args:
+            keep_images -- whether the images recorded for the original
+                           message now belong to the rewritten version
+        """
+        with self.lock, self.conn:
+            self._replace_message(gm_id, new_gm_id, keep_images)
+
+    def _replace_message(self, gm_id, new_gm_id, keep_images):
+        # Leaves committing to the caller
+        gm_id = unicode(gm_id)
+        new_gm_id = unicode(new_gm_id)
+        self.conn.execute("""INSERT OR REPLACE INTO messages (gm_id, subject)
+                             SELECT ?, subject FROM messages WHERE gm_id = ?""",
+                          (new_gm_id, gm_id))
+        if keep_images:
+            self.conn.execute("UPDATE images SET gm_id = ? WHERE gm_id = ?",
+                              (new_gm_id, gm_id))
+
+    def plan_rewrite(self, gm_id, fnames, token=None):
+        """Records that a message is about to be rewritten, with the images
+        saved as the given files removed from it, and the given token
+        identifying the altered version.
+        """
+        with self.lock, self.conn:
+            self.conn.execute("""INSERT OR REPLACE INTO rewrites (gm_id, state, fnames, token)
+                                 VALUES (?, 'planned', ?, ?)""",
+                              (unicode(gm_id), json.dumps(list(fnames)), token))
+
+    def rewrite_saved(self, gm_id, uidvalidity, new_uid, new_gm_id=None):
+        """Records that the rewritten version of a message has been saved
+        to Gmail, in "All Mail" with the given UIDVALIDITY and UID, and,
+        once known, the given gmail id.
+        """
+        with self.lock, self.conn:
+            self.conn.execute("""UPDATE rewrites SET state = 'saved', uidvalidity = ?,
+                                 new_uid = ?, new_gm_id = ? WHERE gm_id = ?""",
+                              (unicode(uidvalidity), new_uid,
+                               None if new_gm_id is None else unicode(new_gm_id),
+                               unicode(gm_id)))
+
+    def finish_rewrite(self, gm_id, new_gm_id, keep_images=True):
+        """Records that a message has been completely rewritten: the
+        rewritten version is recorded as processed (see replace_message())
+        and the images removed from it are forgotten.  All of this is
+        committed in a single transaction with the rewrite being marked
+        done, so none of it is recorded if the process stops part way.
+        """
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT fnames FROM rewrites WHERE gm_id = ?",
+                                    (unicode(gm_id),)).fetchone()
+            self._replace_message(gm_id, new_gm_id, keep_images)
+            if row is not None:
+                self._remove_images(json.loads(row[0]))
+            self.conn.execute("UPDATE rewrites SET state = 'done' WHERE gm_id = ?",
+                              (unicode(gm_id),))
+
+    def cancel_rewrite(self, gm_id):
+        """Forgets an unfinished rewrite of a message, so that it is started
+        over.
+        """
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM rewrites WHERE gm_id = ? AND state != 'done'",
+                              (unicode(gm_id),))
+
+    def unfinished_rewrites(self):
+        """Returns a dict mapping the gmail id of every message whose rewrite
+        was started but not finished to a dict describing how far it got,
+        with the keys "state", "fnames", "uidvalidity", "new_uid",
+        "new_gm_id" and "token".
+        """
+        with self.lock:
+            rows = self.conn.execute("""SELECT gm_id, state, fnames, uidvalidity, new_uid,
+                                               new_gm_id, token
+                                        FROM rewrites WHERE state != 'done'""").fetchall()
+        return dict((gm_id, {"state": state,
+                             "fnames": json.loads(fnames),
+                             "uidvalidity": uidvalidity,
+                             "new_uid": new_uid,
+                             "new_gm_id": new_gm_id,
+                             "token": token})
+                    for gm_id, state, fnames, uidvalidity, new_uid, new_gm_id, token in rows)
+
+    def mapping(self):
+        """Returns a dict in the same format as GmailImageExtractor.mapping,
+        built from every image recorded in the manifest.
+        """
+        with self.lock:
+            rows = self.conn.execute("""SELECT i.fname, i.gm_id, i.sha1, m.subject
+                                        FROM images AS i
+                                        LEFT JOIN messages AS m ON i.gm_id = m.gm_id""").fetchall()
+        return dict((fname, (gm_id, a_hash, subject)) for fname, gm_id, a_hash, subject in rows)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
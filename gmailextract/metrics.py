@@ -0,0 +1,100 @@
+"""Counters and timers recording where the time and bytes go while
+extracting images and syncing messages, such as how many IMAP commands of
+each kind were sent and how long they took.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics(object):
+    """A set of named counters and timers, which can be updated from any
+    thread.
+
+    Counters are numbers that are added to, such as the number of bytes
+    fetched.  Timers record how many times something happened and how long
+    it took, such as each IMAP FETCH command.
+    """
+
+    def __init__(self, parent=None):
+        """
+        Keyword Args:
+            parent -- an optional Metrics that every update is also made to,
+                      for keeping totals across several extractors
+        """
+        self.parent = parent
+        self.lock = threading.Lock()
+        self.counters = {}
+        # Maps each timer's name to a list of the number of times it was
+        # recorded, the total seconds and the longest time recorded
+        self.timers = {}
+
+    def incr(self, name, amount=1):
+        """Adds `amount` to the counter called `name`."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+        if self.parent is not None:
+            self.parent.incr(name, amount)
+
+    def record(self, name, seconds):
+        """Records that something timed by the timer called `name` took
+        `seconds` seconds.
+        """
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+        if self.parent is not None:
+            self.parent.record(name, seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """Times the body of a with statement with the timer called
+        `name`.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def snapshot(self):
+        """Returns a dict with the current value of every counter, under the
+        "counters" key, and of every timer, under the "timers" key.  Each
+        timer is a dict of its "count", and "total", "mean" and "max" times
+        in seconds.
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            timers = dict((name, {"count": count,
+                                  "total": total,
+                                  "mean": total / count,
+                                  "max": longest})
+                          for name, (count, total, longest) in self.timers.items())
+        return {"counters": counters, "timers": timers}
+
+    def summary(self):
+        """Returns a plain text table of every counter and timer."""
+        snapshot = self.snapshot()
+        lines = []
+        if snapshot["timers"]:
+            row = u"{0:<32} {1:>8} {2:>10} {3:>10} {4:>10}"
+            lines.append(row.format(u"timer", u"count", u"total (s)", u"mean (ms)", u"max (ms)"))
+            for name, timer in sorted(snapshot["timers"].items()):
+                lines.append(row.format(name, timer["count"],
+                                        u"{0:.2f}".format(timer["total"]),
+                                        u"{0:.1f}".format(timer["mean"] * 1000),
+                                        u"{0:.1f}".format(timer["max"] * 1000)))
+        if snapshot["counters"]:
+            if lines:
+                lines.append(u"")
+            row = u"{0:<32} {1:>14}"
+            lines.append(row.format(u"counter", u"value"))
+            for name, value in sorted(snapshot["counters"].items()):
+                lines.append(row.format(name, value))
+        return u"\n".join(lines)
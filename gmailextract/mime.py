@@ -0,0 +1,225 @@
+"""Functions for working with the MIME structure of messages, as described
+by the IMAP BODYSTRUCTURE of a message, without having to download the
+message itself, and for removing attachments from downloaded messages.
+"""
+
+import base64
+import email
+import email.generator
+import email.header
+import email.utils
+import hashlib
+import quopri
+import urllib
+from cStringIO import StringIO
+
+
+class Part(object):
+    """A single, non-multipart, MIME part of a message."""
+
+    def __init__(self, section, type, params, encoding, size, disposition):
+        # The IMAP section specifier of the part, ex "2" or "1.3"
+        self.section = section
+        # The lower cased content type of the part, ex "image/jpeg"
+        self.type = type
+        self.params = params
+        self.encoding = encoding
+        # The size of the part, in its transfer encoding
+        self.size = size
+        self.disposition = disposition
+
+    def name(self):
+        """Returns the file name of the part, as advertised in either its
+        Content-Disposition or Content-Type headers, or an empty string if
+        neither give one.
+        """
+        disp_params = self.disposition[1] if self.disposition else {}
+        for params, key in ((disp_params, "filename"), (self.params, "name")):
+            if key in params:
+                return decode_header(params[key])
+            if key + "*" in params:
+                charset, language, value = email.utils.decode_rfc2231(params[key + "*"])
+                return email.utils.collapse_rfc2231_value(
+                    (charset, language, urllib.unquote(value)))
+        return u""
+
+
+def _params(values):
+    """Returns a dict of the lower cased keys and values from an IMAP
+    parenthesized list of body parameters.
+    """
+    if not values:
+        return {}
+    return dict((values[i].lower(), values[i + 1] or "")
+                for i in range(0, len(values) - 1, 2))
+
+
+def _disposition(value):
+    if not isinstance(value, list) or not value:
+        return None
+    return (value[0] or "").lower(), _params(value[1] if len(value) > 1 else None)
+
+
+def parts(bodystructure, prefix=""):
+    """Returns a list of every non-multipart part described in a parsed
+    BODYSTRUCTURE response.  Messages attached to the message are not
+    descended into.
+    """
+    if isinstance(bodystructure[0], list):
+        found = []
+        index = 1
+        for child in bodystructure:
+            if not isinstance(child, list):
+                break
+            found.extend(parts(child, u"{0}{1}.".format(prefix, index)))
+            index += 1
+        return found
+
+    section = prefix[:-1] if prefix else u"1"
+    main_type = (bodystructure[0] or "").lower()
+    sub_type = (bodystructure[1] or "").lower()
+    # Text and message parts have extra fields (line counts, envelopes)
+    # before their extension data
+    if main_type == "text":
+        disp_index = 9
+    elif main_type == "message" and sub_type == "rfc822":
+        disp_index = 11
+    else:
+        disp_index = 8
+    disposition = bodystructure[disp_index] if len(bodystructure) > disp_index else None
+    return [Part(section, u"{0}/{1}".format(main_type, sub_type),
+                 _params(bodystructure[2]),
+                 (bodystructure[5] or "7bit").lower(),
+                 int(bodystructure[6] or 0),
+                 _disposition(disposition))]
+
+
+def decode_header(value):
+    """Returns a unicode version of a (possibly RFC 2047 encoded) header
+    value.
+    """
+    decoded = []
+    for fragment, charset in email.header.decode_header(value):
+        try:
+            decoded.append(fragment.decode(charset or "ascii", "replace"))
+        except LookupError:
+            decoded.append(fragment.decode("ascii", "replace"))
+    return u"".join(decoded)
+
+
+def subject(header_block):
+    """Returns the decoded subject from a block of message headers."""
+    value = email.message_from_string(header_block or "").get("Subject", "")
+    return decode_header(value.replace("\r\n", "").replace("\n", ""))
+
+
+class Base64Decoder(object):
+    """Decodes base64 encoded data given a piece at a time."""
+
+    def __init__(self):
+        self.pending = ""
+
+    def decode(self, data):
+        data = self.pending + "".join(data.split())
+        usable = len(data) - len(data) % 4
+        self.pending = data[usable:]
+        return base64.b64decode(data[:usable])
+
+    def flush(self):
+        # Be forgiving of messages with missing padding
+        data, self.pending = self.pending, ""
+        if not data:
+            return ""
+        return base64.b64decode(data + "=" * (-len(data) % 4))
+
+
+class QuotedPrintableDecoder(object):
+    """Decodes quoted-printable encoded data given a piece at a time.  Only
+    complete lines are decoded, so that escapes and soft line breaks are
+    never split.
+    """
+
+    def __init__(self):
+        self.pending = ""
+
+    def decode(self, data):
+        data = self.pending + data
+        end = data.rfind("\n") + 1
+        self.pending = data[end:]
+        return quopri.decodestring(data[:end])
+
+    def flush(self):
+        data, self.pending = self.pending, ""
+        return quopri.decodestring(data)
+
+
+class IdentityDecoder(object):
+    """Passes through data sent with the 7bit, 8bit or binary encodings."""
+
+    def decode(self, data):
+        return data
+
+    def flush(self):
+        return ""
+
+
+def decoder(encoding):
+    """Returns an object that can decode a MIME part, sent with the given
+    transfer encoding, a piece at a time through its decode() method,
+    followed by a final call to flush().
+    """
+    if encoding == "base64":
+        return Base64Decoder()
+    elif encoding == "quoted-printable":
+        return QuotedPrintableDecoder()
+    return IdentityDecoder()
+
+
+def remove_parts(raw, hashes):
+    """Removes attachments, identified by the sha1 hashes of their (decoded)
+    contents, from a message.
+
+    Args:
+        raw    -- the full text of a message
+        hashes -- a list of sha1 hashes, as hex strings.  A hash that is
+                  given more than once removes that many attachments with
+                  those contents.
+
+    Returns:
+        Two values, the first being the full text of the altered message,
+        and the second a list of the hashes of the attachments that were
+        removed.
+    """
+    msg = email.message_from_string(raw)
+    remaining = {}
+    for a_hash in hashes:
+        remaining[a_hash] = remaining.get(a_hash, 0) + 1
+    removed = []
+    for part in msg.walk():
+        if not part.is_multipart():
+            continue
+        kept = []
+        for child in part.get_payload():
+            if not child.is_multipart():
+                a_hash = hashlib.sha1(child.get_payload(decode=True) or "").hexdigest()
+                if remaining.get(a_hash):
+                    remaining[a_hash] -= 1
+                    removed.append(a_hash)
+                    continue
+            kept.append(child)
+        part.set_payload(kept)
+
+    if not removed:
+        return raw, removed
+    out = StringIO()
+    # Don't re-wrap headers, to change as little of the message as possible
+    email.generator.Generator(out, mangle_from_=False, maxheaderlen=0).flatten(msg)
+    # Messages given to IMAP need CRLF line endings throughout
+    return out.getvalue().replace("\r\n", "\n").replace("\n", "\r\n"), removed
+
+
+def add_header(raw, name, value):
+    """Returns the full text of a message with a header added to the top of
+    it, leaving the rest of the message as it was.
+    """
+    return "{0}: {1}\r\n{2}".format(name, value, raw)
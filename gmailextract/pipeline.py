@@ -0,0 +1,192 @@
+"""A small threaded pipeline, where each stage runs in its own pool of
+threads and passes work on to the next stage through bounded queues, so
+that a slow stage holds back the stages before it instead of letting work
+pile up in memory.
+"""
+
+import sys
+import threading
+import Queue
+
+# Sent through the queues to tell a worker there is no more work coming
+_DONE = object()
+
+# How long, in seconds, blocked workers wait before checking whether the
+# pipeline has been aborted
+_POLL = 0.1
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+class Stage(object):
+    """One step of a pipeline."""
+
+    def __init__(self, name, func, workers=1, maxsize=0, key=None):
+        """
+        Args:
+            name -- a name for the stage, used when reporting statistics
+            func -- called as `func(worker_index, item, emit)` for each item
+                    given to the stage, where `emit` is a function that
+                    passes an item on to the next stage.
+
+        Keyword Args:
+            workers -- the number of threads working on this stage
+            maxsize -- the maximum number of items that can be waiting to
+                       be worked on by each worker of this stage, or 0 for
+                       no limit
+            key     -- an optional function that is given each item and
+                       returns a hashable value.  Items with the same key
+                       are always handled, in the order they were emitted,
+                       by the same worker.
+        """
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.key = key
+        # Keyed stages need a queue per worker to keep items in order,
+        # otherwise all the workers share a single queue
+        num_queues = workers if key else 1
+        self.queues = [Queue.Queue(maxsize) for i in range(num_queues)]
+        self.items = 0
+        self.max_depth = 0
+        self.depth_total = 0
+
+    def depth(self):
+        """Returns the number of items waiting to be worked on."""
+        return sum(queue.qsize() for queue in self.queues)
+
+    def stats(self):
+        return {"items": self.items,
+                "max_depth": self.max_depth,
+                "mean_depth": float(self.depth_total) / self.items if self.items else 0.0}
+
+    def _queue_for(self, item):
+        if self.key is None:
+            return self.queues[0]
+        return self.queues[hash(self.key(item)) % len(self.queues)]
+
+
+class Pipeline(object):
+    """Runs items through a series of stages."""
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def depths(self):
+        """Returns a dict of the number of items waiting at each stage."""
+        return dict((stage.name, stage.depth()) for stage in self.stages)
+
+    def stats(self):
+        """Returns a dict of statistics about the items that went through
+        each stage, including the largest and average number of items that
+        were waiting at the stage.
+        """
+        return dict((stage.name, stage.stats()) for stage in self.stages)
+
+    def _put(self, stage, item):
+        queue = stage._queue_for(item)
+        depth = stage.depth()
+        with self.lock:
+            stage.items += 1
+            stage.depth_total += depth
+            stage.max_depth = max(stage.max_depth, depth + 1)
+        while True:
+            if self.errors:
+                raise PipelineAborted()
+            try:
+                queue.put(item, True, _POLL)
+                return
+            except Queue.Full:
+                pass
+
+    def _get(self, queue):
+        while True:
+            if self.errors:
+                raise PipelineAborted()
+            try:
+                return queue.get(True, _POLL)
+            except Queue.Empty:
+                pass
+
+    def _work(self, position, worker_index, remaining):
+        stage = self.stages[position]
+        queue = stage.queues[worker_index % len(stage.queues)]
+        next_stage = self.stages[position + 1] if position + 1 < len(self.stages) else None
+
+        def _emit(item):
+            self._put(next_stage, item)
+
+        try:
+            while True:
+                item = self._get(queue)
+                if item is _DONE:
+                    break
+                stage.func(worker_index, item, _emit)
+        except PipelineAborted:
+            return
+        except Exception:
+            self.errors.append(sys.exc_info())
+            return
+
+        # The last worker of a stage to finish tells the next stage that
+        # nothing more is coming
+        with self.lock:
+            remaining[position] -= 1
+            last = remaining[position] == 0
+        if last and next_stage is not None:
+            try:
+                self._finish(next_stage)
+            except PipelineAborted:
+                pass
+
+    def _finish(self, stage):
+        for queue in stage.queues:
+            for i in range(stage.workers // len(stage.queues)):
+                while True:
+                    if self.errors:
+                        raise PipelineAborted()
+                    try:
+                        queue.put(_DONE, True, _POLL)
+                        break
+                    except Queue.Full:
+                        pass
+
+    def run(self, items):
+        """Passes each of the given items to the first stage, and waits for
+        every stage to finish.  If any stage raises an exception, the whole
+        pipeline is stopped and the exception is re-raised.
+        """
+        remaining = [stage.workers for stage in self.stages]
+        threads = []
+        for position, stage in enumerate(self.stages):
+            for worker_index in range(stage.workers):
+                thread = threading.Thread(target=self._work,
+                                          args=(position, worker_index, remaining))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        try:
+            for item in items:
+                self._put(self.stages[0], item)
+            self._finish(self.stages[0])
+        except PipelineAborted:
+            pass
+        except BaseException:
+            # Errors raised while producing the items stop the workers too,
+            # just as errors raised by a stage do
+            self.errors.append(sys.exc_info())
+
+        for thread in threads:
+            # Joining with a timeout keeps the main thread responsive to
+            # signals, such as a KeyboardInterrupt
+            while thread.is_alive():
+                thread.join(_POLL)
+
+        if self.errors:
+            exc_type, exc_value, exc_tb = self.errors[0]
+            raise exc_type, exc_value, exc_tb
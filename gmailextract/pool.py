@@ -0,0 +1,226 @@
+"""A pool of IMAP connections to the same Gmail account, used to work on
+several batches of messages at the same time, and a budget that limits how
+many connections several pools may have open to a host between them.
+"""
+
+import ctypes
+import multiprocessing
+import sys
+import threading
+from .imap import GmailConnection
+
+
+# How long, in seconds, a pool waiting on a budget sleeps before checking
+# the budget again, and waits on its threads before checking for signals
+_POLL = 0.5
+
+
+class ConnectionBudget(object):
+    """A limit on the number of connections open to a single host, shared
+    by every pool given the budget.
+    """
+
+    def __init__(self, limit, shared=False):
+        """
+        Args:
+            limit -- the most connections that can be open at once
+
+        Keyword Args:
+            shared -- whether the budget is shared between processes, by
+                      being created before they are started, rather than
+                      just between threads
+        """
+        self.limit = max(1, limit)
+        if shared:
+            self.cond = multiprocessing.Condition()
+            self.count = multiprocessing.RawValue(ctypes.c_int, 0)
+        else:
+            self.cond = threading.Condition()
+            self.count = ctypes.c_int(0)
+
+    @property
+    def in_use(self):
+        """The number of connections currently taken from the budget."""
+        return self.count.value
+
+    def acquire(self, wanted, block=True):
+        """Takes up to `wanted` connections from the budget.
+
+        Keyword Args:
+            block -- whether to wait until at least one connection is free,
+                     instead of returning straight away
+
+        Returns:
+            The number of connections taken, which is at least one if
+            `block` is True.
+        """
+        with self.cond:
+            while block and self.in_use >= self.limit:
+                # Waiting with a timeout keeps the thread responsive to
+                # signals, such as a KeyboardInterrupt
+                self.cond.wait(_POLL)
+            granted = max(0, min(wanted, self.limit - self.in_use))
+            self.count.value += granted
+            return granted
+
+    def release(self, count):
+        """Gives back connections taken with acquire()."""
+        with self.cond:
+            self.count.value -= count
+            self.cond.notify_all()
+
+
+class ConnectionPool(object):
+    """Manages several authenticated connections to a single Gmail account,
+    and runs work over them in parallel, one thread per connection.
+    """
+
+    def __init__(self, email, password, size=1, budget=None, server=None, metrics=None,
+                 rate=None):
+        """
+        Args:
+            email    -- the username of the Gmail account to connect to
+            password -- the password of the Gmail account to connect to
+
+        Keyword Args:
+            size   -- the number of connections to open to Gmail
+            budget -- an optional ConnectionBudget, shared with other pools,
+                      that the connections of this pool count against.
+                      When the budget is used up the pool makes do with
+                      fewer connections than `size`.
+            server -- an optional (host, port, use_ssl) tuple, describing
+                      an IMAP server to connect to in place of Gmail's
+            metrics -- an optional metrics.Metrics that every connection
+                       records its IMAP commands in
+            rate    -- an optional throttle.RateLimit capping the bandwidth
+                       every connection uses
+        """
+        self.email = email
+        self.password = password
+        self.size = max(1, size)
+        self.budget = budget
+        self.server = server or ()
+        self.metrics = metrics
+        self.rate = rate
+        self.connections = []
+        # Bytes received over connections that have since been closed
+        self.closed_bytes = 0
+
+    def _open(self, count):
+        """Opens up to `count` more connections, returning a boolean
+        description of whether they could all be opened.
+        """
+        for i in range(count):
+            conn = GmailConnection(self.email, self.password, *self.server,
+                                   metrics=self.metrics, rate=self.rate)
+            if not conn.connect():
+                if self.budget is not None:
+                    self.budget.release(count - i)
+                return False
+            self.connections.append(conn)
+        return True
+
+    def connect(self):
+        """Opens the connections in the pool, waiting for at least one to be
+        free in the budget, if the pool has one.
+
+        Returns:
+            A boolean description of whether the connections could be
+            opened.
+        """
+        self.close()
+        count = self.size
+        if self.budget is not None:
+            count = self.budget.acquire(self.size)
+        if not self._open(count):
+            self.close()
+            return False
+        return True
+
+    def grow(self):
+        """Opens more connections, up to the size of the pool, if there are
+        any free in the budget.
+        """
+        count = self.size - len(self.connections)
+        if count > 0 and self.budget is not None:
+            count = self.budget.acquire(count, block=False)
+        if count > 0:
+            self._open(count)
+
+    def shrink(self, size=1):
+        """Closes connections until no more than `size` are open, giving
+        them back to the budget for other pools to use.
+        """
+        size = max(1, size)
+        while len(self.connections) > size:
+            self._close(self.connections.pop())
+
+    def _close(self, conn):
+        self.closed_bytes += conn.bytes_fetched
+        conn.close()
+        if self.budget is not None:
+            self.budget.release(1)
+
+    def close(self):
+        for conn in self.connections:
+            self._close(conn)
+        self.connections = []
+
+    @property
+    def bytes_fetched(self):
+        """The total number of bytes of message data received over all of
+        the connections the pool has opened.
+        """
+        return self.closed_bytes + sum(conn.bytes_fetched for conn in self.connections)
+
+    def map(self, func, items):
+        """Calls `func(connection, item)` for each of the given items, with
+        the items divided between the connections in the pool.  Items are
+        started in the order given, though with more than one connection
+        they may finish in a different order.
+
+        If any call raises an exception, no further items are started, and
+        the exception is re-raised once the calls already in progress have
+        finished.
+        """
+        if len(self.connections) == 1:
+            for item in items:
+                func(self.connections[0], item)
+            return
+
+        # Items are only taken from `items` as connections become free, so
+        # it can be a generator that decides on each item as it goes
+        items = iter(items)
+        lock = threading.Lock()
+        errors = []
+
+        def _worker(conn):
+            while not errors:
+                try:
+                    with lock:
+                        item = next(items)
+                except StopIteration:
+                    return
+                try:
+                    func(conn, item)
+                except Exception:
+                    errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=_worker, args=(conn,))
+                   for conn in self.connections]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for thread in threads:
+                # Joining with a timeout keeps the main thread responsive to
+                # signals, such as a KeyboardInterrupt
+                while thread.is_alive():
+                    thread.join(_POLL)
+        except BaseException:
+            # Stops the threads from starting on any more items
+            errors.append(sys.exc_info())
+            raise
+        if errors:
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_type, exc_value, exc_tb
@@ -0,0 +1,72 @@
+"""Builds the Gmail search (X-GM-RAW) query used to pick which messages to
+extract images from, so that as many messages as possible are ruled out by
+Gmail before anything is downloaded.
+"""
+
+# File extensions of the image types that are extracted (see
+# extractor.ATTACHMENT_MIMES)
+IMAGE_EXTENSIONS = (u"jpg", u"jpeg", u"png", u"gif")
+
+
+def _text(value):
+    """Returns a unicode version of a value given as a number, or as either
+    a unicode or UTF-8 encoded string.
+    """
+    if isinstance(value, unicode):
+        return value
+    return str(value).decode("utf-8")
+
+
+def _term(key, value):
+    value = _text(value)
+    if u" " in value or u'"' in value:
+        value = u'"{0}"'.format(value.replace(u'"', u''))
+    return u"{0}:{1}".format(key, value)
+
+
+class SearchFilter(object):
+    """Describes which messages with attachments to extract images from."""
+
+    def __init__(self, images_only=True, larger=None, smaller=None, after=None,
+                 before=None, labels=None, raw=None):
+        """
+        Keyword Args:
+            images_only -- only consider messages with an attachment whose
+                           name ends in the extension of an image type that
+                           is extracted.  Images attached without such a
+                           name are then missed.
+            larger      -- only consider messages larger than this, in bytes
+                           or with a suffix, as Gmail accepts (ex "500K",
+                           "2M")
+            smaller     -- only consider messages smaller than this
+            after       -- only consider messages received after this date,
+                           as "YYYY/MM/DD"
+            before      -- only consider messages received before this date
+            labels      -- only consider messages with every one of these
+                           labels
+            raw         -- any other Gmail search terms to add, as typed
+                           into Gmail's search box
+        """
+        self.images_only = images_only
+        self.larger = larger
+        self.smaller = smaller
+        self.after = after
+        self.before = before
+        self.labels = labels or []
+        self.raw = raw
+
+    def query(self):
+        """Returns the Gmail search query described by the filter."""
+        terms = [u"has:attachment"]
+        if self.images_only:
+            extensions = u" OR ".join(_term(u"filename", ext) for ext in IMAGE_EXTENSIONS)
+            terms.append(u"({0})".format(extensions))
+        for key, value in ((u"larger", self.larger), (u"smaller", self.smaller),
+                           (u"after", self.after), (u"before", self.before)):
+            if value:
+                terms.append(_term(key, value))
+        for label in self.labels:
+            terms.append(_term(u"label", label))
+        if self.raw:
+            terms.append(u"({0})".format(_text(self.raw)))
+        return u" ".join(terms)
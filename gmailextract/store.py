@@ -0,0 +1,73 @@
+"""A content addressed index of the images extracted to a directory, used to
+only write each distinct image to disk once.  Later copies of the same image
+are hard links to the first.
+"""
+
+import os
+import threading
+
+
+class ImageStore(object):
+    """Tracks which file on disk holds each distinct image, by sha1 hash."""
+
+    def __init__(self, dest, mapping):
+        """
+        Args:
+            dest    -- the directory extracted images are written to
+            mapping -- a dict in the format of GmailImageExtractor.mapping,
+                       describing the images already extracted to `dest`
+        """
+        self.dest = dest
+        self.lock = threading.Lock()
+        self.paths = {}
+        for fname, (gm_id, a_hash, subject) in mapping.items():
+            self.paths[a_hash] = fname
+        # Number of images looked up, and number of those that were already
+        # on disk
+        self.lookups = 0
+        self.hits = 0
+
+    def add(self, a_hash, fname):
+        """Records that the image with the given hash was written to disk
+        with the given file name.
+        """
+        with self.lock:
+            self.paths[a_hash] = fname
+
+    def link(self, a_hash, fname, replace=False):
+        """Tries to create the file `fname` as a hard link to an image already
+        on disk with the given hash.
+
+        Keyword Args:
+            replace -- whether to replace a file already named `fname`
+
+        Returns:
+            A boolean description of whether the link was created.  If it
+            wasn't, the image has to be written to disk as normal.
+        """
+        with self.lock:
+            self.lookups += 1
+            existing = self.paths.get(a_hash)
+        if existing is None:
+            return False
+        path = os.path.join(self.dest, fname)
+        try:
+            if replace:
+                # Hard links can't replace an existing file, so link under a
+                # temporary name first and then move the link into place
+                temp_path = os.path.join(self.dest, u".{0}.link".format(fname))
+                os.link(os.path.join(self.dest, existing), temp_path)
+                os.rename(temp_path, path)
+            else:
+                os.link(os.path.join(self.dest, existing), path)
+        except OSError:
+            # Either the earlier copy was deleted, or the file system doesn't
+            # support hard links
+            return False
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def hit_rate(self):
+        """Returns the fraction of images looked up that were duplicates."""
+        return float(self.hits) / self.lookups if self.lookups else 0.0
@@ -0,0 +1,142 @@
+"""Helpers for working at the best rate Gmail allows: backing off before
+retrying after a dropped connection or a throttling response, sizing
+batches of messages from how quickly earlier batches went through, and
+capping the bandwidth used.
+"""
+
+import ctypes
+import multiprocessing
+import random
+import threading
+import time
+
+
+class Backoff(object):
+    """Describes how long to wait before each attempt to retry something
+    that failed, doubling the wait each time.
+    """
+
+    def __init__(self, attempts=6, initial=1.0, maximum=60.0, jitter=0.25):
+        """
+        Keyword Args:
+            attempts -- the most times to retry before giving up
+            initial  -- the number of seconds to wait before the first retry
+            maximum  -- the longest, in seconds, to wait before any retry
+            jitter   -- how much, as a fraction of the wait, to randomly
+                        vary each wait by, so that several connections
+                        throttled at once don't all retry at once
+        """
+        self.attempts = attempts
+        self.initial = initial
+        self.maximum = maximum
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        """Returns the number of seconds to wait before the given retry,
+        counting from 1.
+        """
+        delay = min(self.maximum, self.initial * 2 ** (attempt - 1))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class BatchSizer(object):
+    """Picks how many messages to work on in each batch, growing the batch
+    by one after each batch that goes well, and halving it after any that
+    was throttled, took too long or was too large (additive increase,
+    multiplicative decrease).  Can be shared between threads.
+    """
+
+    def __init__(self, initial, minimum=1, maximum=500, target_seconds=10.0,
+                 target_bytes=50 * 1048576):
+        """
+        Args:
+            initial -- the size of the first batch
+
+        Keyword Args:
+            minimum        -- the smallest batch size to use
+            maximum        -- the largest batch size to use
+            target_seconds -- batches taking longer than this are too large
+            target_bytes   -- batches downloading more bytes than this are
+                              too large
+        """
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.size = min(self.maximum, max(self.minimum, initial))
+        self.target_seconds = target_seconds
+        self.target_bytes = target_bytes
+        self.lock = threading.Lock()
+
+    def finished(self, size, seconds, num_bytes, throttled=False):
+        """Adjusts the batch size after a batch has been worked on.
+
+        Args:
+            size      -- the number of messages in the batch
+            seconds   -- how long the batch took
+            num_bytes -- the number of bytes downloaded for the batch
+
+        Keyword Args:
+            throttled -- whether Gmail throttled, or dropped, the connection
+                         while working on the batch
+        """
+        with self.lock:
+            if throttled or seconds > self.target_seconds or num_bytes > self.target_bytes:
+                self.size = max(self.minimum, min(self.size, size) // 2)
+            elif size >= self.size:
+                # Only batches that were as large as the current size say
+                # anything about whether a larger one would be fine
+                self.size = min(self.maximum, self.size + 1)
+
+    def batches(self, items):
+        """Yields lists of the given items, each as large as the batch size
+        is at the time.
+        """
+        items = list(items)
+        start = 0
+        while start < len(items):
+            with self.lock:
+                size = self.size
+            yield items[start:start + size]
+            start += size
+
+
+class RateLimit(object):
+    """A cap on the number of bytes a second moved to and from Gmail, shared
+    by every connection given it.  Connections report each transfer once it
+    is done, and are held back for as long as it takes the average rate to
+    fall back under the cap.
+    """
+
+    def __init__(self, bytes_per_second, burst=1.0, shared=False):
+        """
+        Args:
+            bytes_per_second -- the most bytes a second to move, on average
+
+        Keyword Args:
+            burst  -- the number of seconds' worth of bytes that can be moved
+                      at once without waiting, after a quiet spell
+            shared -- whether the limit is shared between processes, by
+                      being created before they are started, rather than
+                      just between threads
+        """
+        self.bytes_per_second = float(max(1, bytes_per_second))
+        self.burst = burst
+        if shared:
+            self.lock = multiprocessing.Lock()
+            self.next_free = multiprocessing.RawValue(ctypes.c_double, 0.0)
+        else:
+            self.lock = threading.Lock()
+            self.next_free = ctypes.c_double(0.0)
+
+    def consume(self, num_bytes):
+        """Records that `num_bytes` bytes were moved, waiting first if that
+        takes the rate over the cap.
+        """
+        with self.lock:
+            now = time.time()
+            # The time by which every transfer reported so far would have
+            # finished, had each been made at exactly the capped rate
+            self.next_free.value = (max(now, self.next_free.value) +
+                                    num_bytes / self.bytes_per_second)
+            wait = self.next_free.value - now - self.burst
+        if wait > 0:
+            time.sleep(wait)
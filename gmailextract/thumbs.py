@@ -0,0 +1,164 @@
+"""A disk cache of thumbnails of extracted images, so that the images can be
+reviewed in a browser without sending each one at full size.  Thumbnails
+are made as they are first asked for, and keyed by the sha1 hash of the
+image, so every copy of an image shares one thumbnail.  The cache is kept
+under a size limit by dropping the thumbnails used least recently.
+
+Making thumbnails needs PIL (or Pillow).  Without it, available() is False
+and ThumbnailCache.get() always returns None.
+"""
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from .fs import AtomicFile
+from .metrics import Metrics
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# File extension of the thumbnails, which are all JPEGs
+EXTENSION = u".jpg"
+
+log = logging.getLogger(__name__)
+
+
+def available():
+    """Returns a boolean description of whether thumbnails can be made on
+    this system.
+    """
+    return Image is not None
+
+
+class ThumbnailCache(object):
+    """Makes, and keeps on disk, thumbnails of images.  Can be shared
+    between threads.
+    """
+
+    def __init__(self, path, max_bytes=256 * 1048576, size=200, metrics=None):
+        """
+        Args:
+            path -- the directory to keep the thumbnails in, which is
+                    created if need be
+
+        Keyword Args:
+            max_bytes -- the most bytes of thumbnails to keep on disk
+            size      -- the largest width and height, in pixels, of each
+                         thumbnail
+            metrics   -- an optional metrics.Metrics to count the
+                         "thumbnails.hits", "thumbnails.made" and
+                         "thumbnails.failed" in
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = size
+        self.metrics = metrics or Metrics()
+        self.lock = threading.Lock()
+        # Maps the hash of each thumbnail on disk to its size in bytes,
+        # least recently used first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # Thumbnails kept by an earlier run are picked up again, with their
+        # modification times (updated on each use) giving their order
+        found = []
+        for name in os.listdir(path):
+            file_path = os.path.join(path, name)
+            if name.startswith(u"."):
+                # Left behind by a thumbnail that was never finished
+                os.remove(file_path)
+            elif name.endswith(EXTENSION):
+                stat = os.stat(file_path)
+                found.append((stat.st_mtime, name[:-len(EXTENSION)], stat.st_size))
+        for mtime, a_hash, num_bytes in sorted(found):
+            self.entries[a_hash] = num_bytes
+            self.total_bytes += num_bytes
+        with self.lock:
+            self._evict()
+
+    def _path(self, a_hash):
+        return os.path.join(self.path, a_hash + EXTENSION)
+
+    def get(self, a_hash, source):
+        """Returns the thumbnail of an image, as JPEG data, making it if it
+        isn't in the cache.
+
+        Args:
+            a_hash -- the sha1 hash of the image
+            source -- the path of the image, used if the thumbnail has to be
+                      made
+
+        Returns:
+            The thumbnail, or None if PIL isn't available or the image isn't
+            one it can read.
+        """
+        with self.lock:
+            cached = a_hash in self.entries
+            if cached:
+                self.entries[a_hash] = self.entries.pop(a_hash)
+        if cached:
+            try:
+                with open(self._path(a_hash), 'rb') as handle:
+                    data = handle.read()
+                os.utime(self._path(a_hash), None)
+            except (IOError, OSError):
+                # Dropped from the cache by another thread in the meantime
+                pass
+            else:
+                self.metrics.incr(u"thumbnails.hits")
+                return data
+
+        data = self._make(source)
+        if data is None:
+            return None
+        self.metrics.incr(u"thumbnails.made")
+        with self.lock:
+            thumb_file = AtomicFile(self.path, a_hash + EXTENSION)
+            thumb_file.write(data)
+            thumb_file.commit()
+            self.total_bytes += len(data) - self.entries.pop(a_hash, 0)
+            self.entries[a_hash] = len(data)
+            self._evict()
+        return data
+
+    def _make(self, source):
+        if Image is None:
+            return None
+        try:
+            image = Image.open(source)
+            image.thumbnail((self.size, self.size))
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            out = BytesIO()
+            image.save(out, "JPEG", quality=80)
+        except (IOError, ValueError):
+            # Not an image PIL can read
+            self.metrics.incr(u"thumbnails.failed")
+            return None
+        except Exception:
+            # The images are attachments from anyone, and PIL can raise
+            # almost anything on ones that are corrupt or made to be
+            # hostile (ex DecompressionBombError, SyntaxError, struct.error,
+            # MemoryError), none of which should fail the request
+            log.warning("Unable to make a thumbnail of %s", source, exc_info=True)
+            self.metrics.incr(u"thumbnails.failed")
+            return None
+        return out.getvalue()
+
+    def _evict(self):
+        """Removes the least recently used thumbnails until the cache is
+        under its size limit.  Must be called with the lock held.
+        """
+        while self.total_bytes > self.max_bytes and self.entries:
+            a_hash, num_bytes = self.entries.popitem(last=False)
+            self.total_bytes -= num_bytes
+            try:
+                os.remove(self._path(a_hash))
+            except OSError:
+                pass
@@ -0,0 +1,160 @@
+"""Watches the directory images were extracted to for deletions as they
+happen, using Linux's inotify, so that the set of images to remove from Gmail
+is always up to date without having to scan the directory.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+from .fs import list_names
+
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_CLOEXEC = 0o2000000
+
+_EVENT = struct.Struct("iIII")
+
+# How long, in seconds, the watching thread waits for events before
+# checking whether it has been asked to stop
+_POLL = 0.5
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc.inotify_init1
+    _libc.inotify_add_watch
+except (OSError, AttributeError):
+    _libc = None
+
+
+def available():
+    """Returns a boolean description of whether inotify can be used on this
+    system.
+    """
+    return _libc is not None
+
+
+class DeletionWatcher(object):
+    """Keeps track of which of a set of files in a directory have been
+    deleted (or moved out of the directory), updating as the files change.
+    """
+
+    def __init__(self, path, names, callback=None):
+        """
+        Args:
+            path  -- the directory to watch
+            names -- the names of the files in the directory to watch
+
+        Keyword Args:
+            callback -- an optional function that is called, from the
+                        watching thread, with the number of deleted files
+                        whenever that number changes.
+        """
+        self.path = path
+        self.names = set(names)
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.deleted = set()
+        self.fd = None
+        self.thread = None
+        self.stopping = False
+        # Set if events were lost, or the directory itself went away, in
+        # which case the deleted set can no longer be trusted
+        self.broken = False
+
+    def start(self):
+        """Starts watching the directory.
+
+        Returns:
+            A boolean description of whether the directory is being watched.
+        """
+        if not available():
+            return False
+        fd = _libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            return False
+        path = self.path
+        if isinstance(path, unicode):
+            path = path.encode(sys.getfilesystemencoding())
+        mask = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+        if _libc.inotify_add_watch(fd, path, mask) < 0:
+            os.close(fd)
+            return False
+        self.fd = fd
+
+        # Only scan the directory once it is being watched, so that no
+        # deletion can fall between the two
+        self.deleted = self.names - list_names(self.path)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        self._notify()
+        return True
+
+    def stop(self):
+        self.stopping = True
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def running(self):
+        """Returns a boolean description of whether the set of deleted files
+        is being kept up to date.
+        """
+        return self.thread is not None and not self.broken
+
+    def deleted_names(self):
+        """Returns the set of watched files that are currently deleted."""
+        with self.lock:
+            return set(self.deleted)
+
+    def _notify(self):
+        if self.callback:
+            self.callback(len(self.deleted))
+
+    def _run(self):
+        encoding = sys.getfilesystemencoding()
+        while not self.stopping and not self.broken:
+            try:
+                readable, _, _ = select.select([self.fd], [], [], _POLL)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                continue
+            data = os.read(self.fd, 65536)
+            changed = False
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip("\0").decode(encoding, "replace")
+                offset += length
+
+                if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_IGNORED):
+                    self.broken = True
+                    break
+                if name not in self.names:
+                    continue
+                with self.lock:
+                    if mask & (IN_DELETE | IN_MOVED_FROM):
+                        changed = changed or name not in self.deleted
+                        self.deleted.add(name)
+                    elif mask & (IN_CREATE | IN_MOVED_TO):
+                        changed = changed or name in self.deleted
+                        self.deleted.discard(name)
+            if changed:
+                self._notify()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""Tests of naming and writing the files images are extracted to."""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from gmailextract.fs import (NameAllocator, AtomicFile, sanatize_filename,
+                             remove_partial_files, account_dirname)
+
+
+class SanatizeFilenameTest(unittest.TestCase):
+
+    def test_unicode(self):
+        self.assertEqual(sanatize_filename(u"Re: café/photo (1).jpg"), u"Re cafphoto (1).jpg")
+
+    def test_bytes(self):
+        self.assertEqual(sanatize_filename("a/b\\c:d.jpg"), "abcd.jpg")
+
+    def test_account_dirname(self):
+        self.assertEqual(account_dirname(u" A@Example.com"), account_dirname("a@example.com"))
+        self.assertNotEqual(account_dirname("a+b@x.com"), account_dirname("ab@x.com"))
+
+
+class NameAllocatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_unused_name(self):
+        names = NameAllocator(self.path)
+        self.assertEqual(names.allocate(u"photo.jpg"), u"photo.jpg")
+
+    def test_collision_suffixes(self):
+        names = NameAllocator(self.path)
+        self.assertEqual([names.allocate(u"photo.jpg") for i in range(4)],
+                         [u"photo.jpg", u"photo - 2.jpg", u"photo - 3.jpg", u"photo - 4.jpg"])
+
+    def test_names_without_an_extension(self):
+        names = NameAllocator(self.path)
+        self.assertEqual([names.allocate(u"photo") for i in range(2)], [u"photo", u"photo - 2"])
+
+    def test_only_the_last_extension_is_kept(self):
+        names = NameAllocator(self.path)
+        names.allocate(u"a.tar.gz")
+        self.assertEqual(names.allocate(u"a.tar.gz"), u"a.tar - 2.gz")
+
+    def test_files_in_the_directory(self):
+        for name in (u"photo.jpg", u"photo - 2.jpg", u"photo - 4.jpg"):
+            open(os.path.join(self.path, name), "w").close()
+        names = NameAllocator(self.path)
+        self.assertEqual([names.allocate(u"photo.jpg") for i in range(2)],
+                         [u"photo - 3.jpg", u"photo - 5.jpg"])
+
+    def test_suffixed_names_asked_for_directly(self):
+        names = NameAllocator(self.path)
+        self.assertEqual(names.allocate(u"photo - 2.jpg"), u"photo - 2.jpg")
+        self.assertEqual([names.allocate(u"photo.jpg") for i in range(2)],
+                         [u"photo.jpg", u"photo - 3.jpg"])
+
+    def test_reserved_names(self):
+        # Images deleted by the user, but not yet removed from Gmail, still
+        # have their names recorded against their messages, so the names
+        # must not be given to other images
+        open(os.path.join(self.path, u"kept.jpg"), "w").close()
+        names = NameAllocator(self.path, [u"deleted.jpg", u"deleted - 2.jpg"])
+        self.assertEqual(names.allocate(u"deleted.jpg"), u"deleted - 3.jpg")
+        self.assertEqual(names.allocate(u"kept.jpg"), u"kept - 2.jpg")
+
+    def test_threads(self):
+        names = NameAllocator(self.path)
+        allocated = []
+
+        def _allocate():
+            for i in range(50):
+                allocated.append(names.allocate(u"photo.jpg"))
+
+        threads = [threading.Thread(target=_allocate) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(allocated)), 200)
+
+
+class AtomicFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_commit(self):
+        handle = AtomicFile(self.path, u"photo.jpg")
+        handle.write("abc")
+        self.assertEqual(os.listdir(self.path), [os.path.basename(handle.temp_path)])
+        handle.commit()
+        self.assertEqual(os.listdir(self.path), [u"photo.jpg"])
+        with open(os.path.join(self.path, u"photo.jpg"), "rb") as f:
+            self.assertEqual(f.read(), "abc")
+
+    def test_permissions(self):
+        # Committed files have the permissions the umask gives new files,
+        # rather than the owner only ones of a temporary file
+        AtomicFile(self.path, u"photo.jpg").commit()
+        open(os.path.join(self.path, u"plain.jpg"), "w").close()
+        modes = [os.stat(os.path.join(self.path, name)).st_mode & 0o777
+                 for name in (u"photo.jpg", u"plain.jpg")]
+        self.assertEqual(modes[0], modes[1])
+
+    def test_discard(self):
+        handle = AtomicFile(self.path, u"photo.jpg")
+        handle.write("abc")
+        handle.discard()
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_remove_partial_files(self):
+        AtomicFile(self.path, u"a.jpg").handle.close()
+        AtomicFile(self.path, u"b.jpg").handle.close()
+        for name in (u"keep.part", u".keep"):
+            open(os.path.join(self.path, name), "w").close()
+        self.assertEqual(remove_partial_files(self.path), 2)
+        self.assertEqual(sorted(os.listdir(self.path)), [u".keep", u"keep.part"])
+
+
+if __name__ == "__main__":
+    unittest.main()
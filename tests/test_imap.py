@@ -0,0 +1,128 @@
+"""Tests of the parsing of IMAP responses, using responses shaped like the
+ones Gmail sends, as returned by imaplib (with each literal given as a
+(prefix, literal) tuple).
+"""
+
+import unittest
+from gmailextract.imap import Quoted, ParseError, _tokenize, parse, parse_fetch
+
+# UID FETCH 42 (X-GM-MSGID X-GM-LABELS FLAGS BODYSTRUCTURE)
+BODYSTRUCTURE_RESPONSE = [
+    '1 (X-GM-MSGID 1578932345678901234 X-GM-LABELS ("\\\\Important" "Family photos") '
+    'UID 42 FLAGS (\\Seen) BODYSTRUCTURE ((("text" "plain" ("charset" "UTF-8") NIL NIL '
+    '"7bit" 12 1 NIL NIL NIL)("text" "html" ("charset" "UTF-8") NIL NIL "7bit" 34 1 NIL '
+    'NIL NIL) "alternative" ("boundary" "000000000000b1c2") NIL NIL)("image" "jpeg" '
+    '("name" "photo.jpg") "<f_jk1>" NIL "base64" 1024 NIL ("attachment" ("filename" '
+    '"photo.jpg")) NIL) "mixed" ("boundary" "000000000000a0b1") NIL NIL))',
+]
+
+# UID FETCH 7:8 (UID BODY.PEEK[2]<0.5>), where the message data comes back
+# as literals, one message after the other
+LITERAL_RESPONSE = [
+    ('1 (UID 7 BODY[2]<0> {5}', 'R0lGO'),
+    ')',
+    ('2 (UID 8 BODY[2]<0> {5}', '/9j/4'),
+    ')',
+]
+
+# A file name with quotes in it, which Gmail sends as a literal in the
+# middle of the BODYSTRUCTURE's parameter list
+LITERAL_IN_LIST_RESPONSE = [
+    ('1 (UID 9 BODYSTRUCTURE (("text" "plain" ("charset" "us-ascii") NIL NIL "7bit" 3 1 '
+     'NIL NIL NIL)("image" "png" ("name" {13}', 'say "hi".png'),
+    ') NIL NIL "base64" 100 NIL NIL NIL) "mixed" ("boundary" "xyz") NIL NIL))',
+]
+
+
+class TokenizeTest(unittest.TestCase):
+
+    def tokens(self, text):
+        tokens = []
+        _tokenize(text, tokens)
+        return tokens
+
+    def test_atoms_quoted_strings_and_parens(self):
+        tokens = self.tokens('(UID 42 FLAGS (\\Seen) X-GM-LABELS ("Family photos"))')
+        self.assertEqual(tokens, ["(", "UID", "42", "FLAGS", "(", "\\Seen", ")",
+                                  "X-GM-LABELS", "(", "Family photos", ")", ")"])
+        self.assertIsInstance(tokens[9], Quoted)
+        self.assertNotIsInstance(tokens[1], Quoted)
+
+    def test_nil_is_none_unless_quoted(self):
+        tokens = self.tokens('NIL nil "NIL"')
+        self.assertEqual(tokens[:2], [None, None])
+        self.assertEqual(tokens[2], "NIL")
+        self.assertIsInstance(tokens[2], Quoted)
+
+    def test_escapes_in_quoted_strings(self):
+        tokens = self.tokens('"say \\"hi\\"" "back\\\\slash"')
+        self.assertEqual(tokens, ['say "hi"', "back\\slash"])
+
+    def test_parens_in_quoted_strings(self):
+        tokens = self.tokens('"(not a list)"')
+        self.assertEqual(tokens, ["(not a list)"])
+        self.assertIsInstance(tokens[0], Quoted)
+
+    def test_section_atoms_keep_their_brackets(self):
+        tokens = self.tokens('BODY[HEADER.FIELDS (SUBJECT)] {24}')
+        self.assertEqual(tokens, ["BODY[HEADER.FIELDS (SUBJECT)]", "{24}"])
+
+    def test_line_endings(self):
+        self.assertEqual(self.tokens("A\r\nB\n"), ["A", "B"])
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_nested_lists(self):
+        self.assertEqual(parse(['1 (A (B (C)) NIL)']), ["1", ["A", ["B", ["C"]], None]])
+
+    def test_literals(self):
+        parsed = parse(LITERAL_RESPONSE)
+        self.assertEqual(parsed, ["1", ["UID", "7", "BODY[2]<0>", "R0lGO"],
+                                  "2", ["UID", "8", "BODY[2]<0>", "/9j/4"]])
+        self.assertIsInstance(parsed[1][3], Quoted)
+
+    def test_literal_inside_a_list(self):
+        parsed = parse(LITERAL_IN_LIST_RESPONSE)
+        image = parsed[1][3][1]
+        self.assertEqual(image[:3], ["image", "png", ["name", 'say "hi".png']])
+        self.assertEqual(image[5:7], ["base64", "100"])
+
+    def test_parens_in_literals(self):
+        parsed = parse([('1 (BODY[] {3}', '(()'), ')'])
+        self.assertEqual(parsed, ["1", ["BODY[]", "(()"]])
+
+    def test_none_items_are_skipped(self):
+        self.assertEqual(parse([None, '1 (UID 3)']), ["1", ["UID", "3"]])
+
+    def test_unbalanced(self):
+        self.assertRaises(ParseError, parse, ['1 (UID 3'])
+        self.assertRaises(ParseError, parse, ['1 (UID 3))'])
+
+
+class ParseFetchTest(unittest.TestCase):
+
+    def test_items(self):
+        attrs, = parse_fetch(BODYSTRUCTURE_RESPONSE)
+        self.assertEqual(attrs["UID"], "42")
+        self.assertEqual(attrs["X-GM-MSGID"], "1578932345678901234")
+        self.assertEqual(attrs["X-GM-LABELS"], ["\\Important", "Family photos"])
+        self.assertEqual(attrs["FLAGS"], ["\\Seen"])
+        self.assertEqual(attrs["BODYSTRUCTURE"][-4:],
+                         ["mixed", ["boundary", "000000000000a0b1"], None, None])
+
+    def test_item_names_are_upper_cased(self):
+        attrs, = parse_fetch(['1 (uid 5 x-gm-msgid 123)'])
+        self.assertEqual(attrs, {"UID": "5", "X-GM-MSGID": "123"})
+
+    def test_several_messages(self):
+        messages = parse_fetch(LITERAL_RESPONSE)
+        self.assertEqual([(m["UID"], m["BODY[2]<0>"]) for m in messages],
+                         [("7", "R0lGO"), ("8", "/9j/4")])
+
+    def test_empty(self):
+        self.assertEqual(parse_fetch([None]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,250 @@
+"""Tests of the manifest, which lets a later run pick up where an earlier one
+stopped: which messages were processed and which images were written, the
+search state, and the journal of unfinished sync rewrites.
+"""
+
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from gmailextract.extractor import GmailImageExtractor
+from gmailextract.manifest import Manifest, MANIFEST_NAME
+from gmailextract.search import SearchFilter
+
+
+class ManifestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.manifest = Manifest(self.dest)
+
+    def tearDown(self):
+        self.manifest.close()
+        shutil.rmtree(self.dest)
+
+    def reopen(self):
+        """Reopens the manifest, as a later run would."""
+        self.manifest.close()
+        self.manifest = Manifest(self.dest)
+
+
+class ManifestTest(ManifestTestCase):
+
+    def test_meta_values(self):
+        self.assertEqual(self.manifest.get('high_water_uid', 0), 0)
+        self.manifest.set('high_water_uid', 42)
+        self.reopen()
+        self.assertEqual(self.manifest.get('high_water_uid'), u"42")
+
+    def test_messages_and_images(self):
+        self.manifest.add_message(1, u"Holiday", [(u"Holiday - a.jpg", "aa"),
+                                                  (u"Holiday - b.jpg", "bb")])
+        self.manifest.add_message(2, u"No images", [])
+        self.reopen()
+        self.assertEqual(self.manifest.processed_gm_ids(), set([u"1", u"2"]))
+        self.assertEqual(self.manifest.mapping(), {
+            u"Holiday - a.jpg": (u"1", u"aa", u"Holiday"),
+            u"Holiday - b.jpg": (u"1", u"bb", u"Holiday"),
+        })
+
+    def test_file_names_are_not_replaced(self):
+        self.manifest.add_message(1, u"First", [(u"a.jpg", "aa")])
+        self.assertRaises(ValueError, self.manifest.add_message, 2, u"Second",
+                          [(u"b.jpg", "bb"), (u"a.jpg", "cc")])
+        # Nothing of the failed message is recorded
+        self.assertEqual(self.manifest.processed_gm_ids(), set([u"1"]))
+        self.assertEqual(self.manifest.mapping(), {u"a.jpg": (u"1", u"aa", u"First")})
+
+    def test_remove_images(self):
+        self.manifest.add_message(1, u"s", [(u"a.jpg", "aa"), (u"b.jpg", "bb")])
+        self.manifest.remove_images([u"a.jpg"])
+        self.assertEqual(list(self.manifest.mapping()), [u"b.jpg"])
+
+    def test_replace_message(self):
+        self.manifest.add_message(1, u"s", [(u"a.jpg", "aa")])
+        self.manifest.replace_message(1, 5)
+        self.assertEqual(self.manifest.processed_gm_ids(), set([u"1", u"5"]))
+        self.assertEqual(self.manifest.mapping(), {u"a.jpg": (u"5", u"aa", u"s")})
+
+    def test_replace_message_without_images(self):
+        self.manifest.add_message(1, u"s", [(u"a.jpg", "aa")])
+        self.manifest.replace_message(1, 5, keep_images=False)
+        self.assertEqual(self.manifest.processed_gm_ids(), set([u"1", u"5"]))
+        self.assertEqual(self.manifest.mapping(), {u"a.jpg": (u"1", u"aa", u"s")})
+
+
+class RewriteJournalTest(ManifestTestCase):
+
+    def setUp(self):
+        ManifestTestCase.setUp(self)
+        self.manifest.add_message(1, u"s", [(u"a.jpg", "aa"), (u"b.jpg", "bb")])
+
+    def test_planned(self):
+        self.manifest.plan_rewrite(1, [u"a.jpg"], "token1")
+        self.reopen()
+        self.assertEqual(self.manifest.unfinished_rewrites(), {
+            u"1": {"state": u"planned", "fnames": [u"a.jpg"], "uidvalidity": None,
+                   "new_uid": None, "new_gm_id": None, "token": u"token1"},
+        })
+
+    def test_saved(self):
+        self.manifest.plan_rewrite(1, [u"a.jpg"], "token1")
+        self.manifest.rewrite_saved(1, 11, 30)
+        rewrite = self.manifest.unfinished_rewrites()[u"1"]
+        self.assertEqual((rewrite["state"], rewrite["uidvalidity"], rewrite["new_uid"],
+                          rewrite["new_gm_id"]), (u"saved", u"11", 30, None))
+        self.manifest.rewrite_saved(1, 11, 30, 9)
+        self.reopen()
+        self.assertEqual(self.manifest.unfinished_rewrites()[u"1"]["new_gm_id"], u"9")
+
+    def test_done(self):
+        self.manifest.plan_rewrite(1, [u"a.jpg"], "token1")
+        self.manifest.rewrite_saved(1, 11, 30, 9)
+        self.manifest.finish_rewrite(1, 9)
+        self.reopen()
+        self.assertEqual(self.manifest.unfinished_rewrites(), {})
+        self.assertEqual(self.manifest.processed_gm_ids(), set([u"1", u"9"]))
+        self.assertEqual(self.manifest.mapping(), {u"b.jpg": (u"9", u"bb", u"s")})
+
+    def test_done_is_one_transaction(self):
+        self.manifest.plan_rewrite(1, [u"a.jpg"], "token1")
+
+        def _crash(fnames):
+            raise RuntimeError("crashed")
+        self.manifest._remove_images = _crash
+        self.assertRaises(RuntimeError, self.manifest.finish_rewrite, 1, 9)
+        self.reopen()
+        self.assertEqual(self.manifest.unfinished_rewrites()[u"1"]["state"], u"planned")
+        self.assertEqual(self.manifest.processed_gm_ids(), set([u"1"]))
+        self.assertEqual(sorted(self.manifest.mapping()), [u"a.jpg", u"b.jpg"])
+
+    def test_cancel(self):
+        self.manifest.plan_rewrite(1, [u"a.jpg"])
+        self.manifest.cancel_rewrite(1)
+        self.assertEqual(self.manifest.unfinished_rewrites(), {})
+        self.assertEqual(sorted(self.manifest.mapping()), [u"a.jpg", u"b.jpg"])
+
+    def test_planned_again(self):
+        # A cancelled rewrite started over replaces what was planned before
+        self.manifest.plan_rewrite(1, [u"a.jpg"], "token1")
+        self.manifest.rewrite_saved(1, 11, 30)
+        self.manifest.plan_rewrite(1, [u"a.jpg", u"b.jpg"], "token2")
+        rewrite = self.manifest.unfinished_rewrites()[u"1"]
+        self.assertEqual((rewrite["state"], rewrite["fnames"], rewrite["new_uid"], rewrite["token"]),
+                         (u"planned", [u"a.jpg", u"b.jpg"], None, u"token2"))
+
+    def test_journal_from_before_tokens(self):
+        # Manifests written before tokens were journaled are given the column
+        self.manifest.close()
+        shutil.rmtree(self.dest)
+        self.dest = tempfile.mkdtemp()
+        conn = sqlite3.connect(self.dest + "/" + MANIFEST_NAME)
+        conn.execute("""CREATE TABLE rewrites (gm_id TEXT PRIMARY KEY, state TEXT NOT NULL,
+                        fnames TEXT NOT NULL, uidvalidity TEXT, new_uid INTEGER,
+                        new_gm_id TEXT)""")
+        conn.execute("""INSERT INTO rewrites VALUES ('1', 'saved', '["a.jpg"]', '11', 30, NULL)""")
+        conn.commit()
+        conn.close()
+        self.manifest = Manifest(self.dest)
+        rewrite = self.manifest.unfinished_rewrites()[u"1"]
+        self.assertEqual((rewrite["state"], rewrite["new_uid"], rewrite["token"]),
+                         (u"saved", 30, None))
+
+
+class FakeConnection(object):
+    """Stands in for an imap.GmailConnection, answering searches from a
+    list of UIDs.
+    """
+
+    def __init__(self, uids, uidvalidity=11):
+        self.uids = uids
+        self.uidvalidity = uidvalidity
+        self.searches = []
+
+    def search(self, query, min_uid=1):
+        self.searches.append((query, min_uid))
+        return [uid for uid in self.uids if uid >= min_uid]
+
+
+class SnapshotTest(unittest.TestCase):
+    """Tests of how the search state kept in the manifest decides which
+    messages an extraction looks at.
+    """
+
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.extractors = []
+
+    def tearDown(self):
+        for extractor in self.extractors:
+            extractor.close()
+        shutil.rmtree(self.dest)
+
+    def snapshot(self, conn, search=None, limit=None):
+        """Returns the UIDs a new extractor would extract, as if it were a
+        later run, and the extractor.
+        """
+        extractor = GmailImageExtractor(self.dest, "a@example.com", "pw", limit=limit,
+                                        search=search)
+        self.extractors.append(extractor)
+        extractor.conn = conn
+        return extractor._snapshot(), extractor
+
+    def test_first_run(self):
+        conn = FakeConnection([3, 5, 8])
+        uids, extractor = self.snapshot(conn)
+        self.assertEqual(uids, [3, 5, 8])
+        self.assertEqual(conn.searches[0][1], 1)
+        self.assertEqual(extractor.manifest.get('uidvalidity'), u"11")
+
+    def test_snapshot_is_reused(self):
+        conn = FakeConnection([3, 5, 8])
+        uids, extractor = self.snapshot(conn)
+        conn.uids.append(9)
+        self.assertEqual(extractor._snapshot(), [3, 5, 8])
+        self.assertEqual(len(conn.searches), 1)
+
+    def test_limit(self):
+        uids, extractor = self.snapshot(FakeConnection([3, 5, 8]), limit=2)
+        self.assertEqual(uids, [3, 5])
+
+    def test_high_water_uid(self):
+        uids, extractor = self.snapshot(FakeConnection([3, 5, 8]))
+        extractor.manifest.set('high_water_uid', 8)
+        conn = FakeConnection([3, 5, 8, 12])
+        uids, extractor = self.snapshot(conn)
+        self.assertEqual(uids, [12])
+        self.assertEqual(conn.searches[0][1], 9)
+
+    def test_uidvalidity_change_starts_over(self):
+        uids, extractor = self.snapshot(FakeConnection([3, 5, 8]))
+        extractor.manifest.set('high_water_uid', 8)
+        conn = FakeConnection([2, 4], uidvalidity=12)
+        uids, extractor = self.snapshot(conn)
+        self.assertEqual(uids, [2, 4])
+        self.assertEqual(conn.searches[0][1], 1)
+        self.assertEqual(extractor.manifest.get('uidvalidity'), u"12")
+        self.assertEqual(extractor.manifest.get('high_water_uid'), u"0")
+
+    def test_query_change_starts_over(self):
+        uids, extractor = self.snapshot(FakeConnection([3, 5, 8]))
+        extractor.manifest.set('high_water_uid', 8)
+        search = SearchFilter(larger=1048576)
+        conn = FakeConnection([3, 5, 8])
+        uids, extractor = self.snapshot(conn, search=search)
+        self.assertEqual(uids, [3, 5, 8])
+        self.assertEqual(conn.searches[0], (search.query(), 1))
+        self.assertEqual(extractor.manifest.get('query'), search.query())
+
+    def test_same_query_keeps_high_water_uid(self):
+        uids, extractor = self.snapshot(FakeConnection([3, 5, 8]),
+                                        search=SearchFilter(larger=1048576))
+        extractor.manifest.set('high_water_uid', 8)
+        conn = FakeConnection([3, 5, 8])
+        uids, extractor = self.snapshot(conn, search=SearchFilter(larger=1048576))
+        self.assertEqual(uids, [])
+        self.assertEqual(conn.searches[0][1], 9)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""Tests of finding the parts of a message in its BODYSTRUCTURE, using
+structures shaped like the ones Gmail sends, of decoding parts a piece at a
+time, and of removing parts from messages.
+"""
+
+import base64
+import email
+import hashlib
+import quopri
+import unittest
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from gmailextract.imap import parse
+from gmailextract.mime import parts, decoder, remove_parts, add_header
+
+
+def bodystructure(text):
+    """Returns the parsed BODYSTRUCTURE from a FETCH response."""
+    return parse([text])[1][1]
+
+
+# A multipart/alternative body, followed by two images: one named in its
+# Content-Disposition, the other only in its Content-Type
+NESTED = bodystructure(
+    '1 (BODYSTRUCTURE ((("text" "plain" ("charset" "UTF-8") NIL NIL "7bit" 12 1 NIL NIL '
+    'NIL)("text" "html" ("charset" "UTF-8") NIL NIL "quoted-printable" 34 1 NIL NIL NIL) '
+    '"alternative" ("boundary" "000000000000b1c2") NIL NIL)("image" "jpeg" ("name" '
+    '"photo.jpg") "<f_jk1>" NIL "base64" 1024 NIL ("attachment" ("filename" "photo.jpg")) '
+    'NIL)("image" "gif" ("name" "=?UTF-8?B?w6ljbGFpci5naWY=?=") NIL NIL "base64" 512 NIL '
+    'NIL NIL) "mixed" ("boundary" "000000000000a0b1") NIL NIL))')
+
+# A forwarded message, with an image of its own, attached after an image
+FORWARDED = bodystructure(
+    '1 (BODYSTRUCTURE (("text" "plain" ("charset" "UTF-8") NIL NIL "7bit" 20 2 NIL NIL '
+    'NIL)("image" "png" NIL NIL NIL "base64" 2048 NIL ("inline" ("filename" "logo.png")) '
+    'NIL)("message" "rfc822" NIL NIL NIL "7bit" 4096 ("Mon, 1 Jan 2018 10:00:00 +0000" '
+    '"Holiday" (("Ann" NIL "ann" "example.com")) (("Ann" NIL "ann" "example.com")) '
+    '(("Ann" NIL "ann" "example.com")) ((NIL NIL "bob" "example.com")) NIL NIL NIL '
+    '"<abc@example.com>") (("text" "plain" ("charset" "UTF-8") NIL NIL "7bit" 5 1 NIL '
+    'NIL NIL)("image" "jpeg" ("name" "beach.jpg") NIL NIL "base64" 3000 NIL ("attachment" '
+    '("filename" "beach.jpg")) NIL) "mixed" ("boundary" "inner") NIL NIL) 80 NIL '
+    '("attachment" ("filename" "Holiday.eml")) NIL) "mixed" ("boundary" "outer") NIL NIL))')
+
+# File names given with RFC 2231 encoding, in both headers
+RFC2231 = bodystructure(
+    '1 (BODYSTRUCTURE (("text" "plain" ("charset" "UTF-8") NIL NIL "7bit" 3 1 NIL NIL '
+    'NIL)("image" "jpeg" ("name*" "utf-8\'\'%E5%86%99%E7%9C%9F.jpg") NIL NIL "base64" 100 '
+    'NIL ("attachment" ("filename*" "utf-8\'\'%E5%86%99%E7%9C%9F.jpg")) NIL)("image" '
+    '"png" ("name*" "iso-8859-1\'en\'caf%E9.png") NIL NIL "base64" 200 NIL NIL NIL) "mixed" '
+    '("boundary" "b") NIL NIL))')
+
+
+class PartsTest(unittest.TestCase):
+
+    def test_nested_multipart_sections(self):
+        found = parts(NESTED)
+        self.assertEqual([(p.section, p.type) for p in found],
+                         [("1.1", "text/plain"), ("1.2", "text/html"),
+                          ("2", "image/jpeg"), ("3", "image/gif")])
+        self.assertEqual([p.encoding for p in found],
+                         ["7bit", "quoted-printable", "base64", "base64"])
+        self.assertEqual([p.size for p in found], [12, 34, 1024, 512])
+
+    def test_dispositions(self):
+        text, html, jpeg, gif = parts(NESTED)
+        self.assertEqual(jpeg.disposition, ("attachment", {"filename": "photo.jpg"}))
+        self.assertIsNone(text.disposition)
+        self.assertIsNone(gif.disposition)
+
+    def test_names(self):
+        text, html, jpeg, gif = parts(NESTED)
+        self.assertEqual(jpeg.name(), u"photo.jpg")
+        # With a NIL disposition, the name comes from the Content-Type
+        self.assertEqual(gif.name(), u"éclair.gif")
+        self.assertEqual(text.name(), u"")
+
+    def test_single_part_message(self):
+        found = parts(bodystructure(
+            '1 (BODYSTRUCTURE ("image" "jpeg" ("name" "scan.jpg") NIL NIL "base64" 64 NIL '
+            '("attachment" ("filename" "scan.jpg")) NIL))'))
+        self.assertEqual([(p.section, p.type, p.name()) for p in found],
+                         [("1", "image/jpeg", u"scan.jpg")])
+
+    def test_attached_message_is_not_descended_into(self):
+        found = parts(FORWARDED)
+        self.assertEqual([(p.section, p.type) for p in found],
+                         [("1", "text/plain"), ("2", "image/png"), ("3", "message/rfc822")])
+        self.assertEqual(found[1].params, {})
+        self.assertEqual(found[1].disposition, ("inline", {"filename": "logo.png"}))
+        self.assertEqual(found[1].name(), u"logo.png")
+        # The disposition follows the attached message's envelope, body and
+        # line count
+        self.assertEqual(found[2].disposition, ("attachment", {"filename": "Holiday.eml"}))
+        self.assertEqual(found[2].size, 4096)
+
+    def test_rfc2231_names(self):
+        text, jpeg, png = parts(RFC2231)
+        self.assertEqual(jpeg.name(), u"写真.jpg")
+        self.assertEqual(png.name(), u"café.png")
+
+    def test_missing_extension_data(self):
+        # Servers can leave off the extension data after the size
+        found = parts(bodystructure(
+            '1 (BODYSTRUCTURE (("text" "plain" NIL NIL NIL NIL 3 1)("image" "gif" NIL NIL NIL '
+            '"base64" 10) "mixed"))'))
+        self.assertEqual([(p.section, p.type, p.encoding, p.disposition) for p in found],
+                         [("1", "text/plain", "7bit", None), ("2", "image/gif", "base64", None)])
+
+
+def pieces(data, size):
+    """Splits data into pieces of the given size, as they would be fetched."""
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def decode(encoding, data, size):
+    """Decodes data a piece at a time, as it is written to disk."""
+    a_decoder = decoder(encoding)
+    return "".join(a_decoder.decode(piece) for piece in pieces(data, size)) + a_decoder.flush()
+
+
+class DecoderTest(unittest.TestCase):
+
+    data = "".join(chr(i) for i in range(256)) * 20
+
+    def test_base64(self):
+        encoded = base64.encodestring(self.data).replace("\n", "\r\n")
+        for size in (1, 3, 4, 7, 76, 78, len(encoded)):
+            self.assertEqual(decode("base64", encoded, size), self.data)
+
+    def test_base64_without_padding(self):
+        self.assertEqual(decode("base64", base64.b64encode("abcd").rstrip("="), 3), "abcd")
+
+    def test_quoted_printable(self):
+        text = ("caf\xc3\xa9 " * 40 + "\n") * 3
+        encoded = quopri.encodestring(text)
+        self.assertIn("=\n", encoded)
+        for size in (1, 2, 3, 10, len(encoded)):
+            self.assertEqual(decode("quoted-printable", encoded, size), text)
+
+    def test_identity(self):
+        for encoding in ("7bit", "8bit", "binary"):
+            self.assertEqual(decode(encoding, self.data, 100), self.data)
+
+
+def message(*images):
+    """Returns the full text of a message with the given images attached."""
+    msg = MIMEMultipart()
+    msg["Subject"] = "Photos"
+    alternative = MIMEMultipart("alternative")
+    alternative.attach(MIMEText("Some photos"))
+    alternative.attach(MIMEText("<p>Some photos</p>", "html"))
+    msg.attach(alternative)
+    for i, data in enumerate(images):
+        part = MIMEImage(data, "jpeg")
+        part.add_header("Content-Disposition", "attachment", filename="photo{0}.jpg".format(i))
+        msg.attach(part)
+    return msg.as_string().replace("\n", "\r\n")
+
+
+def sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+class RemovePartsTest(unittest.TestCase):
+
+    def attachments(self, raw):
+        return [part.get_payload(decode=True) for part in email.message_from_string(raw).walk()
+                if part.get_content_maintype() == "image"]
+
+    def test_remove(self):
+        raw, removed = remove_parts(message("one", "two"), [sha1("one")])
+        self.assertEqual(removed, [sha1("one")])
+        self.assertEqual(self.attachments(raw), ["two"])
+        msg = email.message_from_string(raw)
+        self.assertEqual(msg["Subject"], "Photos")
+        self.assertEqual([part.get_payload() for part in msg.walk()
+                          if part.get_content_maintype() == "text"],
+                         ["Some photos", "<p>Some photos</p>"])
+
+    def test_crlf_line_endings(self):
+        raw, removed = remove_parts(message("one", "two"), [sha1("two")])
+        self.assertNotIn("\n", raw.replace("\r\n", ""))
+
+    def test_copies_of_an_image(self):
+        # A hash given once only removes one copy
+        raw, removed = remove_parts(message("one", "one", "one"), [sha1("one")] * 2)
+        self.assertEqual(removed, [sha1("one")] * 2)
+        self.assertEqual(self.attachments(raw), ["one"])
+
+    def test_nothing_to_remove(self):
+        original = message("one")
+        raw, removed = remove_parts(original, [sha1("other")])
+        self.assertEqual(removed, [])
+        self.assertIs(raw, original)
+
+    def test_add_header(self):
+        raw = add_header(message("one"), "X-Token", "abc")
+        self.assertTrue(raw.startswith("X-Token: abc\r\n"))
+        self.assertEqual(email.message_from_string(raw)["X-Token"], "abc")
+        self.assertEqual(self.attachments(raw), ["one"])
+
+
+if __name__ == "__main__":
+    unittest.main()
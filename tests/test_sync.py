@@ -0,0 +1,171 @@
+"""Tests that syncing deletions back to Gmail never leaves two copies of an
+altered message, however it is interrupted, and removes the right images,
+run against the stand-in for Gmail's IMAP server in bench/fakeimap.py.
+"""
+
+import collections
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from bench import fakeimap, mailgen
+from gmailextract.extractor import GmailImageExtractor
+from gmailextract.imap import TOKEN_HEADER
+from gmailextract.throttle import Backoff
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs a sync in a process of its own, which is killed (without any chance
+# to clean up) either just before or just after the first APPEND
+CHILD = """
+import os, sys
+sys.path.insert(0, sys.argv[1])
+from gmailextract import imap
+from gmailextract.extractor import GmailImageExtractor
+
+append = imap.GmailConnection.append
+
+def _append(self, *args, **kwargs):
+    if sys.argv[4] == "after":
+        append(self, *args, **kwargs)
+    os._exit(3)
+
+imap.GmailConnection.append = _append
+extractor = GmailImageExtractor(sys.argv[2], "a@example.com", "pw", replace=True,
+                                server=("127.0.0.1", int(sys.argv[3]), False))
+extractor.connect()
+extractor.check_deletions()
+extractor.sync()
+"""
+
+
+class SyncRecoveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.account = fakeimap.Mailbox("a@example.com", "pw")
+        mailgen.populate(self.account, mailgen.MailSpec(messages=6, image_ratio=1.0,
+                                                        image_size=2000, other_size=1000,
+                                                        shared_ratio=0))
+        self.server = fakeimap.FakeGmailServer(self.account)
+        self.server.start()
+        self.extractors = []
+
+        # Extracts everything, and deletes one image
+        extractor = self.extractor()
+        extractor.extract()
+        self.deleted = sorted(extractor.mapping)[0]
+        self.gm_id = extractor.mapping[self.deleted][0]
+        os.remove(os.path.join(self.dest, self.deleted))
+
+    def tearDown(self):
+        for extractor in self.extractors:
+            extractor.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dest)
+
+    def extractor(self):
+        extractor = GmailImageExtractor(self.dest, "a@example.com", "pw", replace=True,
+                                        server=("127.0.0.1", self.server.port, False))
+        self.extractors.append(extractor)
+        self.assertTrue(extractor.connect())
+        return extractor
+
+    def subjects(self, folder=fakeimap.ALL_MAIL):
+        return collections.Counter(msg.parsed["Subject"] for msg in self.account.folders[folder])
+
+    def sync_in_child(self, when):
+        returncode = subprocess.call([sys.executable, "-c", CHILD, ROOT, self.dest,
+                                      str(self.server.port), when])
+        self.assertEqual(returncode, 3)
+
+    def resume(self):
+        """Syncs again, as the next run would, and checks that exactly one
+        altered copy of the message is left in All Mail.
+        """
+        extractor = self.extractor()
+        self.assertEqual(extractor.check_deletions(), 1)
+        self.assertEqual(extractor.sync(), (1, 1))
+        self.assertEqual(extractor.manifest.unfinished_rewrites(), {})
+        self.assertNotIn(self.deleted, extractor.manifest.mapping())
+
+        subjects = self.subjects()
+        self.assertEqual(len(self.account.folders[fakeimap.ALL_MAIL]), 6)
+        self.assertEqual(max(subjects.values()), 1)
+        self.assertEqual(sum(self.subjects(fakeimap.TRASH).values()), 1)
+        # The altered message was recorded as processed, so extracting
+        # again finds nothing new
+        self.assertEqual(extractor.extract(), 0)
+        return extractor
+
+    def test_killed_after_append(self):
+        self.sync_in_child("after")
+        # The altered message reached Gmail, but its UID was never recorded
+        self.assertEqual(len(self.account.folders[fakeimap.ALL_MAIL]), 7)
+        extractor = self.extractors[0]
+        rewrite = extractor.manifest.unfinished_rewrites()[self.gm_id]
+        self.assertEqual((rewrite["state"], rewrite["new_uid"]), (u"planned", None))
+        appended = self.account.folders[fakeimap.ALL_MAIL][-1]
+        self.assertEqual(appended.parsed[TOKEN_HEADER], rewrite["token"])
+
+        extractor = self.resume()
+        # It was found by its token, and finished rather than sent again
+        self.assertEqual(extractor.metrics.snapshot()["counters"].get(u"sync.resumed"), 1)
+        self.assertIn(appended, self.account.folders[fakeimap.ALL_MAIL])
+
+    def test_killed_before_append(self):
+        self.sync_in_child("before")
+        self.assertEqual(len(self.account.folders[fakeimap.ALL_MAIL]), 6)
+        rewrite = self.extractors[0].manifest.unfinished_rewrites()[self.gm_id]
+        self.assertEqual(rewrite["state"], u"planned")
+
+        # Nothing is found by the token, so the rewrite is started over
+        extractor = self.resume()
+        self.assertIsNone(extractor.metrics.snapshot()["counters"].get(u"sync.resumed"))
+
+    def test_connection_dropped_during_append(self):
+        # The message is stored, but the connection drops before Gmail
+        # answers, so it isn't known whether the APPEND worked
+        append = fakeimap.Handler.append
+
+        def _append(handler, tag, rest, parts):
+            fakeimap.Handler.append = append
+            handler.server.account.add(parts[0][1])
+            raise fakeimap.socket.error("dropped")
+
+        fakeimap.Handler.append = _append
+        try:
+            extractor = self.extractor()
+            extractor.conn.backoff = Backoff(initial=0.01)
+            self.assertEqual(extractor.check_deletions(), 1)
+            self.assertEqual(extractor.sync(), (1, 1))
+        finally:
+            fakeimap.Handler.append = append
+        self.assertEqual(extractor.metrics.snapshot()["counters"].get(u"imap.appends_found"), 1)
+        self.assertEqual(len(self.account.folders[fakeimap.ALL_MAIL]), 6)
+        self.assertEqual(max(self.subjects().values()), 1)
+
+    def test_names_of_unsynced_deletions_are_kept(self):
+        # A new image with the same name as the deleted one, which is still
+        # recorded against its message until the deletion is synced
+        index = int(self.deleted.split(u" - ")[0].split()[1])
+        self.account.add(mailgen.make_message(index, ["new image"], []))
+        extractor = self.extractor()
+        self.assertEqual(extractor.extract(), 1)
+        self.assertEqual(extractor.mapping[self.deleted][0], self.gm_id)
+        self.assertFalse(os.path.exists(os.path.join(self.dest, self.deleted)))
+
+        self.assertEqual(extractor.check_deletions(), 1)
+        self.assertEqual(extractor.sync(), (1, 1))
+        new_names = [name for name in extractor.mapping if name.startswith(self.deleted[:-4])]
+        self.assertEqual(len(new_names), 1)
+        self.assertNotEqual(new_names[0], self.deleted)
+        with open(os.path.join(self.dest, new_names[0]), "rb") as handle:
+            self.assertEqual(handle.read(), "new image")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,24 @@
 import tornado
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
 import tornado.web
 import tornado.template
 import tornado.websocket
 import tornado.escape
+import logging
+import mimetypes
 import os
+import sys
+from multiprocessing.pool import ThreadPool
 from os.path import expanduser
 from gmailextract.extractor import GmailImageExtractor
+from gmailextract.fs import account_dirname, normalize_email
+from gmailextract.imap import GMAIL_HOST
+from gmailextract.jobs import JobManager
+from gmailextract.metrics import Metrics
+from gmailextract.search import SearchFilter
+from gmailextract.thumbs import ThumbnailCache
 
 root_dir = os.path.dirname(os.path.abspath(__file__))
 attr_dir = os.path.join(expanduser("~"), "Gmail Images")
@@ -13,7 +26,42 @@ if not os.path.isdir(attr_dir):
     os.mkdir(attr_dir)
 
 tpl_loader = tornado.template.Loader(os.path.join(root_dir, 'templates'))
-state = {}
+jobs = JobManager()
+# Totals across every job run by this process
+metrics = Metrics()
+# Shared by every job, so copies of an image extracted from different
+# accounts share a thumbnail
+thumbnails = ThumbnailCache(os.path.join(attr_dir, ".thumbnails"), metrics=metrics)
+
+# Images are named by their sha1 hash in URLs, so once a browser has one
+# it never needs to ask for it again
+IMAGE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+# The most bytes of a full size image read into memory at a time
+IMAGE_CHUNK_SIZE = 262144
+
+# Reads and makes images for the gallery, so the IOLoop never waits on the
+# disk.  A fixed pool of threads, rather than one per call, as a single
+# download reads many chunks.  concurrent.futures isn't in Python 2's
+# standard library, so the pool comes from multiprocessing.
+file_pool = ThreadPool(8)
+
+def in_pool(func, *args):
+    """Calls `func(*args)` in one of the threads of file_pool, returning a
+    Future that is resolved on the IOLoop with the result.
+    """
+    io_loop = tornado.ioloop.IOLoop.current()
+    future = tornado.concurrent.Future()
+
+    def _call():
+        try:
+            result = func(*args)
+        except Exception:
+            io_loop.add_callback(future.set_exc_info, sys.exc_info())
+        else:
+            io_loop.add_callback(future.set_result, result)
+
+    file_pool.apply_async(_call)
+    return future
 
 def plural(msg, num):
     if num == 1:
@@ -25,98 +73,356 @@ class MainHandler(tornado.web.RequestHandler):
     def get(self):
         self.write(tpl_loader.load("main.html").generate(home_dir=attr_dir))
 
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        job_list = jobs.jobs.values()
+        report = metrics.snapshot()
+        report["jobs"] = {"total": len(job_list),
+                          "running": len([job for job in job_list if job.busy()]),
+                          "attached": len([job for job in job_list if job.attached()])}
+        report["connections"] = dict((host, budget.in_use)
+                                     for host, budget in jobs.budgets.items())
+        self.write(report)
+
+class GalleryHandler(tornado.web.RequestHandler):
+    """Lists a page of the images a job has extracted, as JSON, for the
+    browser to pick images to remove from.
+    """
+
+    def get(self, job_id):
+        job = jobs.get(job_id)
+        if job is None:
+            raise tornado.web.HTTPError(404)
+        try:
+            page = max(0, int(self.get_argument("page", 0)))
+            per_page = min(200, max(1, int(self.get_argument("per_page", 48))))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+
+        # Listed from the mapping, without looking at the directory
+        images = sorted(job.extractor.mapping.items())
+        num_pages = (len(images) + per_page - 1) // per_page
+        base = u"/gallery/{0}".format(job.id)
+        self.write({"page": page,
+                    "pages": num_pages,
+                    "total": len(images),
+                    "images": [{"name": name,
+                                "hash": a_hash,
+                                "subject": subject,
+                                "thumb": u"{0}/thumb/{1}?name={2}".format(base, a_hash, tornado.escape.url_escape(name)),
+                                "url": u"{0}/image/{1}?name={2}".format(base, a_hash, tornado.escape.url_escape(name))}
+                               for name, (gm_id, a_hash, subject)
+                               in images[page * per_page:(page + 1) * per_page]]})
+
+class ImageHandler(tornado.web.RequestHandler):
+    """Serves an image a job has extracted, at full size."""
+
+    def image_path(self, job_id, a_hash):
+        """Returns the path of the image with the given hash, named by the
+        "name" argument, if the job extracted it.
+        """
+        job = jobs.get(job_id)
+        name = self.get_argument("name")
+        entry = job.extractor.mapping.get(name) if job is not None else None
+        if entry is None or entry[1] != a_hash:
+            raise tornado.web.HTTPError(404)
+        path = os.path.join(job.extractor.dest, name)
+        if not os.path.isfile(path):
+            raise tornado.web.HTTPError(404)
+        return path
+
+    def not_modified(self, etag):
+        """Sets caching headers from the given ETag, returning a boolean
+        description of whether the browser already has the response.
+        """
+        self.set_header("Etag", etag)
+        self.set_header("Cache-Control", IMAGE_CACHE_CONTROL)
+        if self.check_etag_header():
+            self.set_status(304)
+            return True
+        return False
+
+    @tornado.gen.coroutine
+    def write_image(self, path):
+        """Sends an image a piece at a time, each read in a thread, so that
+        neither the IOLoop waits on the disk nor is a large image held in
+        memory all at once.
+        """
+        self.set_header("Content-Type", mimetypes.guess_type(path)[0] or "application/octet-stream")
+        handle = yield in_pool(open, path, 'rb')
+        try:
+            while True:
+                data = yield in_pool(handle.read, IMAGE_CHUNK_SIZE)
+                if not data:
+                    break
+                self.write(data)
+                yield self.flush()
+        finally:
+            handle.close()
+
+    @tornado.gen.coroutine
+    def get(self, job_id, a_hash):
+        path = self.image_path(job_id, a_hash)
+        if self.not_modified(u'"{0}"'.format(a_hash)):
+            return
+        yield self.write_image(path)
+
+class ThumbnailHandler(ImageHandler):
+    """Serves a thumbnail of an image a job has extracted, made off the
+    IOLoop the first time it is asked for.
+    """
+
+    @tornado.gen.coroutine
+    def get(self, job_id, a_hash):
+        path = self.image_path(job_id, a_hash)
+        if self.not_modified(u'"{0}-{1}"'.format(a_hash, thumbnails.size)):
+            return
+        data = yield in_pool(thumbnails.get, a_hash, path)
+        if data is None:
+            # Without PIL, or for images it can't read, the image itself
+            # stands in for its thumbnail
+            yield self.write_image(path)
+            return
+        self.set_header("Content-Type", "image/jpeg")
+        self.write(data)
+
 class SocketHandler(tornado.websocket.WebSocketHandler):
 
+    # Talking to Gmail can take minutes, so each step of a job is run in its
+    # own thread, leaving the IOLoop free to serve other requests and to
+    # send progress messages as they happen.  Jobs outlive the socket that
+    # started them, so a client that reconnects can attach to its job again.
+
+    def open(self):
+        self.io_loop = tornado.ioloop.IOLoop.current()
+        self.job = None
+
     def on_message(self, message):
         msg = tornado.escape.json_decode(message)
         if 'type' not in msg:
             return
+        elif msg['type'] == 'attach':
+            self._handle_attach(msg)
         elif msg['type'] == 'connect':
             self._handle_connect(msg)
         elif msg['type'] == 'sync':
-            self._handle_sync(msg)
+            self._run(self._handle_sync, msg)
         elif msg['type'] == 'confirm':
-            self._handle_confirmation(msg)
+            self._run(self._handle_confirmation, msg)
         else:
             return
 
+    def _send(self, message):
+        """Sends a message to the browser.  Can be called from any thread,
+        the message is written from the IOLoop.
+        """
+        self.io_loop.add_callback(self._write, message)
+
+    def _write(self, message):
+        try:
+            self.write_message(message)
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+    def _error(self, text):
+        self.write_message({"ok": False,
+                            "type": "error",
+                            "msg": text})
+
+    def _run(self, handler, msg, prepare=None):
+        job = self.job
+        if job is None:
+            self._error(u"Please connect to Gmail first.")
+            return
+
+        def _guarded(func):
+            def _call():
+                try:
+                    return func(job, msg)
+                except Exception:
+                    logging.exception("Error handling '%s' message", msg['type'])
+                    job.send({"ok": False,
+                              "type": "error",
+                              "msg": u"Something went wrong while talking to Gmail."})
+                    return False
+            return _call
+
+        waiting = {"ok": True,
+                   "type": "waiting",
+                   "msg": u"Waiting for other users' jobs to finish."}
+        if not job.run(_guarded(handler), waiting,
+                       prepare=_guarded(prepare) if prepare is not None else None):
+            self._error(u"Please wait for the current step to finish.")
+
+    def _handle_attach(self, msg):
+        job = jobs.get(msg.get('job'))
+        if job is None:
+            self.write_message({"ok": False,
+                                "type": "attach",
+                                "msg": u"That job has finished, please connect again."})
+            return
+        self._detach()
+        self.job = job
+        job.attach(self._send)
+
+    def _detach(self):
+        if self.job is not None:
+            self.job.detach(self._send)
+            self.job = None
+
     def _handle_connect(self, msg):
-        state['extractor'] = GmailImageExtractor(attr_dir, msg['email'],
-                                                 msg['pass'], limit=int(msg['limit']),
-                                                 batch=int(msg['simultaneous']),
-                                                 replace=bool(msg['rewrite']))
-        if not state['extractor'].connect():
-            self.write_message({'ok': False,
-                                "type": "connect",
-                                'msg': u"Unable to connect to Gmail with provided credentials"})
-        else:
-            self.write_message({'ok': True,
-                                "type": "connect",
-                                "msg": u"Successfully connecting with Gmail."})
-
-            num_messages = state['extractor'].num_messages_with_attachments()
-            self.write_message({'ok': True,
-                                "type": "count",
-                                "msg": u"Found {0} {1} with attachments".format(num_messages, plural(u"message", num_messages)),
-                                "num": num_messages})
-
-            def _status(*args):
-                if args[0] == 'message':
-                    status_msg = u"Fetching messages {1} - {2}".format(msg['simultaneous'], args[1], num_messages)
-                    self.write_message({"ok": True,
-                                        "type": "downloading",
-                                        "msg": status_msg,
-                                        "num": args[1]})
-
-            attachment_count = state['extractor'].extract(_status)
-            self.write_message({"ok": True,
-                                "type": "download-complete",
-                                "msg": "Succesfully stored {0} {1} to disk".format(attachment_count, plural(u"attachment", attachment_count)),
-                                "num": attachment_count})
-
-    def _handle_sync(self, msg):
-        extractor = state['extractor']
-
-        self.write_message({"ok": True,
-                            "type": "file-checking",
-                            "msg": u"Checking to see which files have been deleted."})
-        num_deletions = extractor.check_deletions()
-        self.write_message({"ok": True,
-                            "type": "file-checked",
-                            "msg": u"Found {0} {1} deleted".format(num_deletions, plural(u"image", num_deletions)),
-                            "num": num_deletions})
-
-    def _handle_confirmation(self, msg):
-        extractor = state['extractor']
+        if self.job is not None and self.job.busy():
+            self._error(u"Please wait for the current step to finish.")
+            return
+
+        # Each account gets a directory of its own, so users don't
+        # share images or manifests
+        dest = os.path.join(attr_dir, account_dirname(msg['email']))
+        if not os.path.isdir(dest):
+            os.mkdir(dest)
+        extractor = GmailImageExtractor(dest, msg['email'],
+                                        msg['pass'], limit=int(msg['limit']),
+                                        batch=int(msg['simultaneous']),
+                                        replace=bool(msg['rewrite']),
+                                        connections=int(msg.get('connections', 1)),
+                                        budget=jobs.budget(GMAIL_HOST),
+                                        metrics=Metrics(parent=metrics),
+                                        search=SearchFilter(images_only=not msg.get('all_attachments'),
+                                                            larger=msg.get('larger'),
+                                                            smaller=msg.get('smaller'),
+                                                            after=msg.get('after'),
+                                                            before=msg.get('before'),
+                                                            labels=[msg['label']] if msg.get('label') else [],
+                                                            raw=msg.get('query')))
+        job = jobs.add(normalize_email(msg['email']), extractor)
+        if job is None:
+            extractor.close()
+            self._error(u"Images are already being extracted from this account.")
+            return
+        self._detach()
+        self.job = job
+        job.attach(self._send)
+        self._run(self._handle_extract, msg, prepare=self._handle_login)
+
+    def _handle_login(self, job, msg):
+        """Connects to Gmail, returning a boolean description of whether the
+        job can go on to extracting.  This runs before the job takes a
+        slot, as connecting can wait on the connection budget, which only
+        jobs holding slots can give back to.
+        """
+        extractor = job.extractor
+        if not extractor.connect():
+            job.send({'ok': False,
+                      "type": "connect",
+                      'msg': u"Unable to connect to Gmail with provided credentials"})
+            jobs.remove(job)
+            return False
+
+        if not jobs.authenticate(job):
+            job.send({'ok': False,
+                      "type": "connect",
+                      'msg': u"Images are already being extracted from this account."})
+            jobs.remove(job)
+            return False
+
+        # The job id gives access to the account's images, through the
+        # gallery and by attaching, so it is only handed out now
+        job.send({"ok": True,
+                  "type": "job",
+                  "job": job.id})
+        job.send({'ok': True,
+                  "type": "connect",
+                  "msg": u"Successfully connecting with Gmail."})
+        return True
+
+    def _handle_extract(self, job, msg):
+        extractor = job.extractor
+        num_messages = extractor.num_messages_with_attachments()
+        job.send({'ok': True,
+                  "type": "count",
+                  "msg": u"Found {0} {1} with attachments".format(num_messages, plural(u"message", num_messages)),
+                  "num": num_messages})
+
+        def _status(*args):
+            if args[0] == 'message':
+                status_msg = u"Fetching messages {1} - {2}".format(msg['simultaneous'], args[1], num_messages)
+                job.send({"ok": True,
+                          "type": "downloading",
+                          "msg": status_msg,
+                          "num": args[1]})
+
+        attachment_count = extractor.extract(_status)
+        job.send({"ok": True,
+                  "type": "download-complete",
+                  "msg": "Succesfully stored {0} {1} to disk".format(attachment_count, plural(u"attachment", attachment_count)),
+                  "num": attachment_count,
+                  "path": extractor.dest})
+
+        # Let the user know how many images they've marked for removal
+        # as they delete them.
+        def _marked(num_deleted):
+            job.send({"ok": True,
+                      "type": "marked",
+                      "msg": u"{0} {1} marked for removal".format(num_deleted, plural(u"image", num_deleted)),
+                      "num": num_deleted})
+
+        extractor.watch_deletions(_marked)
+
+    def _handle_sync(self, job, msg):
+        extractor = job.extractor
+
+        job.send({"ok": True,
+                  "type": "file-checking",
+                  "msg": u"Checking to see which files have been deleted."})
+        # Images picked in the gallery are used as is, rather than looking
+        # for images deleted from disk
+        num_deletions = extractor.check_deletions(names=msg.get('names'))
+        job.send({"ok": True,
+                  "type": "file-checked",
+                  "msg": u"Found {0} {1} {2}".format(num_deletions, plural(u"image", num_deletions),
+                                                     u"selected" if 'names' in msg else u"deleted"),
+                  "num": num_deletions})
+
+    def _handle_confirmation(self, job, msg):
+        extractor = job.extractor
 
         def _sync_status(*args):
             update_type = args[0]
             if update_type == "fetch":
-                self.write_message({"ok": True,
-                                    "type": "removing",
-                                    "msg": u"Removing {0} {1} from message '{2}'.".format(args[2], args[1], plural(u"image", args[2]))})
+                job.send({"ok": True,
+                          "type": "removing",
+                          "msg": u"Removing {0} {1} from message '{2}'.".format(args[2], args[1], plural(u"image", args[2]))})
             elif update_type == "write":
-                self.write_message({"ok": True,
-                                    "type": "removed",
-                                    "msg": u"Writing altered version of '{0}' to Gmail.".format(args[1])})
+                job.send({"ok": True,
+                          "type": "removed",
+                          "msg": u"Writing altered version of '{0}' to Gmail.".format(args[1])})
 
+        extractor.stop_watching()
         num_attch_removed, num_msg_changed = extractor.sync(callback=_sync_status)
-        self.write_message({"ok": True,
-                            "type": "finished",
-                            "msg": u"Removed {0} {1} from {2} {3}.".format(num_attch_removed,
-                                                                               plural(u"image", num_attch_removed),
-                                                                               num_msg_changed,
-                                                                               plural(u"message", num_msg_changed))})
+        job.send({"ok": True,
+                  "type": "finished",
+                  "msg": u"Removed {0} {1} from {2} {3}.".format(num_attch_removed,
+                                                                plural(u"image", num_attch_removed),
+                                                                num_msg_changed,
+                                                                plural(u"message", num_msg_changed))})
 
     def on_close(self):
-        state['extractor'] = None
+        # The job carries on without the socket, until it is attached to
+        # again or expires
+        self._detach()
 
 
 if __name__ == "__main__":
     application = tornado.web.Application([
         (r"/assets/(.*)", tornado.web.StaticFileHandler, {"path": os.path.join(root_dir, 'assets')}),
         (r'/ws', SocketHandler),
+        (r'/metrics', MetricsHandler),
+        (r'/gallery/([0-9a-f]+)', GalleryHandler),
+        (r'/gallery/([0-9a-f]+)/image/([0-9a-f]{40})', ImageHandler),
+        (r'/gallery/([0-9a-f]+)/thumb/([0-9a-f]{40})', ThumbnailHandler),
         (r"/", MainHandler),
     ])
     application.listen(8888)
+    # Drop the jobs of users who have gone away, checking once a minute
+    tornado.ioloop.PeriodicCallback(jobs.expire, 60 * 1000).start()
     tornado.ioloop.IOLoop.instance().start()